@@ -1,22 +1,48 @@
 from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
 import sqlite3
 import requests
-from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+from datetime import datetime, timedelta, timezone
 import json
+import copy
 import telebot
-from telebot.apihelper import ApiException
+from telebot.apihelper import ApiException, ApiTelegramException
 from yoomoney import Client, Quickpay
 from apscheduler.schedulers.background import BackgroundScheduler
 from pytz import utc
 from functools import wraps
+from urllib.parse import urljoin, urlsplit
+from collections import namedtuple, deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 import threading
+import queue
+import heapq
+import itertools
 import time
 import sys
 import signal
+import socket
+import atexit
 import uuid
 import os
+import hashlib
+import hmac
+import secrets
+import random
 from werkzeug.utils import secure_filename
 
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    # Без Pillow картинки сохраняются как загружены, без проверки и оптимизации
+    Image = None
+
+try:
+    import numpy as np
+except ImportError:
+    # Без NumPy ClientStatsView считает маски обычным циклом
+    np = None
+
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-here'
 
@@ -27,18 +53,188 @@ scheduler = None
 telegram_bot = None
 bot_thread = None
 bot_running = False  # Добавляем флаг состояния бота
+bot_stop_event = None  # Сигнал остановки текущего потока опроса
+bot_mode = None  # 'polling' или 'webhook'
+applied_telegram_settings = None  # Настройки, с которыми запущены бот и планировщик
+bot_update_offsets = {}  # Токен бота -> offset следующего getUpdates
 
 # Добавим константы для загрузки файлов
 UPLOAD_FOLDER = 'static/uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+ALLOWED_IMAGE_FORMATS = {'PNG', 'JPEG', 'GIF'}
+IMAGE_MAX_UPLOAD_SIZE = 10 * 1024 * 1024  # лимит Telegram для sendPhoto
+IMAGE_MAX_DIMENSION = 1280  # Telegram все равно уменьшает фото до этого размера по большей стороне
+IMAGE_OUTPUT_FORMAT = 'JPEG'  # или 'WEBP'
+IMAGE_QUALITY = 85
+
+# Настройки базы данных
+DATABASE = 'database.db'
+DB_POOL_SIZE = 8
+DB_BUSY_TIMEOUT = 5000  # мс
+DB_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT}',
+    'PRAGMA mmap_size=268435456',
+    'PRAGMA cache_size=-16000',
+    'PRAGMA temp_store=MEMORY',
+)
+
+# Как часто (в секундах) проверять версию настроек, измененных другими процессами
+SETTINGS_VERSION_CHECK_INTERVAL = 2
+
+# Платежи подтверждаются HTTP-уведомлениями YooMoney, опрос истории - страховка
+# на случай потерянного уведомления, поэтому выполняется редко (в минутах)
+PAYMENT_CHECK_INTERVAL = 15
+
+# Постраничная загрузка истории операций YooMoney
+YOOMONEY_HISTORY_PAGE_SIZE = 100
+YOOMONEY_HISTORY_MAX_PAGES = 10
+# Насколько раньше курсора перечитывать историю, чтобы не пропустить поздно подтвержденные операции
+YOOMONEY_RESCAN_WINDOW = timedelta(hours=6)
+# Через сколько дней неоплаченный счет перестает искаться в истории при плановой сверке
+# (статус expired). Уведомление YooMoney или ручная проверка все равно его проведут
+PAYMENT_PENDING_DAYS = 3
+# Наибольшая комиссия YooMoney с суммы перевода: в истории операций сумма указана уже за ее вычетом
+YOOMONEY_MAX_COMMISSION = 0.03
+
+# Время жизни кэша списка inbound в секундах
+INBOUND_CACHE_TTL = float(os.environ.get('INBOUND_CACHE_TTL', 30))
+# Сколько секунд после неудачной загрузки сразу возвращать ту же ошибку, не обращаясь к панели
+INBOUND_FAILURE_BACKOFF = float(os.environ.get('INBOUND_FAILURE_BACKOFF', 15))
+
+# Несколько узлов 3x-ui: сколько ждать ответа одного узла (если в panels не задано свое)
+# и сколько узлов опрашивать одновременно
+PANEL_NODE_TIMEOUT = float(os.environ.get('PANEL_NODE_TIMEOUT', 10))
+PANEL_FANOUT_WORKERS = 8
+
+# Уведомления об окончании подписки рассылаются равномерно в течение окна,
+# не больше NOTIFY_PER_MINUTE_CAP в минуту; если в окно не укладываемся, окно растягивается
+NOTIFY_DELIVERY_WINDOW = int(os.environ.get('NOTIFY_DELIVERY_WINDOW', 60))  # минуты
+NOTIFY_PER_MINUTE_CAP = int(os.environ.get('NOTIFY_PER_MINUTE_CAP', 20))
+
+# Проверка подписок, которой не удалось обработать клиента, повторяется не раньше чем через
+EXPIRY_CHECK_MIN_DELAY = 60  # секунд
+# Клиенты, чей срок напоминания наступает в пределах этого окна, обрабатываются одной проверкой
+EXPIRY_CHECK_COALESCE = 15 * 60  # секунд
+
+# Поля telegram_settings, при изменении которых бота нужно перезапустить.
+# Остальные (шаблоны, сумма платежа) читаются из settings_cache при каждом использовании
+BOT_RESTART_FIELDS = ('bot_token', 'is_enabled', 'update_mode', 'webhook_url', 'webhook_secret')
+
+# Аренда лидера: планировщик и опрос Telegram работают только в одном процессе
+LEADER_LEASE_SECONDS = int(os.environ.get('LEADER_LEASE_SECONDS', 30))
+LEADER_HEARTBEAT_INTERVAL = 10  # секунд
+
+# Кэш ответов на /stat
+STAT_CACHE_TTL = float(os.environ.get('STAT_CACHE_TTL', 60))
+STAT_RATE_LIMIT_INTERVAL = 5  # секунды, повторный /stat раньше получает сохраненный ответ
+STAT_CACHE_MIN_TTL = 5  # секунды, срок ответа клиента, почти исчерпавшего лимит трафика
+
+# Очередь фоновых задач (продление подписки, сообщения в Telegram, выставление счетов)
+JOB_WORKERS = 4
+JOB_POLL_INTERVAL = 1  # секунды
+JOB_LEASE_SECONDS = 300  # через сколько задачу упавшего обработчика можно взять повторно
+JOB_MAX_ATTEMPTS = 8
+JOB_RETRY_BASE = 10  # секунды, задержка удваивается с каждой попыткой
+JOB_RETRY_MAX = 3600
+# Задачи, которые нельзя бросить: оплаченный платеж обязан продлить подписку.
+# После JOB_MAX_ATTEMPTS они повторяются раз в JOB_RETRY_MAX, администратор получает уведомление
+JOB_RETRY_FOREVER = {'extend_client'}
+JOB_RETENTION_DAYS = 7  # через сколько дней удаляются выполненные задачи
+JOB_FAILED_RETENTION_DAYS = 30  # и неудачные, после разбора
+
+# Лимиты Telegram Bot API и очередь исходящих сообщений
+TELEGRAM_GLOBAL_RATE = 30  # сообщений в секунду на бота
+TELEGRAM_CHAT_RATE = 1  # сообщений в секунду в один чат
+TELEGRAM_SEND_QUEUE_SIZE = 1000
+TELEGRAM_SEND_QUEUE_TIMEOUT = 5  # секунды ожидания места в заполненной очереди
+TELEGRAM_SEND_TIMEOUT = 60  # секунды ожидания отправки в send_and_wait
+TELEGRAM_SEND_MAX_RETRIES = 3  # повторов после ответа 429
+TELEGRAM_SEND_CONCURRENCY = 8  # запросов к Bot API одновременно (в разные чаты)
+
+# Прием обновлений Telegram: long polling или webhook (telegram_settings.update_mode)
+TELEGRAM_UPDATE_WORKERS = 8
+TELEGRAM_UPDATE_QUEUE_SIZE = 1000  # обновлений, ожидающих обработки
+TELEGRAM_HANDLER_TIMEOUT = 60  # секунды, после которых чат освобождается для следующего обновления
+TELEGRAM_POLL_TIMEOUT = 30  # секунды long polling
+# Адрес Bot API. Для проверки без сети можно указать локальную заглушку
+# fake_telegram_api.py: http://127.0.0.1:8081/bot{0}/{1}
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL
 
 # Создадим папку для загрузок, если её нет
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+def validate_image(file):
+    """
+    Проверяет загруженную картинку: размер файла и, если есть Pillow, что это действительно картинка.
+
+    Raises:
+        Exception: Если файл не подходит
+    """
+    file.stream.seek(0, os.SEEK_END)
+    size = file.stream.tell()
+    file.stream.seek(0)
+    if size > IMAGE_MAX_UPLOAD_SIZE:
+        raise Exception(f'Файл больше {IMAGE_MAX_UPLOAD_SIZE // (1024 * 1024)} МБ')
+
+    if Image is not None:
+        try:
+            with Image.open(file.stream) as image:
+                image_format = image.format
+                image.verify()
+        except Exception:
+            raise Exception('Файл не является изображением')
+        finally:
+            file.stream.seek(0)
+        if image_format not in ALLOWED_IMAGE_FORMATS:
+            raise Exception(f'Неподдерживаемый формат изображения: {image_format}')
+
+def optimize_image(source_path):
+    """
+    Уменьшает картинку до IMAGE_MAX_DIMENSION и пережимает в IMAGE_OUTPUT_FORMAT.
+
+    Args:
+        source_path (str): Путь относительно static
+
+    Returns:
+        str: Путь к оптимизированной картинке относительно static или None,
+            если оптимизация не нужна (анимация, результат не меньше исходника)
+    """
+    source_file = os.path.join('static', source_path)
+    extension = 'webp' if IMAGE_OUTPUT_FORMAT == 'WEBP' else 'jpg'
+    target_path = f"{os.path.splitext(source_path)[0]}.opt.{extension}"
+    target_file = os.path.join('static', target_path)
+
+    with Image.open(source_file) as image:
+        # Анимацию Telegram как фото все равно не покажет, оставляем файл как есть
+        if getattr(image, 'n_frames', 1) > 1:
+            return None
+
+        image = ImageOps.exif_transpose(image)
+        resized = max(image.size) > IMAGE_MAX_DIMENSION
+        image.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.LANCZOS)
+
+        if image.mode != 'RGB':
+            # Прозрачность накладываем на белый фон, в JPEG ее нет
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+
+        image.save(target_file, IMAGE_OUTPUT_FORMAT, quality=IMAGE_QUALITY, optimize=True)
+
+    if not resized and os.path.getsize(target_file) >= os.path.getsize(source_file):
+        os.remove(target_file)
+        return None
+    return target_path
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def create_payment_for_client(email, amount, days, inbound_id, tgid=None):
+def create_payment_for_client(email, amount, days, inbound_id, tgid=None, payment_id=None):
     """
     Создает платеж для клиента
     
@@ -48,6 +244,8 @@ def create_payment_for_client(email, amount, days, inbound_id, tgid=None):
         days (int): Количество дней
         inbound_id (str): ID inbound
         tgid (str, optional): Telegram ID клиента
+        payment_id (str, optional): Заранее выданный ID платежа, повторный вызов
+            с тем же ID не создает второй записи
         
     Returns:
         dict: Результат создания платежа
@@ -58,7 +256,8 @@ def create_payment_for_client(email, amount, days, inbound_id, tgid=None):
             raise Exception('YooMoney не настроен')
         
         # Создаем уникальный ID платежа
-        payment_id = f"vpn_{email}_{int(datetime.now().timestamp())}"
+        if payment_id is None:
+            payment_id = f"vpn_{email}_{int(datetime.now().timestamp())}"
         
         # Создаем форму оплаты
         quickpay = Quickpay(
@@ -74,7 +273,7 @@ def create_payment_for_client(email, amount, days, inbound_id, tgid=None):
         # Сохраняем информацию о платеже
         db = get_db()
         try:
-            db.execute('''INSERT INTO payments 
+            db.execute('''INSERT OR IGNORE INTO payments 
                          (email, amount, days, payment_id, inbound_id) 
                          VALUES (?, ?, ?, ?, ?)''',
                       [email, amount, days, payment_id, inbound_id])
@@ -95,145 +294,1734 @@ def create_payment_for_client(email, amount, days, inbound_id, tgid=None):
             'error': str(e)
         }
 
+class PooledConnection(sqlite3.Connection):
+    """
+    Соединение из пула.
+
+    close() не закрывает соединение, а откатывает незавершенную транзакцию
+    и возвращает его в пул, поэтому существующий код get_db()/close() работает как раньше.
+    """
+
+    pool = None
+    pid = None
+    released = False
+
+    def close(self):
+        if self.released:
+            return
+        if self.in_transaction:
+            self.rollback()
+        self.released = True
+        self.pool.release(self)
+
+    def close_connection(self):
+        super().close()
+
+class ConnectionPool:
+    """
+    Пул соединений SQLite с настроенными PRAGMA.
+
+    Каждый вызов acquire() выдает отдельное соединение, так что вложенные get_db()
+    (например, get_settings() внутри транзакции) не делят транзакцию с внешним кодом.
+    Если свободных соединений нет, открывается новое, лишние закрываются при возврате.
+
+    Соединения SQLite нельзя использовать после fork (gunicorn --preload): процесс
+    с другим PID начинает с пустым пулом, а унаследованные соединения не трогает.
+    """
+
+    def __init__(self, database, size=DB_POOL_SIZE):
+        self.database = database
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        # Унаследованные от родителя соединения: не используются и не закрываются
+        # (закрытие сняло бы блокировки родительского процесса), но и не собираются GC
+        self._inherited = []
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # Блокировка могла быть захвачена другим потоком родителя в момент fork
+            self._lock = threading.Lock()
+            self._inherited.extend(self._idle)
+            self._idle = []
+            self._pid = os.getpid()
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.database,
+            timeout=DB_BUSY_TIMEOUT / 1000,
+            check_same_thread=False,  # Соединение используется одним потоком, пока оно выдано
+            factory=PooledConnection
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        conn.pool = self
+        conn.pid = os.getpid()
+        return conn
+
+    def acquire(self):
+        self._check_pid()
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = self._connect()
+        conn.released = False
+        return conn
+
+    def release(self, conn):
+        self._check_pid()
+        if conn.pid != self._pid:
+            # Соединение выдано родителю до fork
+            self._inherited.append(conn)
+            return
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close_connection()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close_connection()
+
+db_pool = ConnectionPool(DATABASE)
+
 def get_db():
-    conn = sqlite3.connect('database.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+    return db_pool.acquire()
+
+def add_column_if_missing(db, table, column, definition):
+    """Добавляет колонку в таблицу, если ее еще нет (для баз, созданных старыми версиями)"""
+    columns = [row['name'] for row in db.execute(f'PRAGMA table_info({table})')]
+    if column not in columns:
+        db.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+def migrate_baseline(db):
+    """Базовая схема всех таблиц приложения"""
+    db.execute('''CREATE TABLE IF NOT EXISTS users (
+                     id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     username TEXT NOT NULL UNIQUE,
+                     password TEXT NOT NULL)''')
+    db.execute('''CREATE TABLE IF NOT EXISTS settings (
+                     id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     panel_url TEXT NOT NULL,
+                     username TEXT NOT NULL,
+                     password TEXT NOT NULL,
+                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    db.execute('''CREATE TABLE IF NOT EXISTS telegram_settings (
+                     id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     bot_token TEXT,
+                     admin_chat_id TEXT,
+                     is_enabled BOOLEAN DEFAULT 0,
+                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    db.execute('''CREATE TABLE IF NOT EXISTS yoomoney_settings (
+                     id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     wallet_id TEXT,
+                     secret_key TEXT,
+                     redirect_url TEXT,
+                     is_enabled BOOLEAN DEFAULT 0,
+                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    db.execute('''CREATE TABLE IF NOT EXISTS client_data (
+                     id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     email TEXT NOT NULL UNIQUE,
+                     tgid TEXT,
+                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    db.execute('''CREATE TABLE IF NOT EXISTS payments (
+                     id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     email TEXT NOT NULL,
+                     amount DECIMAL(10,2) NOT NULL,
+                     days INTEGER NOT NULL,
+                     payment_id TEXT NOT NULL UNIQUE,
+                     inbound_id TEXT,
+                     status TEXT DEFAULT 'pending',
+                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                     paid_at TIMESTAMP)''')
+    db.execute('''CREATE TABLE IF NOT EXISTS notification_history (
+                     id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     email TEXT NOT NULL,
+                     expiry_time INTEGER NOT NULL,
+                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    db.execute('''CREATE TABLE IF NOT EXISTS bot_messages (
+                     id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     message_type TEXT NOT NULL UNIQUE,
+                     message_text TEXT,
+                     is_enabled BOOLEAN DEFAULT 1,
+                     image_path TEXT,
+                     show_image BOOLEAN DEFAULT 0)''')
+    db.execute('''CREATE TABLE IF NOT EXISTS test_account_settings (
+                     id INTEGER PRIMARY KEY,
+                     is_enabled BOOLEAN DEFAULT 0,
+                     days INTEGER DEFAULT 1,
+                     traffic_gb INTEGER DEFAULT 1)''')
+    db.execute('INSERT OR IGNORE INTO test_account_settings (id) VALUES (1)')
+
+    # Счетчик изменений настроек для SettingsCache
+    db.execute('''CREATE TABLE IF NOT EXISTS settings_version (
+                     id INTEGER PRIMARY KEY CHECK (id = 1),
+                     version INTEGER NOT NULL DEFAULT 0)''')
+    db.execute('INSERT OR IGNORE INTO settings_version (id, version) VALUES (1, 0)')
+
+    # Учетная запись по умолчанию для новой базы, пароль меняется на странице /change_password
+    if not db.execute('SELECT 1 FROM users LIMIT 1').fetchone():
+        db.execute("INSERT INTO users (username, password) VALUES ('admin', 'admin')")
+
+def migrate_notification_settings(db):
+    """Колонки настроек уведомлений, раньше добавлявшиеся при сохранении формы"""
+    add_column_if_missing(db, 'telegram_settings', 'notify_days', 'INTEGER DEFAULT 3')
+    add_column_if_missing(db, 'telegram_settings', 'create_payment', 'BOOLEAN DEFAULT 0')
+    add_column_if_missing(db, 'telegram_settings', 'payment_amount', 'DECIMAL(10,2)')
+    add_column_if_missing(db, 'telegram_settings', 'notification_template', 'TEXT')
+    add_column_if_missing(db, 'telegram_settings', 'check_interval', 'INTEGER DEFAULT 60')
+    add_column_if_missing(db, 'telegram_settings', 'interval_unit', "TEXT DEFAULT 'minutes'")
+
+    # Колонки сообщений бота, которых может не быть в старых базах
+    add_column_if_missing(db, 'bot_messages', 'is_enabled', 'BOOLEAN DEFAULT 1')
+    add_column_if_missing(db, 'bot_messages', 'image_path', 'TEXT')
+    add_column_if_missing(db, 'bot_messages', 'show_image', 'BOOLEAN DEFAULT 0')
+
+def migrate_lookup_indexes(db):
+    """Индексы для поиска платежей, клиентов и истории уведомлений"""
+    db.execute('CREATE INDEX IF NOT EXISTS idx_payments_payment_id ON payments (payment_id)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_client_data_email ON client_data (email)')
+    db.execute('''CREATE INDEX IF NOT EXISTS idx_notification_history_email_expiry
+                  ON notification_history (email, expiry_time)''')
+
+def migrate_yoomoney_cursor(db):
+    """Курсор истории операций YooMoney для инкрементальной сверки платежей"""
+    db.execute('''CREATE TABLE IF NOT EXISTS yoomoney_cursor (
+                     id INTEGER PRIMARY KEY CHECK (id = 1),
+                     last_operation_id TEXT,
+                     last_operation_time TIMESTAMP,
+                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+def migrate_hot_query_indexes(db):
+    """Индексы для остальных частых запросов, включая поиск по tgid без учета регистра"""
+    db.execute('CREATE INDEX IF NOT EXISTS idx_payments_status ON payments (status)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_client_data_tgid_nocase ON client_data (tgid COLLATE NOCASE)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_notification_history_created_at ON notification_history (created_at)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_bot_messages_message_type ON bot_messages (message_type)')
+
+def migrate_jobs(db):
+    """Таблица очереди фоновых задач"""
+    db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                     id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     job_type TEXT NOT NULL,
+                     payload TEXT NOT NULL,
+                     dedup_key TEXT UNIQUE,
+                     group_key TEXT,
+                     status TEXT DEFAULT 'pending',
+                     attempts INTEGER DEFAULT 0,
+                     max_attempts INTEGER DEFAULT 8,
+                     run_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                     locked_until TIMESTAMP,
+                     last_error TEXT,
+                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status_run_at ON jobs (status, run_at)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_jobs_group_key ON jobs (group_key, status)')
+
+def migrate_telegram_update_mode(db):
+    """Режим получения обновлений Telegram и параметры webhook"""
+    add_column_if_missing(db, 'telegram_settings', 'update_mode', "TEXT DEFAULT 'polling'")
+    add_column_if_missing(db, 'telegram_settings', 'webhook_url', 'TEXT')
+    add_column_if_missing(db, 'telegram_settings', 'webhook_secret', 'TEXT')
+
+def migrate_start_image_file_id(db):
+    """file_id картинки /start, уже загруженной в Telegram"""
+    add_column_if_missing(db, 'bot_messages', 'image_file_id', 'TEXT')
+
+def migrate_start_image_original(db):
+    """Путь к исходной картинке, когда в image_path лежит оптимизированная"""
+    add_column_if_missing(db, 'bot_messages', 'image_original_path', 'TEXT')
+
+def migrate_expiry_timeline(db):
+    """Очередь напоминаний об окончании подписки, упорядоченная по notify_at"""
+    db.execute('''CREATE TABLE IF NOT EXISTS expiry_timeline (
+                     email TEXT PRIMARY KEY,
+                     inbound_id TEXT,
+                     expiry_time INTEGER NOT NULL,
+                     notify_days INTEGER NOT NULL,
+                     notify_at INTEGER NOT NULL,
+                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_expiry_timeline_notify_at ON expiry_timeline (notify_at)')
+
+def migrate_leader_lease(db):
+    """Аренда лидера среди процессов приложения"""
+    db.execute('''CREATE TABLE IF NOT EXISTS leader_lease (
+                     name TEXT PRIMARY KEY,
+                     holder TEXT NOT NULL,
+                     expires_at REAL NOT NULL,
+                     acquired_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+def migrate_panels(db):
+    """Дополнительные узлы 3x-ui, основная панель остается в settings"""
+    db.execute('''CREATE TABLE IF NOT EXISTS panels (
+                     id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     name TEXT NOT NULL,
+                     panel_url TEXT NOT NULL,
+                     username TEXT NOT NULL,
+                     password TEXT NOT NULL,
+                     timeout REAL,
+                     is_enabled BOOLEAN DEFAULT 1,
+                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+def migrate_yoomoney_notification_secret(db):
+    """Секрет HTTP-уведомлений отличается от токена API в secret_key"""
+    add_column_if_missing(db, 'yoomoney_settings', 'notification_secret', 'TEXT')
+
+def migrate_expiry_timeline_per_inbound(db):
+    """
+    Ключ expiry_timeline - (email, inbound_id): клиент с одним email может быть на нескольких узлах.
+
+    Содержимое не переносится, следующая синхронизация заполнит таблицу заново.
+    """
+    db.execute('DROP TABLE IF EXISTS expiry_timeline')
+    db.execute('''CREATE TABLE expiry_timeline (
+                     email TEXT NOT NULL,
+                     inbound_id TEXT NOT NULL,
+                     expiry_time INTEGER NOT NULL,
+                     notify_days INTEGER NOT NULL,
+                     notify_at INTEGER NOT NULL,
+                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                     PRIMARY KEY (email, inbound_id))''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_expiry_timeline_notify_at ON expiry_timeline (notify_at)')
+
+def ensure_unique_index(db, table, column, index_name):
+    """
+    Гарантирует уникальность значений column.
+
+    В базах, созданных до миграций, таблица могла появиться без UNIQUE: CREATE TABLE
+    IF NOT EXISTS ее не меняет. Если уникального индекса нет, он создается;
+    при повторяющихся значениях индекс не создается и выводится предупреждение.
+
+    Returns:
+        bool: True, если уникальность обеспечена индексом
+    """
+    for index in db.execute(f'PRAGMA index_list({table})').fetchall():
+        columns = [row['name'] for row in db.execute(f"PRAGMA index_info({index['name']})")]
+        if index['unique'] and columns == [column]:
+            return True
+
+    if db.execute(f'SELECT 1 FROM {table} GROUP BY {column} HAVING COUNT(*) > 1 LIMIT 1').fetchone():
+        print(f"Warning: {table}.{column} has duplicate values, unique index not created")
+        return False
+    db.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {index_name} ON {table} ({column})')
+    return True
+
+def migrate_unique_lookup_indexes(db):
+    """
+    Уникальные индексы payments.payment_id и client_data.email.
+
+    На них держится идемпотентность INSERT OR IGNORE. Обычные индексы по тем же
+    колонкам удаляются, только когда уникальный индекс точно есть.
+    """
+    for table, column, plain_index in (('payments', 'payment_id', 'idx_payments_payment_id'),
+                                       ('client_data', 'email', 'idx_client_data_email')):
+        if ensure_unique_index(db, table, column, f'{plain_index}_unique'):
+            db.execute(f'DROP INDEX IF EXISTS {plain_index}')
+
+def migrate_remove_default_admin(db):
+    """
+    Удаляет учетную запись admin/admin из migrate_baseline.
+
+    Первая учетная запись создается из ADMIN_USERNAME и ADMIN_PASSWORD (create_initial_admin).
+    """
+    db.execute("DELETE FROM users WHERE username = 'admin' AND password = 'admin'")
+
+def migrate_stat_cache_version(db):
+    """Счетчик сбросов кэша ответов /stat, общий для всех процессов"""
+    db.execute('''CREATE TABLE IF NOT EXISTS stat_cache_version (
+                     id INTEGER PRIMARY KEY CHECK (id = 1),
+                     version INTEGER NOT NULL DEFAULT 0)''')
+    db.execute('INSERT OR IGNORE INTO stat_cache_version (id, version) VALUES (1, 0)')
+
+def migrate_telegram_rate_limit(db):
+    """Состояние общего лимита отправки Telegram, одно на все процессы"""
+    db.execute('''CREATE TABLE IF NOT EXISTS telegram_rate_limit (
+                     id INTEGER PRIMARY KEY CHECK (id = 1),
+                     tokens REAL NOT NULL,
+                     updated_at REAL NOT NULL)''')
+
+def migrate_bot_messages_unique_type(db):
+    """
+    Уникальный индекс bot_messages.message_type.
+
+    Колонка объявлена UNIQUE, поэтому обычный индекс из migrate_hot_query_indexes
+    дублирует его и удаляется, если уникальность обеспечена.
+    """
+    if ensure_unique_index(db, 'bot_messages', 'message_type', 'idx_bot_messages_message_type_unique'):
+        db.execute('DROP INDEX IF EXISTS idx_bot_messages_message_type')
+
+# Упорядоченный список миграций: (версия, описание, функция).
+# Новые шаги добавляются только в конец, уже примененные шаги не меняются
+MIGRATIONS = [
+    (1, 'Базовая схема', migrate_baseline),
+    (2, 'Настройки уведомлений', migrate_notification_settings),
+    (3, 'Индексы поиска', migrate_lookup_indexes),
+    (4, 'Индексы частых запросов', migrate_hot_query_indexes),
+    (5, 'Курсор истории YooMoney', migrate_yoomoney_cursor),
+    (6, 'Очередь фоновых задач', migrate_jobs),
+    (7, 'Режим получения обновлений Telegram', migrate_telegram_update_mode),
+    (8, 'file_id картинки /start', migrate_start_image_file_id),
+    (9, 'Исходная картинка /start', migrate_start_image_original),
+    (10, 'Очередь напоминаний о подписках', migrate_expiry_timeline),
+    (11, 'Аренда лидера', migrate_leader_lease),
+    (12, 'Дополнительные панели', migrate_panels),
+    (13, 'Секрет HTTP-уведомлений YooMoney', migrate_yoomoney_notification_secret),
+    (14, 'Напоминания по каждому узлу клиента', migrate_expiry_timeline_per_inbound),
+    (15, 'Уникальные индексы платежей и клиентов', migrate_unique_lookup_indexes),
+    (16, 'Версия кэша ответов /stat', migrate_stat_cache_version),
+    (17, 'Общий лимит отправки Telegram', migrate_telegram_rate_limit),
+    # Миграция 15 раньше удаляла индексы, не проверяя UNIQUE: для баз, где она уже применена
+    (18, 'Проверка уникальных индексов платежей и клиентов', migrate_unique_lookup_indexes),
+    (19, 'Удаление учетной записи по умолчанию', migrate_remove_default_admin),
+    (20, 'Уникальный индекс типов сообщений бота', migrate_bot_messages_unique_type),
+]
+
+# Частые запросы. Код выполняет именно эти строки, а INDEXED_QUERIES (и тест
+# test_migrations) проверяет их планы, поэтому проверка не расходится с кодом.
+# Запросы с IN ({placeholders}) подставляют список параметров через format()
+
+# Платежи и сверка с YooMoney
+SQL_PAYMENT_BY_ID = 'SELECT * FROM payments WHERE payment_id = ?'
+SQL_PAYMENT_STATUS = 'SELECT status FROM payments WHERE payment_id = ?'
+SQL_PENDING_PAYMENT_IDS = 'SELECT payment_id FROM payments WHERE status = ?'
+SQL_OLDEST_PENDING_PAYMENT = 'SELECT MIN(created_at) AS oldest FROM payments WHERE status = ?'
+SQL_EXPIRE_STALE_PAYMENTS = '''UPDATE payments SET status = 'expired' 
+                               WHERE status = 'pending' AND created_at < datetime('now', ?)'''
+SQL_UNSETTLED_PAYMENTS = "SELECT * FROM payments WHERE status IN ('pending', 'expired') AND payment_id IN ({placeholders})"
+SQL_MARK_PAYMENT_PAID = 'UPDATE payments SET status = ?, paid_at = CURRENT_TIMESTAMP WHERE payment_id = ?'
+
+# Клиенты и бот
+SQL_CLIENT_BY_EMAIL = 'SELECT * FROM client_data WHERE email = ?'
+SQL_EMAIL_BY_TGID = 'SELECT email FROM client_data WHERE tgid = ? COLLATE NOCASE'
+SQL_USER_BY_LOGIN = 'SELECT * FROM users WHERE username = ? AND password = ?'
+
+# Напоминания об окончании подписки
+SQL_DUE_TIMELINE = '''SELECT * FROM expiry_timeline 
+                      WHERE notify_at <= ? AND expiry_time > ? AND notify_at < expiry_time 
+                      ORDER BY notify_at'''
+SQL_NEXT_NOTIFY_AT = '''SELECT MIN(notify_at) AS next_at FROM expiry_timeline 
+                        WHERE expiry_time > ? AND notify_at < expiry_time'''
+SQL_NOTIFIED_EMAILS = 'SELECT email, expiry_time FROM notification_history WHERE email IN ({placeholders})'
+SQL_TGIDS_BY_EMAILS = "SELECT email, tgid FROM client_data WHERE tgid IS NOT NULL AND tgid != '' AND email IN ({placeholders})"
+SQL_CLEANUP_NOTIFICATION_HISTORY = "DELETE FROM notification_history WHERE created_at < datetime('now', '-1 day')"
+
+# Очередь задач
+SQL_CLAIM_JOB = '''SELECT * FROM jobs j
+                   WHERE ((j.status = 'pending' AND j.run_at <= datetime('now'))
+                          OR (j.status = 'running' AND j.locked_until <= datetime('now')))
+                     AND NOT EXISTS (
+                         SELECT 1 FROM jobs k
+                         WHERE k.group_key = j.group_key AND k.id < j.id
+                           AND k.status IN ('pending', 'running'))
+                   ORDER BY j.run_at, j.id
+                   LIMIT 1'''
+SQL_PLANNED_NOTIFICATIONS = '''SELECT CAST((strftime('%s', run_at) - strftime('%s', 'now')) / 60 AS INTEGER) AS minute,
+                                     COUNT(*) AS planned
+                              FROM jobs 
+                              WHERE status = 'pending' AND run_at > datetime('now')
+                                AND (dedup_key LIKE 'expiry_notice:%' OR dedup_key LIKE 'create_invoice:%')
+                              GROUP BY minute'''
+
+# Запросы, которые должны обслуживаться индексами: (запрос, параметры для EXPLAIN)
+INDEXED_QUERIES = [
+    (SQL_PAYMENT_BY_ID, ['']),
+    (SQL_PAYMENT_STATUS, ['']),
+    (SQL_PENDING_PAYMENT_IDS, ['pending']),
+    (SQL_OLDEST_PENDING_PAYMENT, ['pending']),
+    (SQL_EXPIRE_STALE_PAYMENTS, ['-3 days']),
+    (SQL_UNSETTLED_PAYMENTS.format(placeholders='?,?'), ['', '']),
+    (SQL_MARK_PAYMENT_PAID, ['paid', '']),
+    (SQL_CLIENT_BY_EMAIL, ['']),
+    (SQL_EMAIL_BY_TGID, ['']),
+    (SQL_USER_BY_LOGIN, ['', '']),
+    (SQL_DUE_TIMELINE, [0, 0]),
+    (SQL_NEXT_NOTIFY_AT, [0]),
+    (SQL_NOTIFIED_EMAILS.format(placeholders='?,?'), ['', '']),
+    (SQL_TGIDS_BY_EMAILS.format(placeholders='?,?'), ['', '']),
+    (SQL_CLEANUP_NOTIFICATION_HISTORY, []),
+    (SQL_CLAIM_JOB, []),
+    (SQL_PLANNED_NOTIFICATIONS, []),
+]
+
+def find_full_scans(db, queries=INDEXED_QUERIES):
+    """
+    Прогоняет EXPLAIN QUERY PLAN для запросов и возвращает те, что читают всю таблицу.
+
+    Returns:
+        list: Пары (запрос, строка плана) для запросов с полным сканированием
+    """
+    full_scans = []
+    for query, params in queries:
+        for row in db.execute(f'EXPLAIN QUERY PLAN {query}', params):
+            detail = row['detail']
+            # "SCAN t" и "SCAN t USING COVERING INDEX" - полный проход, "SEARCH t USING INDEX" - поиск по индексу
+            if detail.startswith('SCAN ') and 'CONSTANT ROW' not in detail:
+                full_scans.append((query, detail))
+    return full_scans
+
+def run_migrations(db):
+    """Применяет непримененные миграции, каждую в своей транзакции"""
+    db.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+                     version INTEGER PRIMARY KEY,
+                     description TEXT,
+                     applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    db.commit()
+
+    for version, description, migrate in MIGRATIONS:
+        # BEGIN IMMEDIATE не дает двум процессам применить одну миграцию одновременно
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            applied = db.execute('SELECT 1 FROM schema_version WHERE version = ?',
+                                 [version]).fetchone()
+            if applied:
+                db.rollback()
+                continue
+
+            print(f"Applying migration {version}: {description}")
+            migrate(db)
+            db.execute('INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                      [version, description])
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+NO_USERS_MESSAGE = ('Учетных записей нет: задайте переменные окружения ADMIN_PASSWORD '
+                    '(и при необходимости ADMIN_USERNAME) и перезапустите приложение')
+
+def create_initial_admin(db):
+    """
+    Создает первую учетную запись в пустой базе.
+
+    Пароля по умолчанию нет: логин и пароль берутся из ADMIN_USERNAME и ADMIN_PASSWORD,
+    без ADMIN_PASSWORD учетная запись не создается.
+    """
+    if db.execute('SELECT 1 FROM users LIMIT 1').fetchone():
+        return
+
+    password = os.environ.get('ADMIN_PASSWORD')
+    if not password:
+        print(f"Warning: {NO_USERS_MESSAGE}")
+        return
+    username = os.environ.get('ADMIN_USERNAME', 'admin')
+    db.execute('INSERT INTO users (username, password) VALUES (?, ?)', [username, password])
+    db.commit()
+    print(f"Created user {username}")
 
 def init_db():
     with app.app_context():
         db = get_db()
-        with app.open_resource('schema.sql', mode='r') as f:
-            db.cursor().executescript(f.read())
-        db.commit()
+        try:
+            run_migrations(db)
+            create_initial_admin(db)
+
+            # Проверяем, что после миграций частые запросы не деградировали до полного сканирования
+            for query, detail in find_full_scans(db):
+                print(f"Warning: full table scan in query plan: {query} -> {detail}")
+        finally:
+            db.close()
+
+class SettingsCache:
+    """
+    Кэш строк настроек, сообщений бота и настроек тестовых аккаунтов.
+
+    Маршруты, изменяющие эти таблицы, увеличивают счетчик в settings_version
+    (bump_settings_version) и сбрасывают локальный кэш. Остальные процессы
+    замечают новую версию при следующей проверке, не чаще раза в check_interval секунд.
+    """
+
+    def __init__(self, check_interval=SETTINGS_VERSION_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._data = None
+        self._version = None
+        self._checked_at = 0
+
+    @staticmethod
+    def _read_version(db):
+        row = db.execute('SELECT version FROM settings_version WHERE id = 1').fetchone()
+        return row['version'] if row else 0
+
+    def _load(self):
+        db = get_db()
+        try:
+            # Читаем версию и данные в одной транзакции, чтобы они соответствовали друг другу
+            db.execute('BEGIN')
+            version = self._read_version(db)
+            data = {
+                'settings': db.execute('SELECT * FROM settings ORDER BY id DESC LIMIT 1').fetchone(),
+                'telegram_settings': db.execute('SELECT * FROM telegram_settings ORDER BY id DESC LIMIT 1').fetchone(),
+                'yoomoney_settings': db.execute('SELECT * FROM yoomoney_settings ORDER BY id DESC LIMIT 1').fetchone(),
+                'test_account_settings': db.execute('SELECT * FROM test_account_settings WHERE id = 1').fetchone(),
+                'bot_messages': {row['message_type']: row for row in db.execute('SELECT * FROM bot_messages')},
+                'panels': db.execute('SELECT * FROM panels WHERE is_enabled = 1 ORDER BY id').fetchall()
+            }
+        finally:
+            db.close()
+        return version, data
+
+    def _current(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._data is not None:
+                if now - self._checked_at < self.check_interval:
+                    return self._data
+
+                db = get_db()
+                try:
+                    version = self._read_version(db)
+                finally:
+                    db.close()
+
+                if version == self._version:
+                    self._checked_at = now
+                    return self._data
+
+            self._version, self._data = self._load()
+            self._checked_at = now
+            return self._data
+
+    def get(self, name):
+        return self._current()[name]
+
+    def get_bot_message(self, message_type):
+        return self._current()['bot_messages'].get(message_type)
+
+    def invalidate(self):
+        with self._lock:
+            self._data = None
+
+settings_cache = SettingsCache()
+
+# Таблицы, содержимое которых хранится в SettingsCache
+SETTINGS_TABLES = {'settings', 'telegram_settings', 'yoomoney_settings', 'test_account_settings', 'bot_messages', 'panels'}
+
+def bump_settings_version(db):
+    """Отмечает изменение настроек для всех процессов, вызывается в транзакции записи"""
+    db.execute('UPDATE settings_version SET version = version + 1 WHERE id = 1')
 
 def get_settings():
-    db = get_db()
-    settings = db.execute('SELECT * FROM settings ORDER BY id DESC LIMIT 1').fetchone()
-    db.close()
-    return settings
+    return settings_cache.get('settings')
 
 def get_telegram_settings():
-    db = get_db()
-    settings = db.execute('SELECT * FROM telegram_settings ORDER BY id DESC LIMIT 1').fetchone()
-    db.close()
-    return settings
+    return settings_cache.get('telegram_settings')
+
+def get_extra_panels():
+    return settings_cache.get('panels')
 
 def get_yoomoney_settings():
-    db = get_db()
-    settings = db.execute('SELECT * FROM yoomoney_settings ORDER BY id DESC LIMIT 1').fetchone()
-    db.close()
-    return settings
+    return settings_cache.get('yoomoney_settings')
+
+def get_test_account_settings():
+    return settings_cache.get('test_account_settings')
 
 def get_client_data(email):
     db = get_db()
-    client = db.execute('SELECT * FROM client_data WHERE email = ?', [email]).fetchone()
+    client = db.execute(SQL_CLIENT_BY_EMAIL, [email]).fetchone()
     db.close()
     return client
 
 def update_client_data(email, tgid):
     db = get_db()
-    existing = db.execute('SELECT * FROM client_data WHERE email = ?', [email]).fetchone()
+    existing = db.execute(SQL_CLIENT_BY_EMAIL, [email]).fetchone()
     if existing:
         db.execute('UPDATE client_data SET tgid = ?, updated_at = CURRENT_TIMESTAMP WHERE email = ?',
                   [tgid, email])
     else:
         db.execute('INSERT INTO client_data (email, tgid) VALUES (?, ?)',
                   [email, tgid])
+    version = bump_stat_cache_version(db)
     db.commit()
     db.close()
+    stat_cache.invalidate(tgid=tgid, emails=[email], version=version)
 
-# Добавим декоратор для проверки авторизации
-def login_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
-            return redirect(url_for('login'))
-        return f(*args, **kwargs)
-    return decorated_function
+class PanelError(Exception):
+    """Ошибка обращения к панели 3x-ui"""
 
-@app.route('/login', methods=['GET', 'POST'])
-def login():
-    if request.method == 'POST':
-        username = request.form['username']
-        password = request.form['password']
-        
-        db = get_db()
-        user = db.execute('SELECT * FROM users WHERE username = ? AND password = ?',
-                         [username, password]).fetchone()
-        db.close()
-        
-        if user:
-            session['user_id'] = user['id']
-            session['username'] = user['username']
-            return redirect(url_for('index'))
-        
-        return render_template('login.html', error='Неверный логин или пароль')
-    
-    return render_template('login.html')
+class PanelAuthError(PanelError):
+    """Панель отклонила логин"""
 
-@app.route('/logout')
-def logout():
-    session.clear()
-    return redirect(url_for('login'))
+class PanelClient:
+    """
+    Долгоживущий клиент панели 3x-ui.
 
-@app.route('/change_password', methods=['GET', 'POST'])
-@login_required
-def change_password():
-    if request.method == 'POST':
-        current_password = request.form['current_password']
-        new_username = request.form['new_username']
-        new_password = request.form['new_password']
-        confirm_password = request.form['confirm_password']
-        
-        if new_password != confirm_password:
-            return render_template('change_password.html', 
-                                 error='Пароли не совпадают')
-        
-        db = get_db()
-        # Проверяем текущий пароль
-        user = db.execute('SELECT * FROM users WHERE id = ? AND password = ?',
-                         [session['user_id'], current_password]).fetchone()
-        
-        if not user:
-            return render_template('change_password.html', 
-                                 error='Неверный теущий пароль')
-        
-        # Проверяем, не занят ли новый логин другим пользователем
-        if new_username != user['username']:
-            existing_user = db.execute('SELECT * FROM users WHERE username = ? AND id != ?',
-                                     [new_username, session['user_id']]).fetchone()
-            if existing_user:
-                return render_template('change_password.html', 
-                                     error='Этот логин уже занят')
-        
-        try:
-            # Обновляем учетные данные существующего пользователя
-            db.execute('UPDATE users SET username = ?, password = ? WHERE id = ?',
-                      [new_username, new_password, session['user_id']])
-            db.commit()
-            
-            # Обновляем данные сессии
-            session['username'] = new_username
-            
-            return render_template('change_password.html', 
-                                 success='Учетные данные успешно обновлены')
-        except Exception as e:
-            db.rollback()
-            return render_template('change_password.html', 
-                                 error=f'Ошибка при обновлении данных: {str(e)}')
-        finally:
-            db.close()
-    
-    return render_template('change_password.html')
+    Держит пул HTTP-соединений и cookie авторизации, повторно логинится
+    только когда панель отклоняет сессию (401/403 или редирект на /login).
+    Один экземпляр используется маршрутами, обработчиками бота и задачами планировщика.
+    """
 
-# авляем декоратор @login_required ко всем существующим маршрутам
-@app.route('/')
-@login_required
-def index():
-    return redirect(url_for('clients'))
+    def __init__(self, panel_url, username, password, pool_size=10, timeout=30):
+        self.panel_url = panel_url.rstrip('/')
+        self.username = username
+        self.password = password
+        self.timeout = timeout
 
-@app.route('/clients')
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+        self._login_lock = threading.Lock()
+        self._login_generation = 0  # Увеличивается при каждом успешном логине
+
+        # Кэш списка inbound живет вместе с клиентом и сбрасывается при смене панели
+        self.inbounds = InboundCache(self)
+
+    def login(self, stale_generation=None):
+        """
+        Авторизуется в панели.
+
+        Если передан stale_generation и другой поток уже перелогинился после него,
+        повторный логин не выполняется.
+        """
+        with self._login_lock:
+            if stale_generation is not None and stale_generation != self._login_generation:
+                return
+
+            response = self._session.post(
+                f"{self.panel_url}/login",
+                data={'username': self.username, 'password': self.password},
+                timeout=self.timeout
+            )
+            if response.status_code != 200:
+                raise PanelAuthError('Ошибка авторизации')
+
+            # Панель отвечает 200 и при неверном пароле, признак успеха в JSON
+            try:
+                if not response.json().get('success', True):
+                    raise PanelAuthError('Ошибка авторизации')
+            except ValueError:
+                pass
+
+            self._login_generation += 1
+
+    def _is_auth_rejected(self, response):
+        # Без cookie панель отвечает 401/403 или редиректит на страницу входа:
+        # /login или корень панели (webBasePath). 404 - настоящая ошибка адреса,
+        # повторный логин ее не исправит
+        if response.status_code in (401, 403):
+            return True
+        if not response.is_redirect:
+            return False
+        location = urlsplit(urljoin(response.url, response.headers.get('Location', ''))).path.rstrip('/')
+        base_path = urlsplit(self.panel_url).path.rstrip('/')
+        return location in (base_path, f'{base_path}/login')
+
+    def request(self, method, path, **kwargs):
+        """Выполняет запрос к панели, при отказе в авторизации перелогинивается один раз"""
+        kwargs.setdefault('timeout', self.timeout)
+        kwargs.setdefault('allow_redirects', False)
+        url = f"{self.panel_url}{path}"
+
+        if self._login_generation == 0:
+            self.login(stale_generation=0)
+
+        generation = self._login_generation
+        response = self._session.request(method, url, **kwargs)
+        if self._is_auth_rejected(response):
+            self.login(stale_generation=generation)
+            response = self._session.request(method, url, **kwargs)
+
+        return response
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def close(self):
+        self._session.close()
+
+def parse_json_field(value):
+    """Разбирает JSON-строку из ответа панели, при ошибке возвращает пустой словарь"""
+    if isinstance(value, dict):
+        return value
+    try:
+        return json.loads(value) if value else {}
+    except (TypeError, ValueError):
+        return {}
+
+# Запись индекса клиентов: inbound, настройки клиента из settings и его clientStats.
+# settings или stats могут быть None, если панель вернула только одну из частей
+ClientRecord = namedtuple('ClientRecord', ['inbound', 'settings', 'stats'])
+
+class InboundSnapshot:
+    """
+    Снимок /panel/api/inbounds/list с заранее разобранными settings и streamSettings.
+
+    Индексы клиентов по email, tgId и UUID строятся один раз при создании снимка.
+    """
+
+    def __init__(self, raw, host='', hosts=None):
+        self.raw = raw
+        self.fetched_at = time.monotonic()
+        self.inbounds = raw.get('obj') or []
+
+        # Ключи - строковые ID inbound, как они приходят из форм и callback_data
+        self.by_id = {}
+        self.settings = {}
+        self.stream_settings = {}
+
+        # Один клиент может быть заведен на нескольких узлах: email -> [ClientRecord, ...]
+        self.clients_by_email = {}
+        self.email_by_tgid = {}
+        self.email_by_uuid = {}
+
+        for inbound in self.inbounds:
+            inbound_id = str(inbound['id'])
+            self.by_id[inbound_id] = inbound
+            self.settings[inbound_id] = parse_json_field(inbound.get('settings'))
+            self.stream_settings[inbound_id] = parse_json_field(inbound.get('streamSettings'))
+            self._index_inbound(inbound, self.settings[inbound_id])
+
+        # Шаблоны ссылок считаются один раз на снимок.
+        # В объединенном снимке нескольких узлов у каждого inbound свой адрес сервера
+        self.links = VlessLinkBuilder(self, host, hosts)
+        self._client_stats = None
+
+        # Узлы, не ответившие при сборке объединенного снимка: key -> ошибка
+        self.unavailable = {}
+
+    def _index_inbound(self, inbound, settings_json):
+        stats_by_email = {stats['email']: stats for stats in inbound.get('clientStats') or []}
+
+        in_settings = set()
+        for client in settings_json.get('clients', []):
+            email = client.get('email')
+            if not email:
+                continue
+            in_settings.add(email)
+            self.clients_by_email.setdefault(email, []).append(ClientRecord(inbound, client, stats_by_email.get(email)))
+            if client.get('tgId'):
+                self.email_by_tgid.setdefault(str(client['tgId']), email)
+            if client.get('id'):
+                self.email_by_uuid.setdefault(client['id'], email)
+
+        # Статистика клиентов, которых нет в settings этого inbound
+        for email, stats in stats_by_email.items():
+            if email not in in_settings:
+                self.clients_by_email.setdefault(email, []).append(ClientRecord(inbound, None, stats))
+
+    @property
+    def age(self):
+        return time.monotonic() - self.fetched_at
+
+    @property
+    def client_stats(self):
+        """ClientStatsView по всем inbound, строится при первом обращении"""
+        if self._client_stats is None:
+            self._client_stats = ClientStatsView(self.inbounds)
+        return self._client_stats
+
+    def get_inbound(self, inbound_id):
+        return self.by_id.get(str(inbound_id))
+
+    def find_client(self, email, inbound_id=None):
+        """Возвращает ClientRecord по email: из указанного inbound или первый найденный"""
+        for record in self.clients_by_email.get(email, ()):
+            if inbound_id is None or str(record.inbound['id']) == str(inbound_id):
+                return record
+        return None
+
+    def find_clients(self, email):
+        """Все записи клиента, по одной на каждый inbound (узел), где он заведен"""
+        return list(self.clients_by_email.get(email, ()))
+
+    def find_email_by_tgid(self, tgid):
+        return self.email_by_tgid.get(str(tgid))
+
+    def find_email_by_uuid(self, client_uuid):
+        return self.email_by_uuid.get(client_uuid)
+
+def get_panel_host(panel_url):
+    """Извлекает домен из URL панели - он же адрес сервера в ссылках подключения"""
+    domain_part = panel_url.split('://')[-1]
+    return domain_part.split('/')[0].split(':')[0]
+
+class VlessLinkTemplate:
+    """Предрассчитанные параметры ссылки vless:// для одного inbound"""
+
+    def __init__(self, inbound, stream_settings, host):
+        reality_settings = stream_settings.get('realitySettings', {})
+
+        self.host = host
+        self.port = inbound.get('port', '')
+        self.type = stream_settings.get('network', '')
+        self.security = stream_settings.get('security', '')
+
+        # publicKey может лежать как в realitySettings, так и в realitySettings.settings
+        self.pbk = reality_settings.get('publicKey', '')
+        if not self.pbk:
+            self.pbk = reality_settings.get('settings', {}).get('publicKey', '')
+
+        self.sni = (reality_settings.get('serverNames') or [''])[0]
+        self.sid = (reality_settings.get('shortIds') or [''])[0]
+        self.fp = 'chrome'
+        self.spx = '%2F'
+
+        # Параметры в определенном порядке, пустые пропускаем
+        params = []
+        if self.type:
+            params.append(f"type={self.type}")
+        if self.security:
+            params.append(f"security={self.security}")
+        if self.pbk:
+            params.append(f"pbk={self.pbk}")
+        params.append(f"fp={self.fp}")
+        if self.sni:
+            params.append(f"sni={self.sni}")
+        if self.sid:
+            params.append(f"sid={self.sid}")
+        params.append(f"spx={self.spx}")
+
+        self.query = '&'.join(params)
+
+    def render(self, client_id, email, flow=None):
+        flow_param = f"&flow={flow}" if flow else ''
+        return f"vless://{client_id}@{self.host}:{self.port}?{self.query}{flow_param}#vless2-{email}"
+
+class VlessLinkBuilder:
+    """Единая точка формирования ссылок подключения для клиентов снимка"""
+
+    def __init__(self, snapshot, host, hosts=None):
+        self.snapshot = snapshot
+        hosts = hosts or {}
+        self.templates = {
+            inbound_id: VlessLinkTemplate(inbound, snapshot.stream_settings[inbound_id],
+                                          hosts.get(inbound_id, host))
+            for inbound_id, inbound in snapshot.by_id.items()
+        }
+
+    def template(self, inbound_id):
+        return self.templates.get(str(inbound_id))
+
+    @staticmethod
+    def _render(template, client, email):
+        return template.render(client['id'], email, client.get('flow', 'xtls-rprx-vision'))
+
+    def client_link(self, email, inbound_id=None):
+        """Возвращает ссылку клиента или None, если клиент не найден"""
+        record = self.snapshot.find_client(email, inbound_id)
+        if not record or not record.settings or not record.settings.get('id'):
+            return None
+        return self._render(self.template(record.inbound['id']), record.settings, email)
+
+    def client_links(self, email):
+        """Ссылки клиента на всех узлах: список (адрес сервера, ссылка)"""
+        links = []
+        for record in self.snapshot.find_clients(email):
+            if record.settings and record.settings.get('id'):
+                template = self.template(record.inbound['id'])
+                links.append((template.host, self._render(template, record.settings, email)))
+        return links
+
+    def inbound_links(self, inbound_id):
+        """Возвращает ссылки всех клиентов inbound в виде {email: ссылка}"""
+        template = self.template(inbound_id)
+        if template is None:
+            return {}
+
+        links = {}
+        for client in self.snapshot.settings[str(inbound_id)].get('clients', []):
+            if client.get('email') and client.get('id'):
+                links[client['email']] = self._render(template, client, client['email'])
+        return links
+
+MS_PER_DAY = 24 * 60 * 60 * 1000
+BYTES_PER_GB = 1024 * 1024 * 1024
+
+class ClientStatsView:
+    """
+    Колоночное представление clientStats всех inbound снимка.
+
+    expiryTime, up, down, total и enable хранятся массивами NumPy, поэтому маски
+    «скоро истекает», «истекла» и «превышен лимит» считаются для всех клиентов
+    за один проход. Без NumPy те же маски считаются обычным циклом.
+    Используется для сводки администратора; напоминания планируются по expiry_timeline.
+    """
+
+    def __init__(self, inbounds):
+        self.records = [(inbound, client)
+                        for inbound in inbounds
+                        for client in inbound.get('clientStats') or []]
+
+        expiry = [int(client.get('expiryTime') or 0) for _, client in self.records]
+        up = [int(client.get('up') or 0) for _, client in self.records]
+        down = [int(client.get('down') or 0) for _, client in self.records]
+        total = [int(client.get('total') or 0) for _, client in self.records]
+        enable = [bool(client.get('enable', True)) for _, client in self.records]
+
+        if np is not None:
+            self.expiry = np.array(expiry, dtype=np.int64)
+            self.up = np.array(up, dtype=np.int64)
+            self.down = np.array(down, dtype=np.int64)
+            self.total = np.array(total, dtype=np.int64)
+            self.enable = np.array(enable, dtype=bool)
+        else:
+            self.expiry, self.up, self.down, self.total, self.enable = expiry, up, down, total, enable
+
+    def __len__(self):
+        return len(self.records)
+
+    def masks(self, now_ms, notify_days):
+        """
+        Считает маски для всех клиентов.
+
+        Args:
+            now_ms (float): Текущее время в мс
+            notify_days (int): За сколько дней до окончания уведомлять
+
+        Returns:
+            dict: Индексы в records для expiring (истекает в ближайшие notify_days),
+                expired, unlimited, over_quota и disabled
+        """
+        if np is not None:
+            limited = self.expiry > 0
+            left = self.expiry - now_ms
+            return {
+                'expiring': np.flatnonzero(limited & (left > 0) & (left < notify_days * MS_PER_DAY)).tolist(),
+                'expired': np.flatnonzero(limited & (left <= 0)).tolist(),
+                'unlimited': np.flatnonzero(~limited).tolist(),
+                'over_quota': np.flatnonzero((self.total > 0) & (self.up + self.down >= self.total)).tolist(),
+                'disabled': np.flatnonzero(~self.enable).tolist(),
+            }
+
+        masks = {'expiring': [], 'expired': [], 'unlimited': [], 'over_quota': [], 'disabled': []}
+        for index in range(len(self.records)):
+            expiry = self.expiry[index]
+            if expiry > 0:
+                left = expiry - now_ms
+                if left <= 0:
+                    masks['expired'].append(index)
+                elif left < notify_days * MS_PER_DAY:
+                    masks['expiring'].append(index)
+            else:
+                masks['unlimited'].append(index)
+            if self.total[index] > 0 and self.up[index] + self.down[index] >= self.total[index]:
+                masks['over_quota'].append(index)
+            if not self.enable[index]:
+                masks['disabled'].append(index)
+        return masks
+
+    def summary(self, now_ms, notify_days):
+        """Сводка по всем клиентам для панели администратора"""
+        masks = self.masks(now_ms, notify_days)
+        if np is not None:
+            traffic_up, traffic_down = int(self.up.sum()), int(self.down.sum())
+        else:
+            traffic_up, traffic_down = sum(self.up), sum(self.down)
+        return {
+            'clients': len(self.records),
+            'unlimited': len(masks['unlimited']),
+            'expiring': len(masks['expiring']),
+            'expired': len(masks['expired']),
+            'over_quota': len(masks['over_quota']),
+            'disabled': len(masks['disabled']),
+            'traffic_up_gb': round(traffic_up / BYTES_PER_GB, 2),
+            'traffic_down_gb': round(traffic_down / BYTES_PER_GB, 2),
+        }
+
+class InboundCache:
+    """
+    Кэш списка inbound с TTL.
+
+    Одновременные промахи объединяются: список с панели загружает только один поток,
+    остальные ждут его и получают тот же снимок или ту же ошибку. Ошибка запоминается
+    на INBOUND_FAILURE_BACKOFF секунд, чтобы недоступная панель не опрашивалась каждым запросом.
+    """
+
+    def __init__(self, panel, ttl=None):
+        self.panel = panel
+        self.ttl = INBOUND_CACHE_TTL if ttl is None else ttl
+
+        self._snapshot = None
+        self._failure = None  # (исключение, time.monotonic()) последней неудачной загрузки
+        self._pending = None  # Future загрузки, запущенной через get_async
+        self._generation = 0  # Увеличивается при каждой инвалидации
+        self._refresh_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.invalidations = 0
+
+    def _is_fresh(self, snapshot):
+        return snapshot is not None and snapshot.age < self.ttl
+
+    def _recent_failure(self):
+        failure = self._failure
+        if failure is not None and time.monotonic() - failure[1] < INBOUND_FAILURE_BACKOFF:
+            return failure[0]
+        return None
+
+    def _count(self, counter):
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _fetch(self):
+        response = self.panel.get(
+            '/panel/api/inbounds/list',
+            headers={'Accept': 'application/json'}
+        )
+        if response.status_code != 200:
+            raise PanelError(f'Ошибка получения данных inbound: {response.status_code}')
+
+        try:
+            data = response.json()
+        except ValueError as e:
+            raise PanelError(f'Ошибка парсинга ответа: {str(e)}, Ответ: {response.text}')
+
+        if not data.get('success'):
+            raise PanelError('Ошибка получения списка клиентов')
+
+        return InboundSnapshot(data, host=get_panel_host(self.panel.panel_url))
+
+    def get(self):
+        """Возвращает актуальный снимок, при необходимости загружая его с панели"""
+        snapshot = self._snapshot
+        if self._is_fresh(snapshot):
+            self._count('hits')
+            return snapshot
+        error = self._recent_failure()
+        if error is not None:
+            raise error
+
+        with self._refresh_lock:
+            # Пока ждали блокировку, другой поток мог обновить список или получить ошибку
+            snapshot = self._snapshot
+            if self._is_fresh(snapshot):
+                self._count('hits')
+                return snapshot
+            error = self._recent_failure()
+            if error is not None:
+                raise error
+
+            self._count('misses')
+            generation = self._generation
+            try:
+                snapshot = self._fetch()
+            except (PanelError, requests.exceptions.RequestException) as e:
+                self._count('failures')
+                if generation == self._generation:
+                    self._failure = (e, time.monotonic())
+                raise
+
+            # Если во время загрузки кэш сбросили, снимок мог устареть - не сохраняем его
+            if generation == self._generation:
+                self._snapshot = snapshot
+                self._failure = None
+            return snapshot
+
+    def get_async(self, executor):
+        """
+        Запускает get() в executor и возвращает Future.
+
+        Пока предыдущая загрузка не завершилась, возвращается ее Future: зависшая
+        панель занимает не больше одного потока executor.
+        """
+        with self._stats_lock:
+            if self._pending is None or self._pending.done():
+                self._pending = executor.submit(self.get)
+            return self._pending
+
+    def invalidate(self):
+        with self._stats_lock:
+            self._generation += 1
+            self._snapshot = None
+            self._failure = None
+            # Загрузка, начатая до сброса, может вернуть данные до изменения:
+            # get_async больше не отдает ее Future, а ее снимок не попадет в кэш
+            self._pending = None
+            self.invalidations += 1
+
+    def stats(self):
+        snapshot = self._snapshot
+        with self._stats_lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'failures': self.failures,
+                'invalidations': self.invalidations,
+                'ttl': self.ttl,
+                'age': round(snapshot.age, 3) if snapshot else None
+            }
+
+# Общий клиент панели и блокировка для его пересоздания
+panel_client = None
+panel_client_lock = threading.Lock()
+
+# Клиенты дополнительных панелей из таблицы panels: id -> PanelClient
+extra_panel_clients = {}
+
+# Узел 3x-ui: key - None для основной панели из settings, id строки panels для дополнительных
+PanelNode = namedtuple('PanelNode', ['key', 'name', 'client', 'timeout'])
+
+# Снимки узлов загружаются параллельно, медленный узел не задерживает остальные
+panel_executor = ThreadPoolExecutor(max_workers=PANEL_FANOUT_WORKERS, thread_name_prefix='panel')
+
+# Последний объединенный снимок и снимки узлов, из которых он собран
+merged_snapshot = None
+merged_sources = ()
+merged_snapshot_lock = threading.Lock()
+
+def qualify_inbound_id(panel_key, inbound_id):
+    """ID inbound, уникальный среди всех узлов: у основной панели он не меняется"""
+    if panel_key is None:
+        return str(inbound_id)
+    return f"{panel_key}-{inbound_id}"
+
+def split_inbound_id(inbound_id):
+    """Обратное к qualify_inbound_id: (key узла, ID inbound в его панели)"""
+    inbound_id = str(inbound_id)
+    if '-' in inbound_id:
+        panel_key, local_id = inbound_id.split('-', 1)
+        return int(panel_key), local_id
+    return None, inbound_id
+
+def get_panel_client():
+    """Возвращает общий клиент панели, пересоздавая его при изменении настроек"""
+    global panel_client
+
+    settings = get_settings()
+    if not settings:
+        return None
+
+    with panel_client_lock:
+        if (panel_client is None or
+                panel_client.panel_url != settings['panel_url'].rstrip('/') or
+                panel_client.username != settings['username'] or
+                panel_client.password != settings['password']):
+            if panel_client is not None:
+                panel_client.close()
+            panel_client = PanelClient(settings['panel_url'], settings['username'], settings['password'])
+        return panel_client
+
+def get_panel_nodes():
+    """Основная панель и включенные дополнительные, клиенты пересоздаются при смене настроек"""
+    nodes = []
+    primary = get_panel_client()
+    if primary is not None:
+        nodes.append(PanelNode(None, 'main', primary, PANEL_NODE_TIMEOUT))
+
+    rows = get_extra_panels()
+    with panel_client_lock:
+        for row in rows:
+            timeout = row['timeout'] or PANEL_NODE_TIMEOUT
+            client = extra_panel_clients.get(row['id'])
+            if (client is None or
+                    client.panel_url != row['panel_url'].rstrip('/') or
+                    client.username != row['username'] or
+                    client.password != row['password'] or
+                    client.timeout != timeout):
+                if client is not None:
+                    client.close()
+                client = PanelClient(row['panel_url'], row['username'], row['password'], timeout=timeout)
+                extra_panel_clients[row['id']] = client
+            nodes.append(PanelNode(row['id'], row['name'], client, timeout))
+
+        # Удаленные и выключенные панели
+        for panel_id in set(extra_panel_clients) - {row['id'] for row in rows}:
+            extra_panel_clients.pop(panel_id).close()
+
+    return nodes
+
+def get_panel_for_inbound(inbound_id):
+    """
+    Возвращает клиент панели, которой принадлежит inbound.
+
+    Returns:
+        tuple: (PanelClient, ID inbound в этой панели)
+    """
+    panel_key, local_id = split_inbound_id(inbound_id)
+    if panel_key is None:
+        panel = get_panel_client()
+    else:
+        panel = next((node.client for node in get_panel_nodes() if node.key == panel_key), None)
+    if panel is None:
+        raise PanelError(f'Панель для inbound {inbound_id} не найдена')
+    return panel, local_id
+
+def fetch_node_snapshots(nodes):
+    """
+    Загружает снимки узлов параллельно, каждый не дольше его timeout.
+
+    Returns:
+        tuple: (список (узел, снимок) в порядке nodes, {key узла: исключение})
+    """
+    started = time.monotonic()
+    futures = [(node, node.client.inbounds.get_async(panel_executor)) for node in nodes]
+
+    results = []
+    errors = {}
+    for node, future in futures:
+        try:
+            # Загрузка, не уложившаяся в срок, не прерывается: если она все же
+            # завершится, снимок (или ошибка) попадет в кэш узла, а до тех пор
+            # следующие вызовы ждут ее же, а не запускают новую
+            results.append((node, future.result(timeout=max(0, started + node.timeout - time.monotonic()))))
+        except FuturesTimeoutError:
+            errors[node.key] = PanelError(f'Панель {node.name} не ответила за {node.timeout} с')
+        except (PanelError, requests.exceptions.RequestException) as e:
+            errors[node.key] = e
+    return results, errors
+
+def merge_node_snapshots(results):
+    """Собирает снимки узлов в один InboundSnapshot с уникальными ID inbound"""
+    inbounds = []
+    hosts = {}
+    for node, snapshot in results:
+        host = get_panel_host(node.client.panel_url)
+        for inbound in snapshot.inbounds:
+            inbound = dict(inbound)
+            inbound['id'] = qualify_inbound_id(node.key, inbound['id'])
+            hosts[inbound['id']] = host
+            inbounds.append(inbound)
+    return InboundSnapshot({'success': True, 'obj': inbounds}, hosts=hosts)
+
+def get_inbound_snapshot():
+    """
+    Возвращает снимок inbound всех узлов.
+
+    С одной панелью это снимок из ее кэша. С несколькими узлы опрашиваются
+    параллельно, недоступные пропускаются и перечислены в snapshot.unavailable.
+    Объединенный снимок пересобирается, только когда изменился снимок какого-то узла.
+    """
+    global merged_snapshot, merged_sources
+
+    nodes = get_panel_nodes()
+    if not nodes:
+        raise PanelError('Настройки панели не найдены')
+    if len(nodes) == 1 and nodes[0].key is None:
+        return nodes[0].client.inbounds.get()
+
+    results, errors = fetch_node_snapshots(nodes)
+    if not results:
+        raise next(iter(errors.values()))
+    for key, error in errors.items():
+        print(f"Panel node {key or 'main'} unavailable: {str(error)}")
+
+    sources = tuple((node.key, snapshot) for node, snapshot in results)
+    with merged_snapshot_lock:
+        if (len(sources) != len(merged_sources) or
+                any(key != old_key or snapshot is not old_snapshot
+                    for (key, snapshot), (old_key, old_snapshot) in zip(sources, merged_sources))):
+            merged_snapshot = merge_node_snapshots(results)
+            merged_sources = sources
+        snapshot = merged_snapshot
+
+    if errors:
+        # Снимок общий для всех потоков, поэтому недоступные узлы отмечаем на копии
+        snapshot = copy.copy(snapshot)
+        snapshot.unavailable = {key: str(error) for key, error in errors.items()}
+    return snapshot
+
+def invalidate_inbound_snapshot(inbound_id=None):
+    """Сбрасывает кэш inbound после изменения клиентов в панели: одного узла или всех"""
+    with panel_client_lock:
+        panels = [panel_client] + list(extra_panel_clients.values())
+    if inbound_id is not None:
+        panel_key, _ = split_inbound_id(inbound_id)
+        panels = [panel_client] if panel_key is None else [extra_panel_clients.get(panel_key)]
+    for panel in panels:
+        if panel is not None:
+            panel.inbounds.invalidate()
+
+class TokenBucket:
+    """
+    Ограничитель частоты: rate токенов в секунду, не больше capacity подряд.
+
+    Не потокобезопасен: общий лимит TelegramSender используется под его блокировкой.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now=None):
+        """Резервирует токен и возвращает, сколько секунд ждать до его появления"""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def pause(self, seconds):
+        """Не выдавать токены ближайшие seconds секунд"""
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+class SharedTokenBucket(TokenBucket):
+    """
+    TokenBucket, общий для всех процессов: состояние хранится в telegram_rate_limit.
+
+    Лимит Telegram действует на бота, а не на процесс, поэтому несколько рабочих
+    процессов делят одни токены. Время берется из time.time(): time.monotonic()
+    у каждого процесса свое.
+    """
+
+    def _update(self, apply):
+        db = get_db()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute('SELECT tokens, updated_at FROM telegram_rate_limit WHERE id = 1').fetchone()
+            if row:
+                self.tokens, self.updated = row['tokens'], row['updated_at']
+            else:
+                self.tokens, self.updated = self.capacity, time.time()
+            result = apply(time.time())
+            db.execute('''INSERT INTO telegram_rate_limit (id, tokens, updated_at) VALUES (1, ?, ?)
+                         ON CONFLICT (id) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at''',
+                      [self.tokens, self.updated])
+            db.commit()
+            return result
+        finally:
+            db.close()
+
+    def reserve(self, now=None):
+        return self._update(lambda now: TokenBucket.reserve(self, now))
+
+    def pause(self, seconds):
+        def hold(now):
+            self._refill(now)
+            self.tokens = min(self.tokens, 1 - seconds * self.rate)
+        self._update(hold)
+
+# method - метод бота (send_message, send_photo), args - его аргументы после chat_id
+OutgoingMessage = namedtuple('OutgoingMessage', ['chat_id', 'method', 'args', 'kwargs', 'future', 'submitted_at'])
+# Отметка о завершении отправки в чат, которую поток доставки передает диспетчеру
+DeliveryDone = namedtuple('DeliveryDone', ['chat_id'])
+
+class TelegramSender:
+    """
+    Общий отправитель сообщений Telegram.
+
+    Все исходящие сообщения идут через один экземпляр бота. Поток-диспетчер
+    соблюдает лимиты Telegram, общий на бота (один на все процессы, SharedTokenBucket)
+    и отдельный на каждый чат, и передает
+    сообщения в пул из concurrency потоков, поэтому медленный ответ Telegram
+    не задерживает остальные чаты. В один чат одновременно отправляется не больше
+    одного сообщения, и они уходят в порядке постановки. Ответ 429 приостанавливает
+    всю отправку на retry_after, затем сообщение повторяется.
+    Очередь ограничена: при переполнении send() ждет место и затем падает с ошибкой.
+    """
+
+    def __init__(self, queue_size=TELEGRAM_SEND_QUEUE_SIZE,
+                 global_rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE,
+                 concurrency=TELEGRAM_SEND_CONCURRENCY):
+        self.queue_size = queue_size
+        self.concurrency = concurrency
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='telegram-send')
+        self.in_flight = set()  # чаты, в которые сейчас идет отправка
+        self.held = {}  # chat_id -> deque сообщений, ждущих окончания предыдущей отправки в этот чат
+        self.queue = queue.Queue()
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.global_bucket = SharedTokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_buckets = {}
+        self.scheduled = []  # куча (время отправки, порядковый номер, сообщение)
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.bot = None
+        self.token = None
+
+        self.pending = 0
+        self.sent = 0
+        self.failed = 0
+        self.throttled = 0
+        self.rejected = 0
+        self.latencies = deque(maxlen=1000)
+
+    def get_bot(self):
+        """Возвращает общий экземпляр бота, пересоздавая его при смене токена"""
+        settings = get_telegram_settings()
+        if not settings or not settings['bot_token']:
+            raise Exception('Telegram бот не настроен')
+
+        with self.lock:
+            if self.bot is None or self.token != settings['bot_token']:
+                # threaded=False: обработчики команд запускает telegram_dispatcher
+                self.bot = telebot.TeleBot(settings['bot_token'], threaded=False)
+                self.token = settings['bot_token']
+            return self.bot
+
+    def send(self, chat_id, text, **kwargs):
+        """
+        Ставит сообщение в очередь отправки.
+
+        Returns:
+            Future: Результат send_message или исключение отправки
+        """
+        return self.submit(chat_id, 'send_message', text, **kwargs)
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        """Ставит в очередь отправку картинки (file_id или открытый файл)"""
+        return self.submit(chat_id, 'send_photo', photo, **kwargs)
+
+    def submit(self, chat_id, method, *args, **kwargs):
+        """Ставит в очередь вызов метода бота для чата chat_id"""
+        if not self.slots.acquire(timeout=TELEGRAM_SEND_QUEUE_TIMEOUT):
+            with self.lock:
+                self.rejected += 1
+            raise Exception('Очередь отправки Telegram переполнена')
+
+        future = Future()
+        with self.lock:
+            self.pending += 1
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='telegram-sender', daemon=True)
+                self.thread.start()
+        self.queue.put(OutgoingMessage(str(chat_id), method, args, kwargs, future, time.monotonic()))
+        return future
+
+    def send_and_wait(self, chat_id, text, timeout=TELEGRAM_SEND_TIMEOUT, **kwargs):
+        """Отправляет сообщение через очередь и ждет результата"""
+        return self.send(chat_id, text, **kwargs).result(timeout)
+
+    def _accept(self, item):
+        if isinstance(item, DeliveryDone):
+            self.in_flight.discard(item.chat_id)
+            held = self.held.get(item.chat_id)
+            if held:
+                message = held.popleft()
+                if not held:
+                    del self.held[item.chat_id]
+                self._dispatch(message)
+        else:
+            self._schedule(item)
+
+    def _schedule(self, message):
+        now = time.monotonic()
+        bucket = self.chat_buckets.get(message.chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[message.chat_id] = TokenBucket(self.chat_rate, 1)
+        ready_at = now + bucket.reserve(now)
+        heapq.heappush(self.scheduled, (ready_at, next(self.sequence), message))
+
+    def _dispatch(self, message):
+        with self.lock:
+            delay = self.global_bucket.reserve()
+        time.sleep(delay)
+        self.in_flight.add(message.chat_id)
+        self.executor.submit(self._deliver, message)
+
+    def _run(self):
+        while True:
+            try:
+                # Пока все потоки доставки заняты, ждем DeliveryDone из очереди
+                if self.scheduled and len(self.in_flight) < self.concurrency:
+                    timeout = max(self.scheduled[0][0] - time.monotonic(), 0)
+                else:
+                    timeout = 1
+                try:
+                    self._accept(self.queue.get(timeout=timeout))
+                    while True:
+                        self._accept(self.queue.get_nowait())
+                except queue.Empty:
+                    pass
+
+                while (self.scheduled and self.scheduled[0][0] <= time.monotonic() and
+                       len(self.in_flight) < self.concurrency):
+                    _, _, message = heapq.heappop(self.scheduled)
+                    if message.chat_id in self.in_flight or message.chat_id in self.held:
+                        # Предыдущее сообщение в этот чат еще отправляется
+                        self.held.setdefault(message.chat_id, deque()).append(message)
+                    else:
+                        self._dispatch(message)
+
+                # Лимиты давно молчащих чатов уже восстановились, хранить их незачем
+                if len(self.chat_buckets) > 1000:
+                    idle_since = time.monotonic() - 60
+                    self.chat_buckets = {chat_id: bucket for chat_id, bucket in self.chat_buckets.items()
+                                         if bucket.updated > idle_since}
+            except Exception as e:
+                print(f"Error in Telegram sender: {str(e)}")
+                time.sleep(1)
+
+    def _deliver(self, message):
+        """Отправка в потоке пула; чат остается занятым до конца, включая повторы"""
+        retries = 0
+        try:
+            while True:
+                try:
+                    result = getattr(self.get_bot(), message.method)(message.chat_id, *message.args, **message.kwargs)
+                except ApiTelegramException as e:
+                    if e.error_code == 429 and retries < TELEGRAM_SEND_MAX_RETRIES:
+                        # Пока действует retry_after, не отправляем ничего ни в какой чат
+                        retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                        print(f"Telegram rate limit hit, retry in {retry_after}s")
+                        with self.lock:
+                            self.throttled += 1
+                            self.global_bucket.pause(retry_after)
+                            delay = self.global_bucket.reserve()
+                        retries += 1
+                        # Файл картинки дочитан предыдущей попыткой
+                        for arg in message.args:
+                            if hasattr(arg, 'seek'):
+                                arg.seek(0)
+                        time.sleep(delay)
+                        continue
+                    self._finish(message, error=e)
+                except Exception as e:
+                    self._finish(message, error=e)
+                else:
+                    self._finish(message, result=result)
+                return
+        finally:
+            self.queue.put(DeliveryDone(message.chat_id))
+
+    def _finish(self, message, result=None, error=None):
+        with self.lock:
+            self.pending -= 1
+            self.latencies.append(time.monotonic() - message.submitted_at)
+            if error is None:
+                self.sent += 1
+            else:
+                self.failed += 1
+        self.slots.release()
+
+        if error is None:
+            message.future.set_result(result)
+        else:
+            print(f"Error sending Telegram message to {message.chat_id}: {str(error)}")
+            message.future.set_exception(error)
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            return {
+                'queued': self.pending,
+                'capacity': self.queue_size,
+                'in_flight': len(self.in_flight),
+                'sent': self.sent,
+                'failed': self.failed,
+                'throttled': self.throttled,
+                'rejected': self.rejected,
+                'latency_avg_ms': round(sum(latencies) / len(latencies) * 1000, 1) if latencies else None,
+                'latency_p95_ms': round(latencies[int(len(latencies) * 0.95)] * 1000, 1) if latencies else None,
+                'latency_max_ms': round(latencies[-1] * 1000, 1) if latencies else None,
+            }
+
+# Общий отправитель сообщений Telegram
+telegram_sender = TelegramSender()
+
+# Добавим декоратор для проверки авторизации
+def login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user_id' not in session:
+            return redirect(url_for('login'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+@app.route('/login', methods=['GET', 'POST'])
+def login():
+    if request.method == 'POST':
+        username = request.form['username']
+        password = request.form['password']
+        
+        db = get_db()
+        user = db.execute(SQL_USER_BY_LOGIN, [username, password]).fetchone()
+        db.close()
+        
+        if user:
+            session['user_id'] = user['id']
+            session['username'] = user['username']
+            return redirect(url_for('index'))
+        
+        if not db_has_users():
+            return render_template('login.html', error=NO_USERS_MESSAGE)
+        return render_template('login.html', error='Неверный логин или пароль')
+    
+    # Учетной записи по умолчанию нет: без ADMIN_PASSWORD войти нельзя, объясняем почему
+    if not db_has_users():
+        return render_template('login.html', error=NO_USERS_MESSAGE)
+    return render_template('login.html')
+
+def db_has_users():
+    db = get_db()
+    try:
+        return db.execute('SELECT 1 FROM users LIMIT 1').fetchone() is not None
+    finally:
+        db.close()
+
+@app.route('/logout')
+def logout():
+    session.clear()
+    return redirect(url_for('login'))
+
+@app.route('/change_password', methods=['GET', 'POST'])
+@login_required
+def change_password():
+    if request.method == 'POST':
+        current_password = request.form['current_password']
+        new_username = request.form['new_username']
+        new_password = request.form['new_password']
+        confirm_password = request.form['confirm_password']
+        
+        if new_password != confirm_password:
+            return render_template('change_password.html', 
+                                 error='Пароли не совпадают')
+        
+        db = get_db()
+        # Проверяем текущий пароль
+        user = db.execute('SELECT * FROM users WHERE id = ? AND password = ?',
+                         [session['user_id'], current_password]).fetchone()
+        
+        if not user:
+            return render_template('change_password.html', 
+                                 error='Неверный теущий пароль')
+        
+        # Проверяем, не занят ли новый логин другим пользователем
+        if new_username != user['username']:
+            existing_user = db.execute('SELECT * FROM users WHERE username = ? AND id != ?',
+                                     [new_username, session['user_id']]).fetchone()
+            if existing_user:
+                return render_template('change_password.html', 
+                                     error='Этот логин уже занят')
+        
+        try:
+            # Обновляем учетные данные существующего пользователя
+            db.execute('UPDATE users SET username = ?, password = ? WHERE id = ?',
+                      [new_username, new_password, session['user_id']])
+            db.commit()
+            
+            # Обновляем данные сессии
+            session['username'] = new_username
+            
+            return render_template('change_password.html', 
+                                 success='Учетные данные успешно обновлены')
+        except Exception as e:
+            db.rollback()
+            return render_template('change_password.html', 
+                                 error=f'Ошибка при обновлении данных: {str(e)}')
+        finally:
+            db.close()
+    
+    return render_template('change_password.html')
+
+# авляем декоратор @login_required ко всем существующим маршрутам
+@app.route('/')
+@login_required
+def index():
+    return redirect(url_for('clients'))
+
+@app.route('/clients')
 @login_required
 def clients():
     settings = get_settings()
@@ -242,22 +2030,9 @@ def clients():
         return redirect(url_for('settings'))
     
     try:
-        session = requests.Session()
-        login_response = session.post(
-            f"{settings['panel_url']}/login",
-            data={'username': settings['username'], 'password': settings['password']}
-        )
-        
-        if login_response.status_code != 200:
-            flash('Ошибка авторизации')
-            return redirect(url_for('settings'))
-        
-        clients_response = session.get(f"{settings['panel_url']}/panel/api/inbounds/list")
-        clients_data = clients_response.json()
-        
-        if not clients_data['success']:
-            flash('Ошибка получения списка клиентов')
-            return redirect(url_for('settings'))
+        snapshot = get_inbound_snapshot()
+        for error in snapshot.unavailable.values():
+            flash(f'Узел недоступен, его клиенты не показаны: {error}')
 
         # Получаем все локальные данные клиентов
         db = get_db()
@@ -266,28 +2041,79 @@ def clients():
             local_clients[row['email']] = row['tgid']  # Исправлено: добавлена закрывающая скобка и правильный ��интаксис присваивания
         db.close()
 
-        # Объединяем данные и добавляем UUID клиентов
-        for inbound in clients_data['obj']:
+        # Объединяем данные и добавляем UUID клиентов.
+        # Снимок общий для всех потоков, поэтому дополняем копии записей, а не сами записи
+        inbounds = []
+        for inbound in snapshot.inbounds:
+            inbound = dict(inbound)
             if 'settings' in inbound:
                 try:
-                    settings_json = json.loads(inbound['settings'])
-                    clients_map = {client['email']: client['id'] for client in settings_json.get('clients', [])}
-                    
                     # Добавляем UUID и tgid к данным клиентов
+                    client_stats = []
                     for client in inbound['clientStats']:
+                        client = dict(client)
+                        record = snapshot.find_client(client['email'], inbound['id'])
                         client['tgid'] = local_clients.get(client['email'])
-                        client['uuid'] = clients_map.get(client['email'])
-                except (json.JSONDecodeError, KeyError):
-                    continue
+                        client['uuid'] = record.settings.get('id') if record and record.settings else None
+                        client_stats.append(client)
+                    inbound['clientStats'] = client_stats
+                except KeyError:
+                    pass
+            inbounds.append(inbound)
         
         return render_template('clients.html', 
-                             clients=clients_data['obj'],
+                             clients=inbounds,
                              now=datetime.now().timestamp())
-        
+
+    except PanelAuthError:
+        flash('Ошибка авторизации')
+        return redirect(url_for('settings'))
+    except PanelError as e:
+        flash(str(e))
+        return redirect(url_for('settings'))
     except requests.exceptions.RequestException as e:
         flash(f'Ошибка подключения к панели: {str(e)}')
         return redirect(url_for('settings'))
 
+@app.route('/clients/cache_stats')
+@login_required
+def inbound_cache_stats():
+    """Счетчики кэша inbound для подбора INBOUND_CACHE_TTL"""
+    nodes = get_panel_nodes()
+    if not nodes:
+        return jsonify({'success': False, 'error': 'Настройки панели не найдены'})
+    return jsonify({
+        'success': True,
+        'stats': nodes[0].client.inbounds.stats(),
+        'nodes': [{'id': node.key, 'name': node.name, 'stats': node.client.inbounds.stats()} for node in nodes]
+    })
+
+@app.route('/telegram/sender_stats')
+@login_required
+def telegram_sender_stats():
+    """Глубина очереди и задержки отправки сообщений Telegram"""
+    return jsonify({'success': True, 'stats': telegram_sender.stats()})
+
+@app.route('/telegram/update_stats')
+@login_required
+def telegram_update_stats():
+    """Обновления Telegram в очереди и в обработке, время обработки"""
+    return jsonify({'success': True, 'stats': telegram_dispatcher.stats()})
+
+@app.route('/clients/summary')
+@login_required
+def clients_summary():
+    """Сводка по клиентам: истекающие, истекшие, превысившие лимит трафика"""
+    try:
+        snapshot = get_inbound_snapshot()
+    except (PanelError, requests.exceptions.RequestException) as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+    settings = get_telegram_settings()
+    notify_days = int(settings['notify_days']) if settings and settings['notify_days'] else 3
+    summary = snapshot.client_stats.summary(datetime.now().timestamp() * 1000, notify_days)
+    return jsonify({'success': True, 'summary': summary})
+
 @app.route('/telegram/settings', methods=['GET', 'POST'])
 @login_required
 def telegram_settings():
@@ -301,46 +2127,27 @@ def telegram_settings():
             # Начинаем транзакцию
             db.execute('BEGIN IMMEDIATE')
             
-            # Проверяем и добавляем новые колонки если их нет
-            try:
-                db.execute('SELECT notify_days FROM telegram_settings LIMIT 1')
-            except sqlite3.OperationalError:
-                db.execute('ALTER TABLE telegram_settings ADD COLUMN notify_days INTEGER DEFAULT 3')
-                
-            try:
-                db.execute('SELECT create_payment FROM telegram_settings LIMIT 1')
-            except sqlite3.OperationalError:
-                db.execute('ALTER TABLE telegram_settings ADD COLUMN create_payment BOOLEAN DEFAULT 0')
-                
-            try:
-                db.execute('SELECT payment_amount FROM telegram_settings LIMIT 1')
-            except sqlite3.OperationalError:
-                db.execute('ALTER TABLE telegram_settings ADD COLUMN payment_amount DECIMAL(10,2)')
-                
-            try:
-                db.execute('SELECT notification_template FROM telegram_settings LIMIT 1')
-            except sqlite3.OperationalError:
-                db.execute('ALTER TABLE telegram_settings ADD COLUMN notification_template TEXT')
-                
-            try:
-                db.execute('SELECT check_interval FROM telegram_settings LIMIT 1')
-            except sqlite3.OperationalError:
-                db.execute('ALTER TABLE telegram_settings ADD COLUMN check_interval INTEGER DEFAULT 60')
-                
-            try:
-                db.execute('SELECT interval_unit FROM telegram_settings LIMIT 1')
-            except sqlite3.OperationalError:
-                db.execute('ALTER TABLE telegram_settings ADD COLUMN interval_unit TEXT DEFAULT "minutes"')
-            
             if form_type == 'bot_settings':
                 bot_token = request.form['bot_token']
                 admin_chat_id = request.form['admin_chat_id']
                 is_enabled = 1 if 'is_enabled' in request.form else 0
+                update_mode = request.form.get('update_mode', 'polling')
+                webhook_url = request.form.get('webhook_url', '').strip()
+                
+                if update_mode not in ('polling', 'webhook'):
+                    raise Exception('Неизвестный режим получения обновлений')
+                if update_mode == 'webhook' and not webhook_url.startswith('https://'):
+                    raise Exception('Для webhook нужен адрес https://')
+                
+                # Секрет webhook сохраняется между изменениями настроек
+                previous = get_telegram_settings()
+                webhook_secret = (previous['webhook_secret'] if previous and previous['webhook_secret']
+                                  else secrets.token_urlsafe(32))
                 
                 db.execute('''INSERT INTO telegram_settings 
-                             (bot_token, admin_chat_id, is_enabled) 
-                             VALUES (?, ?, ?)''',
-                          [bot_token, admin_chat_id, is_enabled])
+                             (bot_token, admin_chat_id, is_enabled, update_mode, webhook_url, webhook_secret) 
+                             VALUES (?, ?, ?, ?, ?, ?)''',
+                          [bot_token, admin_chat_id, is_enabled, update_mode, webhook_url, webhook_secret])
                 
                 flash('Настройки Telegram бота успешно сохранены')
                 
@@ -367,10 +2174,12 @@ def telegram_settings():
                 flash('Настройки уведомлений успешно сохранены')
             
             # Фиксируем изменения
+            bump_settings_version(db)
             db.commit()
+            settings_cache.invalidate()
             
-            # Перезапускаем планировщик с новым интервалом
-            restart_scheduler()
+            # Планировщик и бот перезапустит процесс-лидер, заметив новую версию настроек
+            leader_elector.notify_settings_changed()
             
         except sqlite3.OperationalError as e:
             if "database is locked" in str(e):
@@ -388,9 +2197,7 @@ def telegram_settings():
     
     # Получаем текущие настройки
     try:
-        db = get_db()
-        settings = db.execute('SELECT * FROM telegram_settings ORDER BY id DESC LIMIT 1').fetchone()
-        db.close()
+        settings = get_telegram_settings()
     except Exception as e:
         flash(f'Ошибка при поучении настроек: {str(e)}', 'error')
         settings = None
@@ -405,12 +2212,11 @@ def test_telegram():
         return jsonify({'success': False, 'error': 'Настойки бота не найдены'})
     
     try:
-        bot = telebot.TeleBot(settings['bot_token'])
         if not settings['admin_chat_id']:
             return jsonify({'success': False, 'error': 'ID администратора не указан'})
             
         message = "🟢 Тестовое сообщение\nБот успешно настроен и работает!"
-        bot.send_message(settings['admin_chat_id'], message)
+        telegram_sender.send_and_wait(settings['admin_chat_id'], message)
         return jsonify({'success': True})
         
     except ApiException as e:
@@ -427,13 +2233,20 @@ def yoomoney_settings():
         redirect_url = request.form['redirect_url']
         is_enabled = 1 if 'is_enabled' in request.form else 0
         
+        # Секрет уведомлений не показывается в форме: пустое поле оставляет прежний
+        current = get_yoomoney_settings()
+        notification_secret = (request.form.get('notification_secret', '').strip() or
+                               (current['notification_secret'] if current else None))
+        
         db = get_db()
         db.execute('''INSERT INTO yoomoney_settings 
-                     (wallet_id, secret_key, redirect_url, is_enabled) 
-                     VALUES (?, ?, ?, ?)''',
-                  [wallet_id, secret_key, redirect_url, is_enabled])
+                     (wallet_id, secret_key, redirect_url, is_enabled, notification_secret) 
+                     VALUES (?, ?, ?, ?, ?)''',
+                  [wallet_id, secret_key, redirect_url, is_enabled, notification_secret])
+        bump_settings_version(db)
         db.commit()
         db.close()
+        settings_cache.invalidate()
         
         flash('Настройки YooMoney успешно сохранены')
         return redirect(url_for('yoomoney_settings'))
@@ -466,7 +2279,6 @@ def test_yoomoney():
 @login_required
 def send_stats():
     settings = get_telegram_settings()
-    panel_settings = get_settings()
     if not settings or not settings['is_enabled']:
         return jsonify({'success': False, 'error': 'Telegram бот не нстроен или тключен'})
     
@@ -514,91 +2326,25 @@ def send_stats():
             message += " Срок действия: бессрочно\n\n"
 
         # Полчаем ссылку для подклюения
-        session = requests.Session()
-        
-        # Логин
-        login_response = session.post(
-            f"{panel_settings['panel_url']}/login",
-            data={'username': panel_settings['username'], 'password': panel_settings['password']}
-        )
-        
-        if login_response.status_code != 200:
+        try:
+            snapshot = get_inbound_snapshot()
+        except PanelAuthError:
             return jsonify({'success': False, 'error': 'Ошибка авторизации'})
-        
-        # Получаем данные inbound
-        inbounds_response = session.get(f"{panel_settings['panel_url']}/panel/api/inbounds/list")
-        inbounds_data = inbounds_response.json()
-        
-        if not inbounds_data['success']:
+        except PanelError:
             return jsonify({'success': False, 'error': 'Ошибка получения данных'})
         
         # Формируем ссылку для подключения
-        for inbound in inbounds_data['obj']:
-            if str(inbound['id']) == str(inbound_id):
-                settings_json = json.loads(inbound['settings'])
-                stream_settings = json.loads(inbound['streamSettings'])
-                
-                # Ищем клиента по email
-                client_id = None
-                client_flow = None
-                for client in settings_json.get('clients', []):
-                    if client['email'] == email:
-                        client_id = client['id']
-                        client_flow = client.get('flow', 'xtls-rprx-vision')
-                        break
-                
-                if client_id:
-                    # Извлеаем домен из URL панели
-                    panel_url = panel_settings['panel_url']
-                    domain_part = panel_url.split('://')[-1]
-                    domain = domain_part.split('/')[0].split(':')[0]
-                    
-                    # Получаем параметы для ссыл
-                    tcp = stream_settings.get('network', '')
-                    reality = stream_settings.get('security', '')
-                    
-                    # раьно получни publicKey
-                    pbk = None
-                    if 'realitySettings' in stream_settings:
-                        pbk = stream_settings['realitySettings'].get('publicKey')
-                    if not pbk and 'settings' in stream_settings.get('realitySettings', {}):
-                        pbk = stream_settings['realitySettings']['settings'].get('publicKey')
-                    
-                    # Добавляем отладочный вывод
-                    print("Stream Settings:", json.dumps(stream_settings, indent=2))
-                    print("Public Key:", pbk)
-                    
-                    reality_settings = stream_settings.get('realitySettings', {})
-                    sid = reality_settings.get('shortIds', [''])[0]
-                    server_name = reality_settings.get('serverNames', [''])[0]
-                    port = inbound.get('port', '')
-                    
-                    # ормруем ссылку только если сть все необходимые параметры
-                    if not pbk:
-                        return jsonify({'success': False, 'error': 'Не уась получить publicKey'})
-                    
-                    # Формируем ссылку
-                    params = [
-                        f"type={tcp}",
-                        f"security={reality}",
-                        f"pbk={pbk}",  # Теперь pbk очно не будет пустым
-                        "fp=chrome",
-                        f"sni={server_name}",
-                        f"sid={sid}",
-                        "spx=%2F"
-                    ]
-                    
-                    if client_flow:
-                        params.append(f"flow={client_flow}")
-                    
-                    link = f"vless://{client_id}@{domain}:{port}?{'&'.join(params)}#vless2-{email}"
-                    
-                    # Добавляем ссылку в сообщение, оборачивая её в теги code
-                    message += f"🔗 Ссылка для подключения:\n<code>{link}</code>"
-        
+        link = snapshot.links.client_link(email, inbound_id)
+        if link:
+            # ормруем ссылку только если сть все необходимые параметры
+            if not snapshot.links.template(inbound_id).pbk:
+                return jsonify({'success': False, 'error': 'Не уась получить publicKey'})
+            
+            # Добавляем ссылку в сообщение, оборачивая её в теги code
+            message += f"🔗 Ссылка для подключения:\n<code>{link}</code>"
+    
         # Отправляем сообщение с поддержкой HTML
-        bot = telebot.TeleBot(settings['bot_token'])
-        bot.send_message(tgid, message, parse_mode='HTML')
+        telegram_sender.send_and_wait(tgid, message, parse_mode='HTML')
         
         return jsonify({'success': True})
         
@@ -617,25 +2363,23 @@ def add_client():
         if not data:
             return jsonify({'success': False, 'error': 'Данные не получены'})
 
-        session = requests.Session()
-        
-        # Логин
-        login_response = session.post(
-            f"{settings['panel_url']}/login",
-            data={'username': settings['username'], 'password': settings['password']}
-        )
-        
-        if login_response.status_code != 200:
-            return jsonify({'success': False, 'error': 'Ошибка авторизации'})
-        
         # Добавление клиента
         headers = {'Content-Type': 'application/json'}
-        
-        add_response = session.post(
-            f"{settings['panel_url']}/panel/api/inbounds/addClient",
-            json=data,  # Отправляем анные как есть
-            headers=headers
-        )
+
+        # Клиент добавляется в панель узла, которому принадлежит inbound
+        inbound_id = data.get('id', '')
+        panel, local_id = get_panel_for_inbound(inbound_id)
+        if 'id' in data:
+            data = dict(data, id=int(local_id))
+
+        try:
+            add_response = panel.post(
+                '/panel/api/inbounds/addClient',
+                json=data,  # Отправляем анные как есть
+                headers=headers
+            )
+        except PanelAuthError:
+            return jsonify({'success': False, 'error': 'Ошибка авторизации'})
         
         if add_response.status_code != 200:
             return jsonify({'success': False, 'error': f'Ошибка сервера: {add_response.status_code}'})
@@ -647,6 +2391,9 @@ def add_client():
             
         if not response_data.get('success', False):
             return jsonify({'success': False, 'error': response_data.get('msg', 'Неизестная ошибка')})
+
+        # Список клиентов в панели изменился
+        invalidate_inbound_snapshot(inbound_id)
         
         # Сохраняем Telegram ID в локальной базе если он указан
         client_settings = json.loads(data['settings'])
@@ -698,21 +2445,14 @@ def delete_client():
         client_uuid = data['uuid']  # Теперь ожидам UUID вместо email
         email = data['email']  # Email нужен только для удалени из локальной БД
         
-        session = requests.Session()
-        
-        # Логин
-        login_response = session.post(
-            f"{settings['panel_url']}/login",
-            data={'username': settings['username'], 'password': settings['password']}
-        )
-        
-        if login_response.status_code != 200:
-            return jsonify({'success': False, 'error': 'Ошибка авторизации'})
-        
         # Удаление клиента используя правиьный URL с UUID
-        delete_response = session.post(
-            f"{settings['panel_url']}/panel/api/inbounds/{inbound_id}/delClient/{client_uuid}"
-        )
+        panel, local_id = get_panel_for_inbound(inbound_id)
+        try:
+            delete_response = panel.post(
+                f"/panel/api/inbounds/{local_id}/delClient/{client_uuid}"
+            )
+        except PanelAuthError:
+            return jsonify({'success': False, 'error': 'Ошибка авторизации'})
         
         if delete_response.status_code != 200:
             return jsonify({'success': False, 'error': f'Ошибка сервера: {delete_response.status_code}'})
@@ -724,244 +2464,543 @@ def delete_client():
             
         if not response_data.get('success', False):
             return jsonify({'success': False, 'error': response_data.get('msg', 'Неизвестная ошибка')})
+
+        # Список клиентов в панели изменился
+        invalidate_inbound_snapshot(inbound_id)
         
         # Удаляем локальные анные
         db = get_db()
         db.execute('DELETE FROM client_data WHERE email = ?', [email])
+        version = bump_stat_cache_version(db)
         db.commit()
         db.close()
+        stat_cache.invalidate(emails=[email], version=version)
         
         return jsonify({'success': True})
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
-@app.route('/clients/get_link', methods=['POST'])
+@app.route('/clients/get_link', methods=['POST'])
+@login_required
+def get_client_link():
+    settings = get_settings()
+    if not settings:
+        return jsonify({'success': False, 'error': 'Настройки панели не найдены'})
+    
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({'success': False, 'error': 'Данные не получены'})
+
+        inbound_id = data['inbound_id']
+        email = data['email']
+        
+        # Получаем данные inbound
+        try:
+            snapshot = get_inbound_snapshot()
+        except PanelAuthError:
+            return jsonify({'success': False, 'error': 'Ошибка авторизации'})
+        except PanelError:
+            return jsonify({'success': False, 'error': 'Ошибка получения данных'})
+        
+        # Ищем клиента по email в нужном inbound
+        link = snapshot.links.client_link(email, inbound_id)
+        if link:
+            return jsonify({'success': True, 'link': link})
+    
+        return jsonify({'success': False, 'error': 'Клиент не найде'})
+        
+    except Exception as e:
+        print("Error:", str(e))  # Добавлем вывод ошибки
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/clients/export_links', methods=['POST'])
 @login_required
-def get_client_link():
-    settings = get_settings()
-    if not settings:
-        return jsonify({'success': False, 'error': 'Настройки панели не найдены'})
-    
+def export_client_links():
+    """Ссылки подключения всех клиентов inbound для выгрузки"""
     try:
         data = request.get_json()
         if not data:
             return jsonify({'success': False, 'error': 'Данные не получены'})
 
         inbound_id = data['inbound_id']
-        email = data['email']
-        
-        # Извлекаем доен  порт из URL панели
-        panel_url = settings['panel_url']
-        domain_part = panel_url.split('://')[-1]
-        domain_port = domain_part.split('/')[0].split(':')[0]
-        
-        session = requests.Session()
-        
-        # Логин
-        login_response = session.post(
-            f"{settings['panel_url']}/login",
-            data={'username': settings['username'], 'password': settings['password']}
-        )
-        
-        if login_response.status_code != 200:
+
+        try:
+            snapshot = get_inbound_snapshot()
+        except PanelAuthError:
             return jsonify({'success': False, 'error': 'Ошибка авторизации'})
-        
-        # Получаем данные inbound
-        inbounds_response = session.get(f"{settings['panel_url']}/panel/api/inbounds/list")
-        inbounds_data = inbounds_response.json()
-        
-        if not inbounds_data['success']:
+        except PanelError:
             return jsonify({'success': False, 'error': 'Ошибка получения данных'})
-        
-        # Ищем нужный inbound
-        for inbound in inbounds_data['obj']:
-            if str(inbound['id']) == str(inbound_id):
-                settings_json = json.loads(inbound['settings'])
-                stream_settings = json.loads(inbound['streamSettings'])
-                
-                # Ищем клиента по email
-                client_id = None
-                client_flow = None
-                for client in settings_json.get('clients', []):
-                    if client['email'] == email:
-                        client_id = client['id']
-                        client_flow = client.get('flow', 'xtls-rprx-vision')
-                        break
-                
-                if client_id:
-                    # Плуаем все необходимые параметры
-                    tcp = stream_settings.get('network', '')
-                    reality = stream_settings.get('security', '')
-                    reality_settings = stream_settings.get('realitySettings', {})
-                    
-                    # Добавляем отладочный вывод
-                    print("Stream Settings:", stream_settings)
-                    print("Reality Settings:", reality_settings)
-                    
-                    # Полчаем publicKey из настроек текущего inbound
-                    pbk = reality_settings.get('publicKey', '')
-                    if not pbk:  # Если publicKey не найден в realitySettings
-                        pbk = stream_settings.get('realitySettings', {}).get('settings', {}).get('publicKey', '')
-                    
-                    sid = reality_settings.get('shortIds', [''])[0]
-                    server_name = reality_settings.get('serverNames', [''])[0]
-                    port = inbound.get('port', '')
-                    
-                    # Формируем базовую часть ссылки
-                    link = f"vless://{client_id}@{domain_port}:{port}"
-                    
-                    # Добавляем параметры в определенном порядке
-                    params = []
-                    if tcp:
-                        params.append(f"type={tcp}")
-                    if reality:
-                        params.append(f"security={reality}")
-                    if pbk:
-                        params.append(f"pbk={pbk}")
-                    params.append("fp=chrome")
-                    if server_name:
-                        params.append(f"sni={server_name}")
-                    if sid:
-                        params.append(f"sid={sid}")
-                    params.append("spx=%2F")
-                    if client_flow:
-                        params.append(f"flow={client_flow}")
-                    
-                    # Собирае финальную сылку
-                    link = f"{link}?{'&'.join(params)}#vless2-{email}"
-                    
-                    return jsonify({'success': True, 'link': link})
-        
-        return jsonify({'success': False, 'error': 'Клиент не найде'})
-        
+
+        if snapshot.get_inbound(inbound_id) is None:
+            return jsonify({'success': False, 'error': 'Inbound не найден'})
+
+        return jsonify({'success': True, 'links': snapshot.links.inbound_links(inbound_id)})
+
     except Exception as e:
-        print("Error:", str(e))  # Добавлем вывод ошибки
         return jsonify({'success': False, 'error': str(e)})
 
 @app.template_filter('datetime')
 def timestamp_to_datetime(timestamp):
     return datetime.fromtimestamp(timestamp)
 
-# Добавим новую функцию для прверки статуса платежа
-def check_payment_status(payment_id):
-    """Общая функция для проверки статуса платежа"""
+def fetch_yoomoney_operations(client, label=None, from_date=None):
+    """
+    Загружает входящие операции YooMoney постранично, от новых к старым.
+
+    Args:
+        client (Client): Клиент YooMoney
+        label (str, optional): Загрузить только операции с этой меткой
+        from_date (datetime, optional): Загрузить только операции не старше этой даты
+
+    Returns:
+        tuple: (список операций, True если история загружена полностью)
+    """
+    operations = []
+    start_record = None
+    for _ in range(YOOMONEY_HISTORY_MAX_PAGES):
+        history = client.operation_history(
+            type='deposition',
+            label=label,
+            from_date=from_date,
+            start_record=start_record,
+            records=YOOMONEY_HISTORY_PAGE_SIZE
+        )
+        operations.extend(history.operations)
+
+        start_record = getattr(history, 'next_record', None)
+        if not start_record:
+            return operations, True
+
+    print(f"Warning: YooMoney history truncated at {YOOMONEY_HISTORY_MAX_PAGES} pages")
+    return operations, False
+
+def get_history_start(db):
+    """
+    Дата, с которой нужно загружать историю операций YooMoney.
+
+    Берется курсор последней обработанной операции минус окно пересканирования
+    (для операций, статус которых стал success позже), но не раньше создания
+    самого старого ожидающего платежа - до него оплат по нашим меткам быть не может.
+    """
+    oldest = db.execute(SQL_OLDEST_PENDING_PAYMENT, ['pending']).fetchone()['oldest']
+    if not oldest:
+        return None
+    start = datetime.strptime(oldest, '%Y-%m-%d %H:%M:%S') - YOOMONEY_RESCAN_WINDOW
+
+    cursor = db.execute('SELECT last_operation_time FROM yoomoney_cursor WHERE id = 1').fetchone()
+    if cursor and cursor['last_operation_time']:
+        cursor_time = datetime.strptime(cursor['last_operation_time'], '%Y-%m-%d %H:%M:%S')
+        start = max(start, cursor_time - YOOMONEY_RESCAN_WINDOW)
+
+    return start
+
+def expire_stale_payments(db):
+    """
+    Переводит счета старше PAYMENT_PENDING_DAYS в expired.
+
+    Начало загрузки истории ограничено самым старым ожидающим счетом, поэтому
+    один забытый счет заставлял бы каждый цикл читать историю за все время с его создания.
+    """
+    cursor = db.execute(SQL_EXPIRE_STALE_PAYMENTS, [f'-{PAYMENT_PENDING_DAYS} days'])
+    db.commit()
+    if cursor.rowcount:
+        print(f"Expired {cursor.rowcount} unpaid payments")
+
+def save_history_cursor(operation_id, operation_time):
+    """Сохраняет курсор истории YooMoney, не сдвигая его назад"""
     db = get_db()
     try:
-        # Начинаем транзакцию
-        db.execute('BEGIN IMMEDIATE')
-        
-        # Проверяем, не обработан ли уже платеж
-        payment = db.execute('SELECT * FROM payments WHERE payment_id = ?', 
-                           [payment_id]).fetchone()
-        
-        if not payment or payment['status'] != 'pending':
-            db.rollback()
-            return False
+        db.execute('''INSERT INTO yoomoney_cursor (id, last_operation_id, last_operation_time, updated_at)
+                     VALUES (1, ?, ?, CURRENT_TIMESTAMP)
+                     ON CONFLICT (id) DO UPDATE SET
+                         last_operation_id = excluded.last_operation_id,
+                         last_operation_time = excluded.last_operation_time,
+                         updated_at = CURRENT_TIMESTAMP
+                     WHERE yoomoney_cursor.last_operation_time IS NULL
+                        OR excluded.last_operation_time >= yoomoney_cursor.last_operation_time''',
+                  [operation_id, operation_time.strftime('%Y-%m-%d %H:%M:%S')])
+        db.commit()
+    finally:
+        db.close()
 
-        # Получаем настройки YooMoney
-        yoomoney_settings = get_yoomoney_settings()
-        if not yoomoney_settings:
-            db.rollback()
-            return False
+# Очередь фоновых задач.
+# Задачи пишутся в таблицу jobs в той же транзакции, что и изменение данных (outbox),
+# поэтому побочный эффект не теряется при падении процесса и не выполняется без записи о нем.
+# Повторы идут с экспоненциальной задержкой, dedup_key не дает поставить одну задачу дважды,
+# задачи с общим group_key выполняются строго по порядку.
+job_wake_event = threading.Event()
+job_stop_event = threading.Event()
+job_threads = []
 
-        # Создаем клиента YooMoney
-        client = Client(yoomoney_settings['secret_key'])
-        
-        # Получаем историю операций
-        history = client.operation_history()
-        
-        # Проверяем каждую операцию
-        payment_processed = False
-        for operation in history.operations:
-            if (hasattr(operation, 'label') and 
-                operation.label == payment_id and 
-                operation.status == 'success'):
-                
-                # Обновляем статус платежа
-                db.execute('''UPDATE payments 
-                             SET status = ?, paid_at = CURRENT_TIMESTAMP 
-                             WHERE payment_id = ?''',
-                          ['paid', payment_id])
-                
-                payment_processed = True
-                break
-        
-        if payment_processed:
-            # Обновляем дни подписки
-            try:
-                update_client_expiry(
-                    payment['inbound_id'],
-                    payment['email'],
-                    payment['days']
-                )
-                
-                # Отправляем уведомление в Telegram
-                settings = get_telegram_settings()
-                if settings and settings['is_enabled']:
-                    client_data = db.execute(
-                        'SELECT tgid FROM client_data WHERE email = ?',
-                        [payment['email']]
-                    ).fetchone()
-                    
-                    if client_data and client_data['tgid']:
-                        bot = telebot.TeleBot(settings['bot_token'])
-                        message = (
-                            f"✅ Оплата получена\n\n"
-                            f"Сумма: {payment['amount']} ₽\n"
-                            f"Дней добавлено: {payment['days']}\n"
-                            f"Спасибо за оплату!"
-                        )
-                        bot.send_message(client_data['tgid'], message)
-                
+def enqueue_job(db, job_type, payload, dedup_key=None, group_key=None, delay=0):
+    """
+    Ставит задачу в очередь в транзакции вызывающего кода (commit делает вызывающий).
+
+    Args:
+        db: Соединение с базой
+        job_type (str): Тип задачи из JOB_HANDLERS
+        payload (dict): Параметры задачи
+        dedup_key (str, optional): Ключ идемпотентности, повторная задача с ним игнорируется
+        group_key (str, optional): Задачи одной группы выполняются по очереди
+        delay (int, optional): Отложить выполнение на столько секунд
+
+    Returns:
+        bool: True если задача добавлена, False если такая уже есть
+    """
+    cursor = db.execute('''INSERT OR IGNORE INTO jobs 
+                          (job_type, payload, dedup_key, group_key, max_attempts, run_at) 
+                          VALUES (?, ?, ?, ?, ?, datetime('now', ?))''',
+                       [job_type, json.dumps(payload), dedup_key, group_key,
+                        JOB_MAX_ATTEMPTS, f'+{int(delay)} seconds'])
+    job_wake_event.set()
+    return cursor.rowcount > 0
+
+def submit_job(job_type, payload, dedup_key=None, group_key=None, delay=0):
+    """Ставит задачу в очередь в отдельной транзакции"""
+    db = get_db()
+    try:
+        added = enqueue_job(db, job_type, payload, dedup_key, group_key, delay)
+        db.commit()
+        return added
+    finally:
+        db.close()
+
+def claim_job():
+    """
+    Берет в работу первую готовую задачу.
+
+    Задача получает аренду на JOB_LEASE_SECONDS: если обработчик упадет вместе с процессом,
+    после окончания аренды задачу возьмет другой обработчик.
+    """
+    db = get_db()
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        while True:
+            job = db.execute(SQL_CLAIM_JOB).fetchone()
+            if job is None:
                 db.commit()
-                return True
-            except Exception as e:
-                print(f"Error processing payment: {str(e)}")
-                db.rollback()
-                return False
+                return None
+
+            # Обработчик упал на последней попытке - больше не повторяем
+            if job['attempts'] >= job['max_attempts'] and job['job_type'] not in JOB_RETRY_FOREVER:
+                db.execute('''UPDATE jobs SET status = 'failed', updated_at = CURRENT_TIMESTAMP 
+                             WHERE id = ?''', [job['id']])
+                print(f"Job {job['id']} ({job['job_type']}) failed: lease expired on last attempt")
+                alert_job_failure(db, job, 'аренда истекла на последней попытке')
+                continue
+
+            db.execute('''UPDATE jobs 
+                         SET status = 'running', attempts = attempts + 1,
+                             locked_until = datetime('now', ?), updated_at = CURRENT_TIMESTAMP 
+                         WHERE id = ?''',
+                      [f'+{JOB_LEASE_SECONDS} seconds', job['id']])
+            job = db.execute('SELECT * FROM jobs WHERE id = ?', [job['id']]).fetchone()
+            db.commit()
+            return job
+    finally:
+        db.close()
+
+def complete_job(job_id):
+    db = get_db()
+    try:
+        db.execute('''UPDATE jobs 
+                     SET status = 'done', locked_until = NULL, last_error = NULL, updated_at = CURRENT_TIMESTAMP 
+                     WHERE id = ? AND status = ?''', [job_id, 'running'])
+        db.commit()
+    finally:
+        db.close()
+
+def extend_job_lease(job_id):
+    """Продлевает аренду задачи, которая еще выполняется"""
+    db = get_db()
+    try:
+        db.execute('''UPDATE jobs 
+                     SET locked_until = datetime('now', ?), updated_at = CURRENT_TIMESTAMP 
+                     WHERE id = ? AND status = ?''',
+                  [f'+{JOB_LEASE_SECONDS} seconds', job_id, 'running'])
+        db.commit()
+    finally:
+        db.close()
+
+def alert_job_failure(db, job, error):
+    """Сообщает администратору о задаче, исчерпавшей попытки (один раз на задачу)"""
+    if (job['dedup_key'] or '').startswith('job_alert:'):
+        # Не уведомляем о неудачном уведомлении, иначе при недоступном Telegram цепочка не кончится
+        return
+    settings = get_telegram_settings()
+    if not settings or not settings['admin_chat_id']:
+        return
+    payload = json.loads(job['payload'])
+    message = (
+        f"⚠️ Фоновая задача {job['job_type']} #{job['id']} не выполнена "
+        f"после {job['attempts']} попыток\n\n"
+        f"Ошибка: {error}"
+    )
+    if job['job_type'] in JOB_RETRY_FOREVER:
+        message += f"\n\nПлатеж {payload.get('payment_id')} ({payload.get('email')}) оплачен, но подписка не продлена. Задача повторяется раз в час."
+    enqueue_job(db, 'send_message', {'chat_id': settings['admin_chat_id'], 'text': message},
+                dedup_key=f"job_alert:{job['id']}")
+
+def fail_job(job, error):
+    """
+    Возвращает задачу в очередь с экспоненциальной задержкой или помечает неудачной.
+
+    Задачи из JOB_RETRY_FOREVER не помечаются неудачными: после JOB_MAX_ATTEMPTS
+    они повторяются раз в JOB_RETRY_MAX, администратор получает уведомление.
+    """
+    db = get_db()
+    try:
+        if job['attempts'] >= job['max_attempts'] and job['job_type'] not in JOB_RETRY_FOREVER:
+            db.execute('''UPDATE jobs 
+                         SET status = 'failed', locked_until = NULL, last_error = ?, updated_at = CURRENT_TIMESTAMP 
+                         WHERE id = ?''', [str(error), job['id']])
+            print(f"Job {job['id']} ({job['job_type']}) failed after {job['attempts']} attempts: {error}")
+            alert_job_failure(db, job, error)
         else:
-            db.rollback()
-            return False
-        
+            delay = min(JOB_RETRY_BASE * 2 ** (job['attempts'] - 1), JOB_RETRY_MAX)
+            db.execute('''UPDATE jobs 
+                         SET status = 'pending', locked_until = NULL, last_error = ?,
+                             run_at = datetime('now', ?), updated_at = CURRENT_TIMESTAMP 
+                         WHERE id = ?''', [str(error), f'+{delay} seconds', job['id']])
+            print(f"Job {job['id']} ({job['job_type']}) attempt {job['attempts']} failed, retry in {delay}s: {error}")
+            if job['attempts'] == job['max_attempts']:
+                alert_job_failure(db, job, error)
+        db.commit()
+    finally:
+        db.close()
+
+def cleanup_jobs():
+    """Удаляет старые выполненные и неудачные задачи, чтобы таблица jobs не росла бесконечно"""
+    db = get_db()
+    try:
+        cursor = db.execute('''DELETE FROM jobs 
+                               WHERE (status = 'done' AND updated_at < datetime('now', ?))
+                                  OR (status = 'failed' AND updated_at < datetime('now', ?))''',
+                           [f'-{JOB_RETENTION_DAYS} days', f'-{JOB_FAILED_RETENTION_DAYS} days'])
+        db.commit()
+        print(f"Removed {cursor.rowcount} old jobs")
+    except Exception as e:
+        print(f"Error cleaning up jobs: {str(e)}")
+    finally:
+        db.close()
+
+def update_job_payload(job_id, payload):
+    """Сохраняет промежуточный результат задачи, чтобы повтор продолжил с того же места"""
+    db = get_db()
+    try:
+        db.execute('UPDATE jobs SET payload = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+                  [json.dumps(payload), job_id])
+        db.commit()
+    finally:
+        db.close()
+
+def execute_job(job):
+    handler = JOB_HANDLERS.get(job['job_type'])
+    try:
+        if handler is None:
+            raise Exception(f"Неизвестный тип задачи: {job['job_type']}")
+        with app.app_context():
+            handler(job, json.loads(job['payload']))
+    except Exception as e:
+        fail_job(job, e)
+    else:
+        complete_job(job['id'])
+
+def run_job_worker():
+    while not job_stop_event.is_set():
+        try:
+            job = claim_job()
+        except Exception as e:
+            print(f"Error claiming job: {str(e)}")
+            job = None
+
+        if job is None:
+            job_wake_event.wait(JOB_POLL_INTERVAL)
+            job_wake_event.clear()
+            continue
+
+        execute_job(job)
+
+def start_job_workers():
+    """Запускает обработчики очереди задач"""
+    job_stop_event.clear()
+    for i in range(JOB_WORKERS):
+        thread = threading.Thread(target=run_job_worker, name=f'job-worker-{i}', daemon=True)
+        thread.start()
+        job_threads.append(thread)
+    print(f"Started {JOB_WORKERS} job workers")
+
+def stop_job_workers():
+    job_stop_event.set()
+    job_wake_event.set()
+    for thread in job_threads:
+        thread.join(timeout=5)
+    job_threads.clear()
+    print("Job workers stopped")
+
+def is_fully_paid(expected_amount, paid_amount, net=False):
+    """
+    Покрывает ли перевод сумму счета.
+
+    Args:
+        net (bool): paid_amount - сумма зачисления за вычетом комиссии YooMoney
+    """
+    required = float(expected_amount)
+    if net:
+        required *= 1 - YOOMONEY_MAX_COMMISSION
+    return float(paid_amount or 0) + 0.005 >= required
+
+def settle_payments(payment_ids, paid_amounts=None, net=False):
+    """
+    Отмечает платежи оплаченными в одной транзакции.
+
+    В той же транзакции для каждого платежа ставится задача продления подписки,
+    поэтому оплаченный платеж не может остаться без продления.
+
+    Args:
+        paid_amounts (dict, optional): payment_id -> сумма перевода. Метку может указать
+            любой перевод, поэтому платеж с недостаточной суммой остается pending.
+            Без paid_amounts платежи подтверждаются вручную (администратором)
+        net (bool): Суммы в paid_amounts за вычетом комиссии (история операций)
+
+    Returns:
+        list: Строки платежей, которые были в статусе pending (или expired) и переведены в paid
+    """
+    payment_ids = list(payment_ids)
+    if not payment_ids:
+        return []
+
+    db = get_db()
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        settled = []
+        # Ограничение SQLite на число параметров в одном запросе
+        for i in range(0, len(payment_ids), 500):
+            chunk = payment_ids[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            # Просроченный счет тоже можно оплатить, он лишь не ищется плановой сверкой
+            settled.extend(db.execute(SQL_UNSETTLED_PAYMENTS.format(placeholders=placeholders), chunk).fetchall())
+
+        if paid_amounts is not None:
+            underpaid = [payment for payment in settled
+                         if not is_fully_paid(payment['amount'], paid_amounts.get(payment['payment_id']), net)]
+            for payment in underpaid:
+                print(f"Payment {payment['payment_id']}: paid {paid_amounts.get(payment['payment_id'])}, "
+                      f"expected {payment['amount']}, not settled")
+            settled = [payment for payment in settled if payment not in underpaid]
+
+        db.executemany(SQL_MARK_PAYMENT_PAID, [('paid', payment['payment_id']) for payment in settled])
+
+        for payment in settled:
+            enqueue_job(db, 'extend_client', {
+                'payment_id': payment['payment_id'],
+                'email': payment['email'],
+                'inbound_id': payment['inbound_id'],
+                'days': payment['days'],
+                'amount': payment['amount'],
+            }, dedup_key=f"extend_client:{payment['payment_id']}", group_key=f"client:{payment['email']}")
+
+        # Один сброс кэша /stat на всю пачку, в той же транзакции
+        version = bump_stat_cache_version(db) if settled else None
+        db.commit()
+
+        if settled:
+            stat_cache.invalidate(emails=[payment['email'] for payment in settled], version=version)
+        return settled
+    finally:
+        db.close()
+
+def reconcile_payments(payment_ids=None):
+    """
+    Сверяет ожидающие платежи с историей операций YooMoney.
+
+    История загружается один раз на цикл, совпавшие платежи отмечаются
+    оплаченными одной транзакцией.
+
+    Args:
+        payment_ids (list, optional): Проверить только эти платежи
+
+    Returns:
+        set: ID платежей, отмеченных оплаченными (продление выполняет очередь задач)
+    """
+    from_date = None
+    db = get_db()
+    try:
+        if payment_ids is None:
+            expire_stale_payments(db)
+            rows = db.execute(SQL_PENDING_PAYMENT_IDS, ['pending']).fetchall()
+            pending = {row['payment_id'] for row in rows}
+            from_date = get_history_start(db)
+        else:
+            pending = set(payment_ids)
+    finally:
+        db.close()
+
+    if not pending:
+        print("No pending payments found.")
+        return set()
+
+    print(f"Found {len(pending)} pending payments")
+
+    yoomoney_settings = get_yoomoney_settings()
+    if not yoomoney_settings:
+        return set()
+
+    client = Client(yoomoney_settings['secret_key'])
+
+    # При ручной проверке одного платежа API сам отфильтрует операции по метке,
+    # курсор в этом случае не используется и не сдвигается
+    incremental = payment_ids is None
+    label = next(iter(pending)) if not incremental and len(pending) == 1 else None
+    operations, complete = fetch_yoomoney_operations(client, label=label, from_date=from_date)
+
+    paid_operations = {
+        operation.label: operation for operation in operations
+        if operation.status == 'success' and getattr(operation, 'direction', 'in') == 'in'
+        and getattr(operation, 'label', None) in pending
+    }
+
+    # В истории кошелька суммы в рублях и за вычетом комиссии
+    processed = {payment['payment_id'] for payment in settle_payments(
+        paid_operations.keys(),
+        paid_amounts={label: operation.amount for label, operation in paid_operations.items()},
+        net=True
+    )}
+
+    # Курсор сдвигается и после неполной загрузки: история идет от новых операций
+    # к старым, самые новые получены. Иначе каждый цикл читал бы все страницы заново
+    if incremental:
+        if not complete:
+            print("Warning: older YooMoney operations were not checked, they are found by notifications and manual checks")
+        dated = [operation for operation in operations if operation.datetime]
+        if dated:
+            cursor_operation = max(dated, key=lambda operation: operation.datetime)
+            cursor_time = cursor_operation.datetime
+
+            # Время в базе хранится в UTC без часового пояса, как CURRENT_TIMESTAMP
+            if cursor_time.tzinfo is not None:
+                cursor_time = cursor_time.astimezone(timezone.utc).replace(tzinfo=None)
+            save_history_cursor(cursor_operation.operation_id, cursor_time)
+
+    return processed
+
+def check_payment_status(payment_id):
+    """Общая функция для проверки статуса платежа"""
+    try:
+        return payment_id in reconcile_payments([payment_id])
     except Exception as e:
         print(f"Error checking payment status: {str(e)}")
-        db.rollback()
         return False
-    finally:
-        if db:
-            try:
-                db.rollback()  # На всякий случай откатываем незавершенную транзакцию
-            except:
-                pass
 
 # Обновляем функцию check_pending_payments
 def check_pending_payments():
     print("Starting automatic payment check...")
-    db = get_db()
     try:
-        pending_payments = db.execute(
-            'SELECT payment_id FROM payments WHERE status = ?', 
-            ['pending']
-        ).fetchall()
-        
-        if not pending_payments:
-            print("No pending payments found.")
-            return
-            
-        print(f"Found {len(pending_payments)} pending payments")
-        
-        for payment in pending_payments:
-            try:
-                check_payment_status(payment['payment_id'])
-            except Exception as e:
-                print(f"Error processing payment {payment['payment_id']}: {str(e)}")
-                continue
-                
+        reconcile_payments()
     except Exception as e:
         print(f"Error in check_pending_payments: {str(e)}")
-    finally:
-        db.close()
 
 # Обновляем маршрут для проверки платежа
 @app.route('/payments/check', methods=['POST'])
@@ -1011,23 +3050,25 @@ def create_payment():
 
         # Сохраняем информацию о платеже
         db = get_db()
-        db.execute('''INSERT INTO payments 
-                     (email, amount, days, payment_id, inbound_id) 
-                     VALUES (?, ?, ?, ?, ?)''',
-                  [email, amount, days, payment_id, inbound_id])
-        db.commit()
-        db.close()
+        try:
+            db.execute('''INSERT INTO payments 
+                         (email, amount, days, payment_id, inbound_id) 
+                         VALUES (?, ?, ?, ?, ?)''',
+                      [email, amount, days, payment_id, inbound_id])
 
-        # Если указан Telegram ID, отправляем ссылку на оплату
-        if tgid:
-            bot = telebot.TeleBot(get_telegram_settings()['bot_token'])
-            message = (
-                f"💰 Счет на олату\n\n"
-                f"Сумма: {amount} ₽\n"
-                f"Дней: {days}\n\n"
-                f"Ссылка дя оплаты:\n{quickpay.redirected_url}"
-            )
-            bot.send_message(tgid, message)
+            # Если указан Telegram ID, ставим в очередь отправку ссылки на оплату
+            if tgid:
+                message = (
+                    f"💰 Счет на олату\n\n"
+                    f"Сумма: {amount} ₽\n"
+                    f"Дней: {days}\n\n"
+                    f"Ссылка дя оплаты:\n{quickpay.redirected_url}"
+                )
+                enqueue_job(db, 'send_message', {'chat_id': tgid, 'text': message},
+                            dedup_key=f"invoice_notice:{payment_id}", group_key=f"chat:{tgid}")
+            db.commit()
+        finally:
+            db.close()
 
         return jsonify({
             'success': True,
@@ -1038,101 +3079,217 @@ def create_payment():
         print(f"Error creating payment: {str(e)}")
         return jsonify({'success': False, 'error': str(e)})
 
-def update_client_expiry(inbound_id, email, days):
+def calculate_client_expiry(client, days):
+    """Новая дата окончания подписки в мс: продление от текущей даты окончания или от сейчас, если она прошла"""
+    current_time = int(datetime.now().timestamp() * 1000)
+    current_expiry = int(client.get('expiryTime', current_time))
+    if current_expiry < current_time:
+        current_expiry = current_time
+    return current_expiry + (int(days) * 24 * 60 * 60 * 1000)
+
+def update_client_expiry(inbound_id, email, days, expiry_time=None):
+    """
+    Продлевает подписку клиента в панели.
+
+    Args:
+        expiry_time (int, optional): Готовая дата окончания в мс. С ней повторный вызов
+            не продлевает подписку второй раз
+    """
     settings = get_settings()
     if not settings:
         raise Exception('Настройки панели не найдены')
     
     try:
-        session = requests.Session()
-        
-        # Логин
-        login_response = session.post(
-            f"{settings['panel_url']}/login",
-            data={'username': settings['username'], 'password': settings['password']}
-        )
-        
-        if login_response.status_code != 200:
-            raise Exception('Ошибка авторизации')
-        
+        # Клиент продлевается в панели узла, которому принадлежит inbound
+        panel, local_id = get_panel_for_inbound(inbound_id)
+
         # олучаем текущие данные inbound
-        inbounds_response = session.get(
-            f"{settings['panel_url']}/panel/api/inbounds/list",
-            headers={'Accept': 'application/json'}
-        )
-        
-        if inbounds_response.status_code != 200:
-            raise Exception(f'Ошибка получения данных inbound: {inbounds_response.status_code}')
-            
-        try:
-            inbounds_data = inbounds_response.json()
-        except ValueError as e:
-            raise Exception(f'Ошибка парсинга ответа: {str(e)}, Ответ: {inbounds_response.text}')
-        
-        if not inbounds_data.get('success'):
-            raise Exception('Ошибка получения днны inbound')
+        snapshot = panel.inbounds.get()
         
         # Ищем нужный inbound и киента
-        for inbound in inbounds_data['obj']:
-            if str(inbound['id']) == str(inbound_id):
-                settings_json = json.loads(inbound['settings'])
+        record = snapshot.find_client(email, local_id)
+        if record and record.settings:
+            client = record.settings
+
+            # Вычисляем нвую дату окончания
+            if expiry_time is None:
+                new_expiry = calculate_client_expiry(client, days)
+            else:
+                new_expiry = int(expiry_time)
+            
+            # Формируем данные дя обновлени  правильном форате
+            update_data = {
+                "id": int(local_id),
+                "settings": json.dumps({
+                    "clients": [{
+                        "id": client['id'],
+                        "alterId": 0,
+                        "email": email,
+                        "limitIp": client.get('limitIp', 0),
+                        "totalGB": client.get('totalGB', 0),
+                        "expiryTime": new_expiry,
+                        "enable": True,
+                        "tgId": client.get('tgId', ''),
+                        "subId": client.get('subId', '')
+                    }]
+                })
+            }
+            
+            # Обновляем данные клиента
+            update_response = panel.post(
+                f"/panel/api/inbounds/updateClient/{client['id']}",
+                json=update_data,
+                headers={'Accept': 'application/json'}
+            )
+            
+            if update_response.status_code != 200:
+                raise Exception(f'Ошибка обновлния данных: {update_response.status_code}')
                 
-                # Ищем клиента по email
-                for client in settings_json.get('clients', []):
-                    if client['email'] == email:
-                        # Вычисляем нвую дату окончания
-                        current_time = int(datetime.now().timestamp() * 1000)
-                        current_expiry = int(client.get('expiryTime', current_time))
-                        if current_expiry < current_time:
-                            current_expiry = current_time
-                            
-                        new_expiry = current_expiry + (int(days) * 24 * 60 * 60 * 1000)
-                        
-                        # Формируем данные дя обновлени  правильном форате
-                        update_data = {
-                            "id": int(inbound_id),
-                            "settings": json.dumps({
-                                "clients": [{
-                                    "id": client['id'],
-                                    "alterId": 0,
-                                    "email": email,
-                                    "limitIp": client.get('limitIp', 0),
-                                    "totalGB": client.get('totalGB', 0),
-                                    "expiryTime": new_expiry,
-                                    "enable": True,
-                                    "tgId": client.get('tgId', ''),
-                                    "subId": client.get('subId', '')
-                                }]
-                            })
-                        }
-                        
-                        # Обновляем данные клиента
-                        update_response = session.post(
-                            f"{settings['panel_url']}/panel/api/inbounds/updateClient/{client['id']}",
-                            json=update_data,
-                            headers={'Accept': 'application/json'}
-                        )
-                        
-                        if update_response.status_code != 200:
-                            raise Exception(f'Ошибка обновлния данных: {update_response.status_code}')
-                            
-                        try:
-                            response_data = update_response.json()
-                        except ValueError as e:
-                            raise Exception(f'Ошибка парсинга ответа: {str(e)}, Ответ: {update_response.text}')
-                        
-                        if not response_data.get('success'):
-                            raise Exception('Ошибка обновления данных клиента')
-                        
-                        print(f"Successfully updated expiry time for {email} to {new_expiry}")
-                        return True
-                        
+            try:
+                response_data = update_response.json()
+            except ValueError as e:
+                raise Exception(f'Ошибка парсинга ответа: {str(e)}, Ответ: {update_response.text}')
+            
+            if not response_data.get('success'):
+                raise Exception('Ошибка обновления данных клиента')
+
+            panel.inbounds.invalidate()
+            stat_cache.invalidate(emails=[email])
+            update_expiry_timeline(email, inbound_id, new_expiry)
+            
+            print(f"Successfully updated expiry time for {email} to {new_expiry}")
+            return True
+
         raise Exception(f'Клиент {email} не найден в inbound {inbound_id}')
         
     except Exception as e:
         print(f"Error in update_client_expiry: {str(e)}")
         raise
 
+def job_extend_client(job, payload):
+    """
+    Продлевает подписку по оплаченному платежу и ставит уведомление клиенту.
+
+    Дата окончания вычисляется один раз и сохраняется в задаче: если панель уже
+    приняла изменение, а процесс упал до завершения задачи, повтор выставит ту же дату.
+    """
+    if payload.get('expiry_time') is None:
+        # Считаем от актуальных данных панели, а не от кэша
+        invalidate_inbound_snapshot(payload['inbound_id'])
+        snapshot = get_inbound_snapshot()
+        record = snapshot.find_client(payload['email'], payload['inbound_id'])
+        if not record or not record.settings:
+            raise Exception(f"Клиент {payload['email']} не найден в inbound {payload['inbound_id']}")
+        payload['expiry_time'] = calculate_client_expiry(record.settings, payload['days'])
+        # Клиент с тем же email на других узлах продлевается до той же даты
+        payload['inbound_ids'] = [str(other.inbound['id']) for other in snapshot.find_clients(payload['email'])
+                                  if other.settings]
+        update_job_payload(job['id'], payload)
+
+    for inbound_id in payload.get('inbound_ids') or [payload['inbound_id']]:
+        update_client_expiry(inbound_id, payload['email'], payload['days'],
+                             expiry_time=payload['expiry_time'])
+
+    client_data = get_client_data(payload['email'])
+    if client_data and client_data['tgid']:
+        message = (
+            f"✅ Оплата получена\n\n"
+            f"Сумма: {payload['amount']} ₽\n"
+            f"Дней добавлено: {payload['days']}\n"
+            f"Спасибо за оплату!"
+        )
+        submit_job('send_message', {'chat_id': client_data['tgid'], 'text': message},
+                   dedup_key=f"payment_notice:{payload['payment_id']}",
+                   group_key=f"chat:{client_data['tgid']}")
+
+def job_send_message(job, payload):
+    settings = get_telegram_settings()
+    if not settings or not settings['is_enabled'] or not settings['bot_token']:
+        # Бот выключен - сообщение некому отправить, повторять бессмысленно
+        print(f"Telegram bot is disabled, dropping message to {payload['chat_id']}")
+        return
+
+    # При заполненной очереди отправки задача уйдет на повтор с задержкой
+    future = telegram_sender.send(payload['chat_id'], payload['text'])
+    while True:
+        try:
+            future.result(TELEGRAM_SEND_TIMEOUT)
+            return
+        except FuturesTimeoutError:
+            # Сообщение все еще в очереди отправки этого процесса и уйдет позже.
+            # Повтор задачи отправил бы его второй раз, поэтому ждем дальше,
+            # продлевая аренду, чтобы задачу не взял другой обработчик
+            print(f"Job {job['id']}: message to {payload['chat_id']} is still queued, waiting")
+            extend_job_lease(job['id'])
+
+def job_create_invoice(job, payload):
+    """
+    Выставляет счет и отправляет клиенту уведомление об окончании подписки со ссылкой.
+
+    ID платежа выдается при постановке задачи, поэтому повтор не создает второй счет.
+    """
+    payment = create_payment_for_client(
+        payload['email'],
+        payload['amount'],
+        payload['days'],
+        payload['inbound_id'],
+        payload['tgid'],
+        payment_id=payload['payment_id']
+    )
+    if not payment.get('success'):
+        raise Exception(payment.get('error', 'Ошибка создания платежа'))
+
+    settings = get_telegram_settings()
+    message = settings['notification_template'].format(
+        days=payload['days_left'],
+        email=payload['email'],
+        payment_link=f"\nСсылка для оплаты:\n{payment['payment_url']}"
+    )
+    submit_job('send_message', {'chat_id': payload['tgid'], 'text': message},
+               dedup_key=f"invoice_notice:{payload['payment_id']}",
+               group_key=f"chat:{payload['tgid']}")
+
+def job_optimize_image(job, payload):
+    """Заменяет картинку /start оптимизированной копией, исходник остается в image_original_path"""
+    if Image is None:
+        print("Pillow is not installed, start image is used as uploaded")
+        return
+
+    source_path = payload['image_path']
+    if not os.path.exists(os.path.join('static', source_path)):
+        # Картинку уже заменили или удалили
+        return
+
+    optimized_path = optimize_image(source_path)
+    if optimized_path is None:
+        return
+
+    db = get_db()
+    try:
+        cursor = db.execute('''UPDATE bot_messages 
+                              SET image_path = ?, image_original_path = ?, image_file_id = NULL 
+                              WHERE message_type = ? AND image_path = ?''',
+                           [optimized_path, source_path, 'start_message', source_path])
+        if cursor.rowcount:
+            bump_settings_version(db)
+        db.commit()
+    finally:
+        db.close()
+
+    if cursor.rowcount:
+        settings_cache.invalidate()
+        print(f"Start image optimized: {source_path} -> {optimized_path}")
+    else:
+        # Пока шла оптимизация, картинку сменили
+        os.remove(os.path.join('static', optimized_path))
+
+JOB_HANDLERS = {
+    'extend_client': job_extend_client,
+    'send_message': job_send_message,
+    'create_invoice': job_create_invoice,
+    'optimize_image': job_optimize_image,
+}
+
 @app.route('/payments/callback', methods=['POST'])
 @login_required
 def payment_callback():
@@ -1143,48 +3300,90 @@ def payment_callback():
             return jsonify({'success': False, 'error': 'Не указан label'})
 
         db = get_db()
-        payment = db.execute('SELECT * FROM payments WHERE payment_id = ?', [label]).fetchone()
+        payment = db.execute(SQL_PAYMENT_BY_ID, [label]).fetchone()
+        db.close()
         
         if not payment:
             return jsonify({'success': False, 'error': 'Платеж не найден'})
 
-        if payment['status'] != 'pending':
+        # Ручное подтверждение администратором: сумму не проверяем.
+        # Обновляем сатус платежа, только если его еще никто не обработал
+        settled = settle_payments([label])
+        if not settled:
             return jsonify({'success': False, 'error': 'Неверны статус платежа'})
 
-        # Обновляем сатус платежа
-        db.execute('''UPDATE payments 
-                     SET status = ?, paid_at = CURRENT_TIMESTAMP 
-                     WHERE payment_id = ?''',
-                  ['paid', label])
-        db.commit()
-
-        # Обновляем дни подписки киента
-        try:
-            update_client_expiry(payment['inbound_id'], payment['email'], payment['days'])
-        except Exception as e:
-            db.rollback()
-            return jsonify({'success': False, 'error': f'Ошиба обновленя подписки: {str(e)}'})
-
-        # тпрвляем уведмление в Telegram
-        settings = get_telegram_settings()
-        if settings and settings['is_enabled']:
-            client = db.execute('SELECT tgid FROM client_data WHERE email = ?', [payment['email']]).fetchone()
-            if client and client['tgid']:
-                bot = telebot.TeleBot(settings['bot_token'])
-                message = (
-                    f"✅ Оплата получена\n\n"
-                    f"Сумма: {payment['amount']} \n"
-                    f"Дней добавлено: {payment['days']}\n"
-                    f"Спасибо за оплату!"
-                )
-                bot.send_message(client['tgid'], message)
-
-        db.close()
+        # Продление подписки и уведомление клиента выполнит очередь задач
         return jsonify({'success': True})
 
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+def verify_yoomoney_notification(form, notification_secret):
+    """
+    Проверяет подпись HTTP-уведомления YooMoney.
+
+    sha1_hash считается от полей уведомления и секрета, разделенных '&',
+    в порядке, заданном протоколом YooMoney.
+    """
+    fields = [
+        form.get('notification_type', ''),
+        form.get('operation_id', ''),
+        form.get('amount', ''),
+        form.get('currency', ''),
+        form.get('datetime', ''),
+        form.get('sender', ''),
+        form.get('codepro', ''),
+        notification_secret,
+        form.get('label', ''),
+    ]
+    expected = hashlib.sha1('&'.join(fields).encode('utf-8')).hexdigest()
+    return hmac.compare_digest(expected, form.get('sha1_hash', '').lower())
+
+@app.route('/yoomoney/notification', methods=['POST'])
+def yoomoney_notification():
+    """
+    Прием HTTP-уведомлений YooMoney о входящих платежах.
+
+    Маршрут публичный: подлинность проверяется по sha1_hash. Платеж отмечается
+    оплаченным сразу, а продление подписки и сообщение в Telegram выполняет
+    очередь задач, чтобы ответить YooMoney без задержек.
+    """
+    yoomoney_settings = get_yoomoney_settings()
+    if (not yoomoney_settings or not yoomoney_settings['is_enabled'] or
+            not yoomoney_settings['notification_secret']):
+        # Без секрета подпись может посчитать кто угодно
+        return 'YooMoney не настроен', 404
+
+    form = request.form
+    if not verify_yoomoney_notification(form, yoomoney_settings['notification_secret']):
+        print(f"Invalid YooMoney notification hash for operation {form.get('operation_id')}")
+        return 'Invalid hash', 400
+
+    label = form.get('label')
+
+    # Платежи с протекцией и незачисленные переводы не продлевают подписку
+    if not label or form.get('codepro') == 'true' or form.get('unaccepted') == 'true':
+        return 'OK', 200
+
+    # Метку может указать любой перевод: продлеваем, только если оплачена вся сумма в рублях
+    if form.get('currency') != '643':
+        print(f"YooMoney notification for {label}: currency {form.get('currency')}, payment not settled")
+        return 'OK', 200
+
+    # withdraw_amount - списано с плательщика, amount - зачислено за вычетом комиссии
+    try:
+        if form.get('withdraw_amount'):
+            paid_amount, net = float(form['withdraw_amount']), False
+        else:
+            paid_amount, net = float(form.get('amount') or 0), True
+    except ValueError:
+        paid_amount, net = 0, False
+
+    # Повторное уведомление по уже обработанному платежу ничего не изменит
+    settle_payments([label], paid_amounts={label: paid_amount}, net=net)
+
+    return 'OK', 200
+
 @app.route('/payments/cancel', methods=['POST'])
 @login_required
 def cancel_payment():
@@ -1212,7 +3411,7 @@ def delete_payment():
 
         db = get_db()
         # Преряем, что платеж существует и имеет статус 'cancelled'
-        payment = db.execute('SELECT status FROM payments WHERE payment_id = ?', [payment_id]).fetchone()
+        payment = db.execute(SQL_PAYMENT_STATUS, [payment_id]).fetchone()
         
         if not payment:
             return jsonify({'success': False, 'error': 'Платеж не найден'})
@@ -1243,8 +3442,10 @@ def settings():
                      (panel_url, username, password) 
                      VALUES (?, ?, ?)''',
                   [panel_url, username, password])
+        bump_settings_version(db)
         db.commit()
         db.close()
+        settings_cache.invalidate()
         
         flash('Нстройки панели упешно охранены')
         return redirect(url_for('settings'))
@@ -1252,46 +3453,257 @@ def settings():
     settings = get_settings()
     return render_template('settings.html', settings=settings)
 
+@app.route('/panels')
+@login_required
+def panels():
+    """Дополнительные узлы 3x-ui и их доступность при последнем опросе"""
+    db = get_db()
+    rows = db.execute('SELECT id, name, panel_url, username, timeout, is_enabled, created_at FROM panels ORDER BY id').fetchall()
+    db.close()
+
+    try:
+        unavailable = get_inbound_snapshot().unavailable
+    except PanelError:
+        unavailable = {}
+
+    return jsonify({'success': True, 'panels': [
+        dict(row, inbound_prefix=f"{row['id']}-", error=unavailable.get(row['id'])) for row in rows
+    ]})
+
+@app.route('/panels/add', methods=['POST'])
+@login_required
+def add_panel():
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({'success': False, 'error': 'Данные не получены'})
+
+        panel_url = data.get('panel_url', '').strip()
+        if not panel_url.startswith(('http://', 'https://')):
+            return jsonify({'success': False, 'error': 'Адрес панели должен начинаться с http:// или https://'})
+        if not data.get('username') or not data.get('password'):
+            return jsonify({'success': False, 'error': 'Укажите логин и пароль панели'})
+
+        timeout = float(data['timeout']) if data.get('timeout') else None
+
+        db = get_db()
+        try:
+            cursor = db.execute('''INSERT INTO panels (name, panel_url, username, password, timeout)
+                                   VALUES (?, ?, ?, ?, ?)''',
+                               [data.get('name') or get_panel_host(panel_url), panel_url,
+                                data['username'], data['password'], timeout])
+            bump_settings_version(db)
+            db.commit()
+            panel_id = cursor.lastrowid
+        finally:
+            db.close()
+        settings_cache.invalidate()
+
+        return jsonify({'success': True, 'id': panel_id})
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/panels/delete', methods=['POST'])
+@login_required
+def delete_panel():
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({'success': False, 'error': 'Данные не получены'})
+
+        db = get_db()
+        try:
+            db.execute('DELETE FROM panels WHERE id = ?', [data['id']])
+            bump_settings_version(db)
+            db.commit()
+        finally:
+            db.close()
+        settings_cache.invalidate()
+
+        return jsonify({'success': True})
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
 # Добавим функцию для получения сообщений бота
 def get_bot_message(message_type):
     try:
-        with app.app_context():
+        message = settings_cache.get_bot_message(message_type)
+        return message['message_text'] if message else None
+    except Exception as e:
+        print(f"Error getting bot message: {str(e)}")
+        return None
+
+StatResponse = namedtuple('StatResponse', ['email', 'text', 'kwargs', 'expires_at'])
+
+class StatResponseCache:
+    """
+    Готовые ответы на /stat по tgid.
+
+    Ответ живет ttl секунд, но не дольше окончания подписки, чтобы после него
+    не показывать устаревший срок. У клиента с лимитом трафика срок сокращается
+    пропорционально остатку лимита (не меньше min_ttl): чем ближе лимит, тем
+    важнее свежие цифры. Повторный /stat раньше min_interval после последнего
+    обращения к панели получает сохраненный ответ даже после окончания срока.
+
+    Сброс увеличивает счетчик в stat_cache_version (bump_stat_cache_version):
+    остальные процессы замечают его при следующей проверке (не чаще раза
+    в check_interval секунд) и забывают все свои ответы, т.к. не знают,
+    чей именно ответ устарел.
+    """
+
+    def __init__(self, ttl=STAT_CACHE_TTL, min_interval=STAT_RATE_LIMIT_INTERVAL,
+                 check_interval=SETTINGS_VERSION_CHECK_INTERVAL, min_ttl=STAT_CACHE_MIN_TTL):
+        self.ttl = ttl
+        self.min_ttl = min_ttl
+        self.min_interval = min_interval
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.responses = {}
+        self.last_requests = {}
+        self._version = None
+        self._checked_at = 0
+
+    @staticmethod
+    def _read_version(db):
+        row = db.execute('SELECT version FROM stat_cache_version WHERE id = 1').fetchone()
+        return row['version'] if row else 0
+
+    def _sync(self):
+        """Забывает все ответы, если кэш сбросил другой процесс. Вызывается под self.lock"""
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return
+        db = get_db()
+        try:
+            version = self._read_version(db)
+        finally:
+            db.close()
+        if version != self._version:
+            self.responses.clear()
+            self._version = version
+        self._checked_at = now
+
+    def get(self, tgid):
+        """Возвращает сохраненный ответ для tgid или None"""
+        now = time.time()
+        with self.lock:
+            self._sync()
+            # Время последнего ответа, собранного заново (put)
+            last_request = self.last_requests.get(tgid)
+            rate_limited = last_request is not None and now - last_request < self.min_interval
+
+            response = self.responses.get(tgid)
+            if response is None:
+                return None
+            if response.expires_at > now or rate_limited:
+                return response
+            del self.responses[tgid]
+            return None
+
+    def put(self, tgid, email, text, expiry_time=None, traffic_used=None, traffic_total=None, **kwargs):
+        """
+        Сохраняет заново собранный ответ.
+
+        Args:
+            expiry_time (int, optional): Окончание подписки в мс
+            traffic_used (int, optional): Израсходованный трафик в байтах
+            traffic_total (int, optional): Лимит трафика в байтах, 0 - без лимита
+        """
+        now = time.time()
+        ttl = self.ttl
+        if traffic_total and float(traffic_total) > 0 and traffic_used is not None:
+            remaining = max(1 - float(traffic_used) / float(traffic_total), 0)
+            ttl = max(self.min_ttl, ttl * remaining)
+        expires_at = now + ttl
+        if expiry_time and float(expiry_time) > 0:
+            expires_at = min(expires_at, float(expiry_time) / 1000)
+        with self.lock:
+            self.responses[tgid] = StatResponse(email, text, kwargs, expires_at)
+            self.last_requests[tgid] = now
+            # Записи давно молчавших чатов больше не ограничивают частоту
+            if len(self.last_requests) > 10000:
+                idle_since = time.time() - self.min_interval
+                self.last_requests = {key: value for key, value in self.last_requests.items()
+                                      if value > idle_since}
+
+    def invalidate(self, tgid=None, emails=(), version=None):
+        """
+        Сбрасывает ответы для tgid и для клиентов с этими email во всех процессах.
+
+        Args:
+            version (int, optional): Результат bump_stat_cache_version в уже завершенной
+                транзакции вызывающего кода. Без него счетчик увеличивается здесь
+        """
+        emails = set(emails)
+        with self.lock:
+            if tgid is not None:
+                self.responses.pop(str(tgid), None)
+            if emails:
+                for key in [key for key, response in self.responses.items() if response.email in emails]:
+                    del self.responses[key]
+
+        if version is None:
             db = get_db()
             try:
-                message = db.execute(
-                    'SELECT message_text FROM bot_messages WHERE message_type = ?', 
-                    [message_type]
-                ).fetchone()
-                
-                return message['message_text'] if message else None
-                
+                db.execute('BEGIN IMMEDIATE')
+                version = bump_stat_cache_version(db)
+                db.commit()
             finally:
                 db.close()
-    except Exception as e:
-        print(f"Error getting bot message: {str(e)}")
-        return None
+
+        with self.lock:
+            # Если между проверками версию менял только этот процесс, остальные ответы актуальны
+            if self._version is not None and version == self._version + 1:
+                self._version = version
+
+def bump_stat_cache_version(db):
+    """
+    Отмечает сброс кэша /stat для всех процессов, вызывается в транзакции записи.
+
+    Returns:
+        int: Новая версия для stat_cache.invalidate после commit
+    """
+    db.execute('UPDATE stat_cache_version SET version = version + 1 WHERE id = 1')
+    return StatResponseCache._read_version(db)
+
+# Ответы на /stat; сбрасываются при оплате и изменении клиента
+stat_cache = StatResponseCache()
 
 # Добави функцию для обработки комады /stat
-def handle_stat_command(message, telegram_bot):
+def handle_stat_command(message):
     try:
         tgid = str(message.chat.id)
         print(f"Received /stat command from tgid: {tgid}")
+
+        cached = stat_cache.get(tgid)
+        if cached:
+            telegram_sender.send(message.chat.id, cached.text, **cached.kwargs)
+            return
         
         with app.app_context():
             db = get_db()
             try:
                 client_data = db.execute(
-                    'SELECT email FROM client_data WHERE tgid = ? COLLATE NOCASE',
+                    SQL_EMAIL_BY_TGID,
                     [tgid]
                 ).fetchone()
                 
+                if not client_data:
+                    # Клиент мог быть заведен в панели с tgId, но без локальной записи
+                    try:
+                        panel_email = get_inbound_snapshot().find_email_by_tgid(tgid)
+                    except PanelError:
+                        panel_email = None
+                    if panel_email:
+                        client_data = {'email': panel_email}
+
                 if not client_data:
                     print(f"No client found for tgid: {tgid}")
                     
                     # Проверяем, включена ли выдача тестовых аккаунтов
-                    test_settings = db.execute(
-                        'SELECT * FROM test_account_settings WHERE id = 1'
-                    ).fetchone()
+                    test_settings = get_test_account_settings()
                     
                     if test_settings and test_settings['is_enabled']:
                         # Создаем тестовый аккаунт
@@ -1299,29 +3711,17 @@ def handle_stat_command(message, telegram_bot):
                             # Генерируем email для тестового аккаунта
                             test_email = f"{tgid}@vpn.syslab.space"
                             
-                            # олучаем настройки панели
-                            panel_settings = get_settings()
-                            
                             # Поучаем первый оступный inbound
-                            session = requests.Session()
-                            login_response = session.post(
-                                f"{panel_settings['panel_url']}/login",
-                                data={'username': panel_settings['username'], 
-                                      'password': panel_settings['password']}
-                            )
-                            
-                            if login_response.status_code != 200:
+                            panel = get_panel_client()
+                            try:
+                                snapshot = panel.inbounds.get()
+                            except PanelAuthError:
                                 raise Exception("Ошибка авторизации в панели")
                             
-                            inbounds_response = session.get(
-                                f"{panel_settings['panel_url']}/panel/api/inbounds/list"
-                            )
-                            inbounds_data = inbounds_response.json()
-                            
-                            if not inbounds_data['success'] or not inbounds_data['obj']:
+                            if not snapshot.inbounds:
                                 raise Exception("Не найдены доступны inbound")
                             
-                            inbound_id = inbounds_data['obj'][0]['id']
+                            inbound_id = snapshot.inbounds[0]['id']
                             
                             # Создаем клиента в панели
                             client_id = str(uuid.uuid4())
@@ -1346,13 +3746,15 @@ def handle_stat_command(message, telegram_bot):
                             }
                             
                             # Добавляем клиента в пнель
-                            add_response = session.post(
-                                f"{panel_settings['panel_url']}/panel/api/inbounds/addClient",
+                            add_response = panel.post(
+                                '/panel/api/inbounds/addClient',
                                 json=client_data
                             )
                             
                             if not add_response.json()['success']:
                                 raise Exception("Ошибка создания тестового аккаунта")
+
+                            panel.inbounds.invalidate()
                             
                             # Сохраняем данные в локальной базе
                             db.execute(
@@ -1369,7 +3771,7 @@ def handle_stat_command(message, telegram_bot):
                                 f"Лимит трафика: {'∞' if test_settings['traffic_gb'] == 0 else str(test_settings['traffic_gb']) + ' GB'}\n\n"
                                 f"Испольуйте команд /stat для получения ссылки подключения."
                             )
-                            telegram_bot.send_message(message.chat.id, message_text)
+                            telegram_sender.send(message.chat.id, message_text)
                             return
                             
                         except Exception as e:
@@ -1377,165 +3779,109 @@ def handle_stat_command(message, telegram_bot):
                             error_message = get_bot_message('tgid_not_found')
                             if not error_message:
                                 error_message = "Ваш Telegram ID не найден в базе. Обратитесь к администратору."
-                            telegram_bot.send_message(message.chat.id, error_message)
+                            telegram_sender.send(message.chat.id, error_message)
                             return
                     else:
                         error_message = get_bot_message('tgid_not_found')
                         if not error_message:
                             error_message = "Ваш Telegram ID не найден в базе. Обртитесь к администратору."
-                        telegram_bot.send_message(message.chat.id, error_message)
+                        telegram_sender.send(message.chat.id, error_message)
                         return
                 else:
-                    # Получаем данные клиента из панели
-                    panel_settings = get_settings()
-                    session = requests.Session()
-                    
-                    # Логин
-                    login_response = session.post(
-                        f"{panel_settings['panel_url']}/login",
-                        data={'username': panel_settings['username'], 'password': panel_settings['password']}
-                    )
-                    
-                    if login_response.status_code != 200:
-                        telegram_bot.send_message(message.chat.id, "Ошибка получения данных")
-                        return
-                    
-                    # Получаем список клиентов
-                    clients_response = session.get(f"{panel_settings['panel_url']}/panel/api/inbounds/list")
-                    clients_data = clients_response.json()
-                    
-                    if not clients_data['success']:
-                        telegram_bot.send_message(message.chat.id, "Ошибка получения данных")
+                    # Получаем список клиентов из панели
+                    try:
+                        snapshot = get_inbound_snapshot()
+                    except PanelError:
+                        telegram_sender.send(message.chat.id, "Ошибка получения данных")
                         return
                     
                     # Ищем клиента по email
                     email = client_data['email']
-                    client_found = False
                     
-                    for inbound in clients_data['obj']:
-                        if client_found:
-                            break
-                        
-                        for client in inbound['clientStats']:
-                            if client['email'] == email:
-                                client_found = True
-                                # Проверяем срок действия подписки
-                                if client['expiryTime'] and client['expiryTime'] != '0':
-                                    current_time = datetime.now().timestamp() * 1000
-                                    time_left = float(client['expiryTime']) - current_time
-                                    
-                                    if time_left <= 0:
-                                        # Получаем настройки для создания платежа
-                                        settings = get_telegram_settings()
-                                        if settings and 'payment_amount' in dict(settings):  # Изменено здесь
-                                            # Создаем клавиатуру с кнопками
-                                            markup = telebot.types.InlineKeyboardMarkup()
-                                            markup.row(
-                                                telebot.types.InlineKeyboardButton("Да", callback_data=f"create_payment:{email}:{inbound['id']}"),
-                                                telebot.types.InlineKeyboardButton("Нет", callback_data="reject_payment")
-                                            )
-                                            
-                                            # Формируем сообщение
-                                            message_text = (
-                                                f"📊 Статистика пользователя: {email}\n\n"
-                                                f"⚠️ Подписка недействительна (срок действия истек)\n\n"
-                                                "Созать счет для продления?"
-                                            )
-                                            
-                                            telegram_bot.send_message(message.chat.id, message_text, reply_markup=markup)
-                                            return
-                                
-                                # Формируем обычное сообщение со статистикой
-                                traffic_up = float(client['up']) / (1024 * 1024 * 1024)
-                                traffic_down = float(client['down']) / (1024 * 1024 * 1024)
-                                
-                                message_text = (
-                                    f"📊 Статистика пользователя: {email}\n\n"
-                                    f"📤 Отправлено: {traffic_up:.2f} GB\n"
-                                    f"📥 Скачано: {traffic_down:.2f} GB\n"
-                                )
-                                
-                                if client['total'] > 0:
-                                    total_gb = float(client['total']) / (1024 * 1024 * 1024)
-                                    message_text += f"💾 Лимит трфка: {total_gb:.2f} GB\n"
-                                else:
-                                    message_text += "💾 Лимит трафика: ∞\n"
-                                
-                                if client['expiryTime'] and client['expiryTime'] != '0':
-                                    current_time = datetime.now().timestamp() * 1000
-                                    time_left = float(client['expiryTime']) - current_time
-                                    
-                                    if time_left <= 0:
-                                        message_text += "⏳ Подписка недействительна (срок действия истек)\n\n"
-                                    else:
-                                        days_left = int(time_left / (1000 * 60 * 60 * 24))
-                                        hours_left = int((time_left % (1000 * 60 * 60 * 24)) / (1000 * 60 * 60))
-                                        
-                                        if days_left > 0:
-                                            message_text += f"⏳ До окончания подписки: {days_left} дн. {hours_left} ч.\n\n"
-                                        elif hours_left > 0:
-                                            message_text += f"⏳ До окончания подписки: {hours_left} ч.\n\n"
-                                else:
-                                    message_text += "⏳ Срок действия: бессрочно\n\n"
-
-                                # Добавляем получение ссылки для подключения
-                                settings_json = json.loads(inbound['settings'])
-                                stream_settings = json.loads(inbound['streamSettings'])
-                                
-                                # Извлекаем домен из URL панели
-                                panel_url = panel_settings['panel_url']
-                                domain_part = panel_url.split('://')[-1]
-                                domain = domain_part.split('/')[0].split(':')[0]
-                                
-                                # Ищем клиента по email для получения ID и flow
-                                client_id = None
-                                client_flow = None
-                                for c in settings_json.get('clients', []):
-                                    if c['email'] == email:
-                                        client_id = c['id']
-                                        client_flow = c.get('flow', 'xtls-rprx-vision')
-                                        break
-                                
-                                if client_id:
-                                    # Полуаем параметры для ссылки
-                                    tcp = stream_settings.get('network', '')
-                                    reality = stream_settings.get('security', '')
-                                    reality_settings = stream_settings.get('realitySettings', {})
-                                    
-                                    pbk = reality_settings.get('publicKey', '')
-                                    if not pbk:
-                                        pbk = stream_settings.get('realitySettings', {}).get('settings', {}).get('publicKey', '')
-                                    
-                                    sid = reality_settings.get('shortIds', [''])[0]
-                                    server_name = reality_settings.get('serverNames', [''])[0]
-                                    port = inbound.get('port', '')
-                                    
-                                    # Формируем ссылку
-                                    params = [
-                                        f"type={tcp}",
-                                        f"security={reality}",
-                                        f"pbk={pbk}",
-                                        "fp=chrome",
-                                        f"sni={server_name}",
-                                        f"sid={sid}",
-                                        "spx=%2F"
-                                    ]
-                                    
-                                    if client_flow:
-                                        params.append(f"flow={client_flow}")
+                    record = snapshot.find_client(email)
+                    client_found = record is not None and record.stats is not None
+                    
+                    if client_found:
+                        inbound = record.inbound
+                        client = record.stats
+
+                        # Проверяем срок действия подписки
+                        if client['expiryTime'] and client['expiryTime'] != '0':
+                            current_time = datetime.now().timestamp() * 1000
+                            time_left = float(client['expiryTime']) - current_time
+                            
+                            if time_left <= 0:
+                                # Получаем настройки для создания платежа
+                                settings = get_telegram_settings()
+                                if settings and 'payment_amount' in dict(settings):  # Изменено здесь
+                                    # Создаем клавиатуру с кнопками
+                                    markup = telebot.types.InlineKeyboardMarkup()
+                                    markup.row(
+                                        telebot.types.InlineKeyboardButton("Да", callback_data=f"create_payment:{email}:{inbound['id']}"),
+                                        telebot.types.InlineKeyboardButton("Нет", callback_data="reject_payment")
+                                    )
                                     
-                                    link = f"vless://{client_id}@{domain}:{port}?{'&'.join(params)}#vless2-{email}"
+                                    # Формируем сообщение
+                                    message_text = (
+                                        f"📊 Статистика пользователя: {email}\n\n"
+                                        f"⚠️ Подписка недействительна (срок действия истек)\n\n"
+                                        "Созать счет для продления?"
+                                    )
                                     
-                                    # Добавляем ссылку в сообщение
-                                    message_text += f"🔗 Ссылка для подключения:\n<code>{link}</code>"
+                                    stat_cache.put(tgid, email, message_text, reply_markup=markup)
+                                    telegram_sender.send(message.chat.id, message_text, reply_markup=markup)
+                                    return
+                        
+                        # Формируем обычное сообщение со статистикой
+                        traffic_up = float(client['up']) / (1024 * 1024 * 1024)
+                        traffic_down = float(client['down']) / (1024 * 1024 * 1024)
+                        
+                        message_text = (
+                            f"📊 Статистика пользователя: {email}\n\n"
+                            f"📤 Отправлено: {traffic_up:.2f} GB\n"
+                            f"📥 Скачано: {traffic_down:.2f} GB\n"
+                        )
+                        
+                        if client['total'] > 0:
+                            total_gb = float(client['total']) / (1024 * 1024 * 1024)
+                            message_text += f"💾 Лимит трфка: {total_gb:.2f} GB\n"
+                        else:
+                            message_text += "💾 Лимит трафика: ∞\n"
+                        
+                        if client['expiryTime'] and client['expiryTime'] != '0':
+                            current_time = datetime.now().timestamp() * 1000
+                            time_left = float(client['expiryTime']) - current_time
+                            
+                            if time_left <= 0:
+                                message_text += "⏳ Подписка недействительна (срок действия истек)\n\n"
+                            else:
+                                days_left = int(time_left / (1000 * 60 * 60 * 24))
+                                hours_left = int((time_left % (1000 * 60 * 60 * 24)) / (1000 * 60 * 60))
                                 
-                                # Отправляем сообщение с поддержкой HTML
-                                telegram_bot.send_message(message.chat.id, message_text, parse_mode='HTML')
-                                break
-                    
+                                if days_left > 0:
+                                    message_text += f"⏳ До окончания подписки: {days_left} дн. {hours_left} ч.\n\n"
+                                elif hours_left > 0:
+                                    message_text += f"⏳ До окончания подписки: {hours_left} ч.\n\n"
+                        else:
+                            message_text += "⏳ Срок действия: бессрочно\n\n"
+
+                        # Добавляем ссылки для подключения: по одной на каждый узел клиента
+                        links = snapshot.links.client_links(email)
+                        if len(links) == 1:
+                            message_text += f"🔗 Ссылка для подключения:\n<code>{links[0][1]}</code>"
+                        elif links:
+                            message_text += "🔗 Ссылки для подключения:\n"
+                            message_text += "\n".join(f"{host}:\n<code>{link}</code>" for host, link in links)
+                        
+                        # Отправляем сообщение с поддержкой HTML
+                        stat_cache.put(tgid, email, message_text, expiry_time=client['expiryTime'],
+                                       traffic_used=float(client['up']) + float(client['down']), traffic_total=client['total'],
+                                       parse_mode='HTML')
+                        telegram_sender.send(message.chat.id, message_text, parse_mode='HTML')
+
                     if not client_found:
                         print(f"Client stats not found for email: {email}")
-                        telegram_bot.send_message(message.chat.id, "Ошибка 5555")
+                        telegram_sender.send(message.chat.id, "Ошибка 5555")
                         
                         # Получаем настройки для создания платежа
                         settings = get_telegram_settings()
@@ -1548,7 +3894,7 @@ def handle_stat_command(message, telegram_bot):
                             )
                             
                             # Отправляем сообщение с кнопками
-                            telegram_bot.send_message(
+                            telegram_sender.send(
                                 message.chat.id, 
                                 f"{message_text}\nСоздать счет для продления?", 
                                 parse_mode='HTML',
@@ -1560,117 +3906,323 @@ def handle_stat_command(message, telegram_bot):
                 db.close()
                 
     except Exception as e:
-        print(f"Error in /stat command: {str(e)}")
-        telegram_bot.send_message(message.chat.id, "Произошла ошибка при получении статистики")
+        print(f"Error in /stat command: {str(e)}")
+        telegram_sender.send(message.chat.id, "Произошла ошибка при получении статистики")
+
+def get_update_chat_id(update):
+    """Чат, к которому относится обновление Telegram, или None"""
+    for message in (update.message, update.edited_message, update.channel_post):
+        if message is not None:
+            return message.chat.id
+    if update.callback_query is not None:
+        if update.callback_query.message is not None:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    return None
+
+class UpdateDispatcher:
+    """
+    Выполняет обработчики обновлений Telegram в ограниченном пуле потоков.
+
+    Обновления одного чата обрабатываются строго по очереди, разные чаты - параллельно.
+    Если обработчик не уложился в timeout, чат освобождается для следующего обновления.
+    Сроки всех обработчиков отслеживает один сторожевой поток. Остановить сам
+    обработчик нельзя: он доработает в фоне и будет виден в in_flight.
+    """
+
+    def __init__(self, workers=TELEGRAM_UPDATE_WORKERS, capacity=TELEGRAM_UPDATE_QUEUE_SIZE,
+                 timeout=TELEGRAM_HANDLER_TIMEOUT):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='telegram-update')
+        self.capacity = capacity
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.chats = {}  # чат -> очередь обновлений, ждущих завершения текущего
+        self.deadlines = []  # куча (срок, порядковый номер, чат, обновление, состояние)
+        self.sequence = itertools.count()
+        self.wakeup = threading.Condition(self.lock)
+        self.watchdog = None
+
+        self.queued = 0
+        self.in_flight = 0
+        self.processed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.rejected = 0
+        self.latencies = deque(maxlen=1000)
+
+    def submit(self, bot, update):
+        """
+        Ставит обновление в очередь обработки.
+
+        Returns:
+            bool: False если очередь заполнена и обновление не принято
+        """
+        chat_id = get_update_chat_id(update)
+        key = chat_id if chat_id is not None else f'update:{update.update_id}'
+        item = (bot, update, time.monotonic())
+
+        with self.lock:
+            if self.queued >= self.capacity:
+                self.rejected += 1
+                return False
+            self.queued += 1
+
+            pending = self.chats.get(key)
+            if pending is not None:
+                # В этом чате уже выполняется обработчик, ждем его завершения
+                pending.append(item)
+                return True
+            self.chats[key] = deque()
+
+        self.executor.submit(self._run, key, item)
+        return True
+
+    def _run(self, key, item):
+        bot, update, received_at = item
+        state = {'released': False}
+
+        with self.lock:
+            self.queued -= 1
+            self.in_flight += 1
+            heapq.heappush(self.deadlines, (time.monotonic() + self.timeout, next(self.sequence), key, update, state))
+            if self.watchdog is None or not self.watchdog.is_alive():
+                self.watchdog = threading.Thread(target=self._watch, name='telegram-update-watchdog', daemon=True)
+                self.watchdog.start()
+            self.wakeup.notify()
+
+        failed = False
+        try:
+            bot.process_new_updates([update])
+        except Exception as e:
+            failed = True
+            print(f"Error processing Telegram update {update.update_id}: {str(e)}")
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+                self.latencies.append(time.monotonic() - received_at)
+                if failed:
+                    self.failed += 1
+                else:
+                    self.processed += 1
+                released = state['released']
+                state['released'] = True
+
+        if not released:
+            self._next(key)
+
+    def _watch(self):
+        """Освобождает чаты, обработчики которых не уложились в timeout"""
+        while True:
+            expired = []
+            with self.lock:
+                now = time.monotonic()
+                # Сроки завершившихся обработчиков просто выбрасываются
+                while self.deadlines and (self.deadlines[0][0] <= now or self.deadlines[0][4]['released']):
+                    _, _, key, update, state = heapq.heappop(self.deadlines)
+                    if not state['released']:
+                        state['released'] = True
+                        self.timed_out += 1
+                        expired.append((key, update))
+                if not expired:
+                    self.wakeup.wait(self.deadlines[0][0] - now if self.deadlines else None)
+                    continue
+
+            for key, update in expired:
+                print(f"Telegram update {update.update_id} handler timed out after {self.timeout}s")
+                self._next(key)
+
+    def _next(self, key):
+        with self.lock:
+            pending = self.chats[key]
+            if not pending:
+                del self.chats[key]
+                return
+            item = pending.popleft()
+        self.executor.submit(self._run, key, item)
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            return {
+                'queued': self.queued,
+                'in_flight': self.in_flight,
+                'capacity': self.capacity,
+                'active_chats': len(self.chats),
+                'processed': self.processed,
+                'failed': self.failed,
+                'timed_out': self.timed_out,
+                'rejected': self.rejected,
+                'latency_avg_ms': round(sum(latencies) / len(latencies) * 1000, 1) if latencies else None,
+                'latency_p95_ms': round(latencies[int(len(latencies) * 0.95)] * 1000, 1) if latencies else None,
+                'latency_max_ms': round(latencies[-1] * 1000, 1) if latencies else None,
+            }
+
+def save_image_file_id(image_path, file_id):
+    """Запоминает file_id загруженной картинки /start, если картинку за это время не сменили"""
+    db = get_db()
+    try:
+        updated = db.execute('''UPDATE bot_messages SET image_file_id = ? 
+                               WHERE message_type = ? AND image_path = ? AND image_file_id IS NOT ?''',
+                            [file_id, 'start_message', image_path, file_id]).rowcount
+        # Картинку сменили или file_id уже сохранен - остальным процессам перечитывать нечего
+        if not updated:
+            db.rollback()
+            return
+        bump_settings_version(db)
+        db.commit()
+    finally:
+        db.close()
+    settings_cache.invalidate()
+
+def send_start_photo(chat_id, start_message):
+    """
+    Отправляет картинку приветствия /start через telegram_sender.
+
+    Файл загружается в Telegram один раз, дальше картинка отправляется по file_id.
+    """
+    if start_message['image_file_id']:
+        try:
+            return telegram_sender.send_photo(chat_id, start_message['image_file_id'],
+                                              caption=start_message['message_text'],
+                                              parse_mode='HTML').result(TELEGRAM_SEND_TIMEOUT)
+        except ApiTelegramException as e:
+            # file_id действует только для бота, который загрузил файл (например, сменился токен)
+            print(f"Cached start image rejected, uploading again: {str(e)}")
+
+    with open(os.path.join('static', start_message['image_path']), 'rb') as photo:
+        # Файл закрывается только после отправки
+        sent = telegram_sender.send_photo(chat_id, photo, caption=start_message['message_text'],
+                                          parse_mode='HTML').result(TELEGRAM_SEND_TIMEOUT)
+
+    # Берем самый крупный вариант, чтобы при повторной отправке картинка не теряла в качестве
+    save_image_file_id(start_message['image_path'], sent.photo[-1].file_id)
+    return sent
+
+# Обработчики обновлений Telegram, общие для polling и webhook
+telegram_dispatcher = UpdateDispatcher()
+
+def dispatch_telegram_update(bot, update):
+    """Передает обновление обработчикам бота, False если очередь заполнена"""
+    return telegram_dispatcher.submit(bot, update)
+
+@app.route('/telegram/webhook', methods=['POST'])
+def telegram_webhook():
+    """
+    Прием обновлений Telegram в режиме webhook.
+
+    Маршрут публичный: подлинность проверяется по заголовку
+    X-Telegram-Bot-Api-Secret-Token. Telegram получает ответ сразу,
+    обработчики команд выполняются в telegram_dispatcher.
+    """
+    bot = telegram_bot
+    settings = get_telegram_settings()
+    if bot is None or bot_mode != 'webhook' or not settings or not settings['webhook_secret']:
+        return 'Webhook не активен', 404
+
+    secret_token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(secret_token.encode('utf-8'), settings['webhook_secret'].encode('utf-8')):
+        return 'Invalid secret token', 403
+
+    try:
+        update = telebot.types.Update.de_json(request.get_data(as_text=True))
+    except Exception as e:
+        print(f"Invalid Telegram update: {str(e)}")
+        return 'Bad request', 400
+
+    # При заполненной очереди Telegram повторит доставку позже
+    if not dispatch_telegram_update(bot, update):
+        return 'Too many updates', 503
+    return 'OK', 200
 
 def handle_telegram_commands():
-    global telegram_bot, bot_thread, bot_running
+    global telegram_bot, bot_thread, bot_stop_event, bot_mode, applied_telegram_settings
     settings = get_telegram_settings()
+    applied_telegram_settings = dict(settings) if settings else None
     if not settings or not settings['is_enabled']:
+        stop_telegram_bot()
+        return
+    
+    use_webhook = settings['update_mode'] == 'webhook' and settings['webhook_url']
+    if not use_webhook and not leader_elector.is_leader:
+        # getUpdates опрашивает только лидер, иначе процессы забирали бы обновления друг у друга
+        stop_telegram_bot()
         return
     
     try:
         # Останавливаем предыдущий экземпляр бота
         if telegram_bot is not None:
             print("Stopping previous bot instance...")
-            bot_running = False
-            telegram_bot.stop_polling()
-            if bot_thread and bot_thread.is_alive():
-                bot_thread.join(timeout=5)
-            telegram_bot = None
-            bot_thread = None
+            stop_telegram_bot()
             print("Previous bot instance stopped")
         
-        # Создаем новый экземпляр бота
-        telegram_bot = telebot.TeleBot(settings['bot_token'])
+        # Бот для приема команд - тот же экземпляр, через который идет отправка
+        bot = telegram_sender.get_bot()
         print("Created new bot instance")
         
-        # Очищаем все обработчики еред добавлением новых
-        telegram_bot.message_handlers = []
-        telegram_bot.callback_query_handlers = []
+        # Обработчики собираются на отдельном экземпляре и подменяются целиком,
+        # чтобы диспетчер не застал пустые списки посреди обработки обновлений
+        handlers = telebot.TeleBot(bot.token, threaded=False)
         
         # Регистрируем обработчики команд
-        @telegram_bot.message_handler(commands=['start'])
+        @handlers.message_handler(commands=['start'])
         def send_welcome(message):
             try:
-                with app.app_context():
-                    db = get_db()
+                start_message = settings_cache.get_bot_message('start_message')
+                
+                if not start_message:
+                    start_message = {
+                        'message_text': 'Добро пожаловать! Используйте команду /stat для получения статистики вашего аккаунта.',
+                        'image_path': None,
+                        'show_image': False
+                    }
+                
+                if start_message['image_path'] and start_message['show_image']:
+                    # Отправляем фото с подписью
                     try:
-                        start_message = db.execute(
-                            'SELECT message_text, image_path, show_image FROM bot_messages WHERE message_type = ?',
-                            ['start_message']
-                        ).fetchone()
-                        
-                        if not start_message:
-                            start_message = {
-                                'message_text': 'Добро пожаловать! Используйте команду /stat для получения статистики вашего аккаунта.',
-                                'image_path': None,
-                                'show_image': False
-                            }
-                        
-                        if start_message['image_path'] and start_message['show_image']:
-                            # Отправляем фото с подписью
-                            try:
-                                with open(os.path.join('static', start_message['image_path']), 'rb') as photo:
-                                    telegram_bot.send_photo(
-                                        message.chat.id,
-                                        photo,
-                                        caption=start_message['message_text'],
-                                        parse_mode='HTML'
-                                    )
-                            except Exception as e:
-                                print(f"Error sending photo: {str(e)}")
-                                telegram_bot.send_message(
-                                    message.chat.id, 
-                                    start_message['message_text'],
-                                    parse_mode='HTML'
-                                )
-                        else:
-                            # Отправляем только текст
-                            telegram_bot.send_message(
-                                message.chat.id, 
-                                start_message['message_text'],
-                                parse_mode='HTML'
-                            )
-                    finally:
-                        db.close()
+                        send_start_photo(message.chat.id, start_message)
+                    except Exception as e:
+                        print(f"Error sending photo: {str(e)}")
+                        telegram_sender.send(
+                            message.chat.id, 
+                            start_message['message_text'],
+                            parse_mode='HTML'
+                        )
+                else:
+                    # Отправляем только текст
+                    telegram_sender.send(
+                        message.chat.id, 
+                        start_message['message_text'],
+                        parse_mode='HTML'
+                    )
             except Exception as e:
                 print(f"Error in /start command: {str(e)}")
             
-        @telegram_bot.message_handler(commands=['stat'])
+        @handlers.message_handler(commands=['stat'])
         def send_stats(message):
-            handle_stat_command(message, telegram_bot)
+            handle_stat_command(message)
             
-        @telegram_bot.message_handler(commands=['info'])
+        @handlers.message_handler(commands=['info'])
         def send_info(message):
             try:
-                with app.app_context():
-                    db = get_db()
-                    try:
-                        info_message = db.execute(
-                            'SELECT message_text, is_enabled FROM bot_messages WHERE message_type = ?',
-                            ['info_message']
-                        ).fetchone()
-                        
-                        if info_message and info_message['is_enabled']:
-                            telegram_bot.send_message(
-                                message.chat.id, 
-                                info_message['message_text'],
-                                parse_mode='HTML'
-                            )
-                    finally:
-                        db.close()
+                info_message = settings_cache.get_bot_message('info_message')
+                
+                if info_message and info_message['is_enabled']:
+                    telegram_sender.send(
+                        message.chat.id, 
+                        info_message['message_text'],
+                        parse_mode='HTML'
+                    )
             except Exception as e:
                 print(f"Error in /info command: {str(e)}")
         
         # Добавляем обработчик callback-кнопок
-        @telegram_bot.callback_query_handler(func=lambda call: True)
+        @handlers.callback_query_handler(func=lambda call: True)
         def handle_callback(call):
             try:
                 if call.data == "reject_payment":
                     # Удаляем сообщение с кнопками
-                    telegram_bot.delete_message(call.message.chat.id, call.message.message_id)
-                    telegram_bot.answer_callback_query(call.id, "Операция отменена")
+                    bot.delete_message(call.message.chat.id, call.message.message_id)
+                    bot.answer_callback_query(call.id, "Операция отменена")
                     return
 
                 if call.data.startswith("create_payment:"):
@@ -1681,7 +4233,7 @@ def handle_telegram_commands():
                         # Получаем настройки
                         settings = get_telegram_settings()
                         if not settings or not settings.get('payment_amount'):
-                            telegram_bot.answer_callback_query(call.id, "Ошибка: не настроена сумма платежа")
+                            bot.answer_callback_query(call.id, "Ошибка: не настроена сумма платежа")
                             return
 
                         try:
@@ -1696,7 +4248,7 @@ def handle_telegram_commands():
 
                             if payment.get('success'):
                                 # Удаляем сообщение с кнопками
-                                telegram_bot.delete_message(call.message.chat.id, call.message.message_id)
+                                bot.delete_message(call.message.chat.id, call.message.message_id)
                                 # Отправляем новое сообщение со ссылкой на оплату
                                 message = (
                                     f"💰 Создан счет на оплату\n\n"
@@ -1704,44 +4256,92 @@ def handle_telegram_commands():
                                     f"Дней: 30\n\n"
                                     f"Ссылка для оплаты:\n{payment['payment_url']}"
                                 )
-                                telegram_bot.send_message(call.message.chat.id, message)
-                                telegram_bot.answer_callback_query(call.id, "Счет создан")
+                                telegram_sender.send(call.message.chat.id, message)
+                                bot.answer_callback_query(call.id, "Счет создан")
                             else:
-                                telegram_bot.answer_callback_query(
+                                bot.answer_callback_query(
                                     call.id, 
                                     f"Ошибка создания платежа: {payment.get('error', 'Неизвестная ошибка')}"
                                 )
                         except Exception as e:
                             print(f"Error creating payment: {str(e)}")
-                            telegram_bot.answer_callback_query(
+                            bot.answer_callback_query(
                                 call.id, 
                                 f"Ошибка создания платежа: {str(e)}"
                             )
             except Exception as e:
                 print(f"Error in callback handler: {str(e)}")
                 try:
-                    telegram_bot.answer_callback_query(call.id, "Произошла ошибка")
+                    bot.answer_callback_query(call.id, "Произошла ошибка")
                 except:
                     pass
 
+        bot.message_handlers = handlers.message_handlers
+        bot.callback_query_handlers = handlers.callback_query_handlers
+        telegram_bot = bot
+
+        if use_webhook and not leader_elector.is_leader:
+            # Webhook устанавливает лидер, здесь только принимаем запросы на /telegram/webhook
+            bot_mode = 'webhook'
+            print("Bot handlers registered for webhook requests")
+            return
+
+        if use_webhook:
+            try:
+                # Обновления приходят на /telegram/webhook, Telegram подписывает их секретом
+                bot.set_webhook(
+                    url=settings['webhook_url'],
+                    secret_token=settings['webhook_secret'],
+                    max_connections=TELEGRAM_UPDATE_WORKERS
+                )
+                bot_mode = 'webhook'
+                print(f"Bot webhook set to {settings['webhook_url']}")
+                return
+            except Exception as e:
+                print(f"Error setting webhook, falling back to polling: {str(e)}")
+
+        # getUpdates не работает, пока у бота установлен webhook
+        try:
+            bot.remove_webhook()
+        except Exception as e:
+            print(f"Error removing webhook: {str(e)}")
+        bot_mode = 'polling'
+
         # Запускаем бота в отдельном потоке
+        stop_event = threading.Event()
+        bot_stop_event = stop_event
+
         def run_bot():
             global bot_running
             bot_running = True
             print("Starting bot polling...")
-            while bot_running:
+            while not stop_event.is_set():
                 try:
-                    telegram_bot.polling(none_stop=True, interval=3, timeout=30)
+                    # Смещение общее для всех запусков опроса с этим токеном: после
+                    # перезапуска уже переданные диспетчеру обновления не придут повторно
+                    updates = bot.get_updates(
+                        offset=bot_update_offsets.get(bot.token),
+                        timeout=TELEGRAM_POLL_TIMEOUT + 5,
+                        long_polling_timeout=TELEGRAM_POLL_TIMEOUT
+                    )
+                    for update in updates:
+                        if stop_event.is_set():
+                            # Offset не сдвинут, эти обновления получит новый опрос
+                            break
+                        # Пока очередь обработки заполнена, новые обновления не забираем
+                        accepted = dispatch_telegram_update(bot, update)
+                        while not accepted and not stop_event.wait(0.5):
+                            accepted = dispatch_telegram_update(bot, update)
+                        if not accepted:
+                            break
+                        bot_update_offsets[bot.token] = update.update_id + 1
                 except Exception as e:
                     print(f"Bot polling error: {str(e)}")
-                    if not bot_running:
+                    if stop_event.is_set():
                         break
                     time.sleep(5)
             print("Bot polling stopped")
         
-        if bot_thread and bot_thread.is_alive():
-            bot_thread.join(timeout=5)
-        
         bot_thread = threading.Thread(target=run_bot, daemon=True)
         bot_thread.start()
         print("Bot thread started")
@@ -1750,12 +4350,20 @@ def handle_telegram_commands():
         print(f"Error starting Telegram bot: {str(e)}")
 
 def stop_telegram_bot():
-    global telegram_bot, bot_thread, bot_running
+    global telegram_bot, bot_thread, bot_running, bot_mode
     try:
         if telegram_bot is not None:
             print("Stopping Telegram bot...")
             bot_running = False  # Сигнал для остановки бота
-            telegram_bot.stop_polling()
+            if bot_mode == 'webhook' and leader_elector.is_leader:
+                # Пока бот остановлен, обновления копятся на стороне Telegram.
+                # Ведомый процесс webhook не трогает - запросы принимают другие процессы
+                telegram_bot.remove_webhook()
+            bot_mode = None
+            if bot_stop_event is not None:
+                bot_stop_event.set()
+            # Поток может ждать ответа getUpdates до TELEGRAM_POLL_TIMEOUT секунд,
+            # новые обновления он уже не обработает
             if bot_thread and bot_thread.is_alive():
                 bot_thread.join(timeout=5)
             telegram_bot = None
@@ -1764,26 +4372,24 @@ def stop_telegram_bot():
     except Exception as e:
         print(f"Error in stop_telegram_bot: {str(e)}")
 
-def restart_scheduler():
-    """Функци для перезапуска планировщика с новыми настройками"""
-    global scheduler
-    
-    try:
-        if scheduler and scheduler.running:
-            print("Stopping current scheduler...")
-            scheduler.shutdown()
-            scheduler = None
-            print("Scheduler stopped")
-        
-        print("Starting new scheduler...")
-        init_scheduler()
-        print("Scheduler restarted successfully")
-        
-    except Exception as e:
-        print(f"Error restarting scheduler: {str(e)}")
-        # Если произошла ошибка, пытаемся создать новый планировщик
-        scheduler = None
-        init_scheduler()
+def apply_scheduler_settings(old_settings, new_settings):
+    """
+    Применяет новые настройки Telegram к работающему планировщику.
+
+    Планировщик не пересоздается: у задачи синхронизации меняется только
+    триггер, а при смене notify_days или включении бота она запускается сразу,
+    чтобы пересчитать notify_at в expiry_timeline.
+    """
+    if scheduler is None or not scheduler.running:
+        return
+
+    interval = get_check_interval(new_settings)
+    if get_check_interval(old_settings) != interval:
+        scheduler.reschedule_job('sync_subscriptions', trigger='interval', minutes=interval)
+        print(f"Subscription sync rescheduled to every {interval} minutes")
+
+    if any(old_settings.get(field) != new_settings.get(field) for field in ('notify_days', 'is_enabled')):
+        scheduler.modify_job('sync_subscriptions', next_run_time=datetime.now(utc))
 
 # Переместим маршрут bot_messages после определения всех необходимых функций
 @app.route('/bot_messages', methods=['GET', 'POST'])
@@ -1819,19 +4425,25 @@ def bot_messages():
                 
                 # Получаем текущий путь к изображению
                 current_image = db.execute(
-                    'SELECT image_path FROM bot_messages WHERE message_type = ?',
+                    'SELECT image_path, image_original_path FROM bot_messages WHERE message_type = ?',
                     ['start_message']
                 ).fetchone()
                 
+                def remove_current_image():
+                    # Удаляем и оптимизированную картинку, и исходник
+                    for path in {current_image['image_path'], current_image['image_original_path']}:
+                        if path and os.path.exists(os.path.join('static', path)):
+                            os.remove(os.path.join('static', path))
+                
                 new_image_path = None
                 if 'start_image' in request.files:
                     file = request.files['start_image']
                     if file and file.filename and allowed_file(file.filename):
+                        validate_image(file)
+                        
                         # Удаляем старое изображение если оно есть
-                        if current_image and current_image['image_path']:
-                            old_image_path = os.path.join('static', current_image['image_path'])
-                            if os.path.exists(old_image_path):
-                                os.remove(old_image_path)
+                        if current_image:
+                            remove_current_image()
                         
                         # Сохраняем новое изображение
                         filename = secure_filename(file.filename)
@@ -1839,12 +4451,14 @@ def bot_messages():
                         new_filename = f"{timestamp}_{filename}"
                         file.save(os.path.join(UPLOAD_FOLDER, new_filename))
                         new_image_path = f"uploads/{new_filename}"
+                        
+                        # Пока картинка оптимизируется, /start отправляет исходник
+                        enqueue_job(db, 'optimize_image', {'image_path': new_image_path},
+                                    dedup_key=f"optimize_image:{new_image_path}")
                 
                 # Если выбрано удаление изображения
                 if remove_image and current_image and current_image['image_path']:
-                    old_image_path = os.path.join('static', current_image['image_path'])
-                    if os.path.exists(old_image_path):
-                        os.remove(old_image_path)
+                    remove_current_image()
                     new_image_path = None
                 
                 # Обновляем или создаем запись
@@ -1853,12 +4467,14 @@ def bot_messages():
                 if existing:
                     if new_image_path is not None:
                         db.execute('''UPDATE bot_messages 
-                                    SET message_text = ?, image_path = ?, show_image = ? 
+                                    SET message_text = ?, image_path = ?, image_original_path = NULL,
+                                        image_file_id = NULL, show_image = ? 
                                     WHERE message_type = ?''',
                                  [start_message, new_image_path, show_image, 'start_message'])
                     elif remove_image:
                         db.execute('''UPDATE bot_messages 
-                                    SET message_text = ?, image_path = NULL, show_image = ? 
+                                    SET message_text = ?, image_path = NULL, image_original_path = NULL,
+                                        image_file_id = NULL, show_image = ? 
                                     WHERE message_type = ?''',
                                  [start_message, show_image, 'start_message'])
                     else:
@@ -1904,11 +4520,14 @@ def bot_messages():
                     db.execute('INSERT INTO bot_messages (message_type, message_text, is_enabled) VALUES (?, ?, ?)',
                               ['info_message', info_message, info_enabled])
             
+            bump_settings_version(db)
             db.commit()
+            settings_cache.invalidate()
             flash('Настройки успешно схранены')
             
-            # Перезапускаем бота для применения новых настроек
-            handle_telegram_commands()
+            # Обработчики читают сообщения из settings_cache, остальным процессам
+            # новая версия настроек видна и без перезапуска бота
+            leader_elector.notify_settings_changed()
             
         except Exception as e:
             db.rollback()
@@ -1940,6 +4559,15 @@ def bot_messages():
                          messages=messages,
                          test_settings=test_settings)
 
+def get_check_interval(settings):
+    """Интервал синхронизации подписок в минутах"""
+    if settings.get('check_interval'):
+        interval = int(settings['check_interval'])
+        if settings.get('interval_unit') == 'hours':
+            interval *= 60  # Конвертируем часы в минуты
+        return interval
+    return 60  # По умолчанию 60 минут
+
 def init_scheduler():
     """Инициализация планировщика задач"""
     global scheduler
@@ -1964,31 +4592,36 @@ def init_scheduler():
         # Получаем настройки интервала для проверки подписок
         with app.app_context():
             settings = get_telegram_settings()
-            if settings and settings['check_interval']:
-                interval = int(settings['check_interval'])
-                if settings['interval_unit'] == 'hours':
-                    interval *= 60  # Конвертируем часы в минуты
-            else:
-                interval = 60  # По умолчанию 60 минут
+            interval = get_check_interval(dict(settings) if settings else {})
         
-        # Добавляем задачу проверки подписок
+        # Синхронизация срока клиентов с панелью; сама проверка подписок
+        # ставится на момент ближайшего напоминания (schedule_next_expiry_check)
         scheduler.add_job(
-            func=check_expiring_subscriptions,
+            func=sync_subscriptions,
             trigger='interval',
             minutes=interval,
-            id='check_subscriptions'
+            id='sync_subscriptions',
+            next_run_time=datetime.now(utc)
         )
         
         # Добавляем задачу проверки платежей
         scheduler.add_job(
             func=check_pending_payments,
             trigger='interval',
-            minutes=1,
+            minutes=PAYMENT_CHECK_INTERVAL,
             id='check_payments'
         )
         
+        # Очистка истории очереди задач
+        scheduler.add_job(
+            func=cleanup_jobs,
+            trigger='interval',
+            hours=24,
+            id='cleanup_jobs'
+        )
+        
         scheduler.start()
-        print(f"Scheduler started. Checking subscriptions every {interval} minutes and payments every minute.")
+        print(f"Scheduler started. Syncing subscriptions every {interval} minutes and checking payments every {PAYMENT_CHECK_INTERVAL} minutes.")
         
         return True
         
@@ -1999,7 +4632,418 @@ def init_scheduler():
             scheduler = None
         return False
 
+def stop_scheduler():
+    """Останавливает планировщик, не дожидаясь выполняющихся задач"""
+    global scheduler
+    if scheduler and scheduler.running:
+        scheduler.shutdown(wait=False)
+        print("Scheduler stopped")
+    scheduler = None
+
+class LeaderElector:
+    """
+    Выбор процесса-лидера через аренду строки в таблице leader_lease.
+
+    Лидер продлевает аренду каждые heartbeat_interval секунд. Если он упал
+    или завис, по истечении lease_seconds аренду забирает другой процесс.
+    Планировщик и опрос Telegram работают только у лидера, остальные процессы
+    обслуживают HTTP. Заодно каждый процесс следит за версией настроек и
+    применяет изменения, сделанные в других процессах.
+    """
+
+    def __init__(self, name, on_leader, on_follower, on_settings_changed,
+                 lease_seconds=LEADER_LEASE_SECONDS, heartbeat_interval=LEADER_HEARTBEAT_INTERVAL):
+        self.name = name
+        self.on_leader = on_leader
+        self.on_follower = on_follower
+        self.on_settings_changed = on_settings_changed
+        self.lease_seconds = lease_seconds
+        self.heartbeat_interval = heartbeat_interval
+        self.holder_id = None
+        self._is_leader = False
+        self._renewed_at = 0
+        self._settings_version = None
+        self._wake_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def is_leader(self):
+        return self._is_leader
+
+    def _try_acquire(self):
+        """Продлевает свою аренду или забирает истекшую чужую"""
+        now = time.time()
+        db = get_db()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute('''INSERT INTO leader_lease (name, holder, expires_at) VALUES (?, ?, ?)
+                         ON CONFLICT (name) DO UPDATE SET
+                             holder = excluded.holder,
+                             expires_at = excluded.expires_at,
+                             acquired_at = CASE WHEN leader_lease.holder = excluded.holder
+                                                THEN leader_lease.acquired_at ELSE CURRENT_TIMESTAMP END
+                         WHERE leader_lease.holder = excluded.holder OR leader_lease.expires_at < ?''',
+                      [self.name, self.holder_id, now + self.lease_seconds, now])
+            holder = db.execute('SELECT holder FROM leader_lease WHERE name = ?', [self.name]).fetchone()['holder']
+            db.commit()
+            return holder == self.holder_id
+        finally:
+            db.close()
+
+    def _release(self):
+        db = get_db()
+        try:
+            db.execute('DELETE FROM leader_lease WHERE name = ? AND holder = ?', [self.name, self.holder_id])
+            db.commit()
+        finally:
+            db.close()
+
+    def _read_settings_version(self):
+        db = get_db()
+        try:
+            return SettingsCache._read_version(db)
+        finally:
+            db.close()
+
+    def _heartbeat(self):
+        try:
+            leader = self._try_acquire()
+            if leader:
+                self._renewed_at = time.monotonic()
+        except Exception as e:
+            print(f"Error renewing leader lease: {str(e)}")
+            # Аренду не продлили: уступаем раньше, чем ее сможет забрать другой процесс
+            leader = (self._is_leader and
+                      time.monotonic() - self._renewed_at < self.lease_seconds - self.heartbeat_interval)
+
+        if leader and not self._is_leader:
+            self._is_leader = True
+            print(f"Process {self.holder_id} is now the leader")
+            self.on_leader()
+        elif not leader and self._is_leader:
+            self._is_leader = False
+            print(f"Process {self.holder_id} lost leadership")
+            self.on_follower()
+
+        try:
+            version = self._read_settings_version()
+        except Exception as e:
+            print(f"Error reading settings version: {str(e)}")
+            return
+        if self._settings_version is not None and version != self._settings_version:
+            self.on_settings_changed()
+        self._settings_version = version
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self._wake_event.wait(self.heartbeat_interval)
+            self._wake_event.clear()
+            if self._stop_event.is_set():
+                break
+            try:
+                self._heartbeat()
+            except Exception as e:
+                print(f"Error in leader heartbeat: {str(e)}")
+
+    def start(self):
+        """Первая попытка стать лидером выполняется сразу, дальше - в фоновом потоке"""
+        if self._thread is not None:
+            return
+        # Идентификатор берется после fork, у каждого воркера свой
+        self.holder_id = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+        self._settings_version = self._read_settings_version()
+        self._stop_event.clear()
+        self._heartbeat()
+        if not self._is_leader:
+            print(f"Process {self.holder_id} started as a follower")
+            self.on_follower()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def notify_settings_changed(self):
+        """Проверить версию настроек сейчас, не дожидаясь очередного продления"""
+        self._wake_event.set()
+
+    def stop(self):
+        """Останавливает продление и отдает аренду, чтобы другой процесс не ждал ее истечения"""
+        self._stop_event.set()
+        self._wake_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        if self._is_leader:
+            self._is_leader = False
+            try:
+                self._release()
+            except Exception as e:
+                print(f"Error releasing leader lease: {str(e)}")
+
+def start_leader_services():
+    """Процесс стал лидером: запускаем планировщик и прием обновлений Telegram"""
+    init_scheduler()
+    handle_telegram_commands()
+
+def start_follower_services():
+    """Процесс стал ведомым: планировщик останавливается, бот остается только для webhook"""
+    stop_scheduler()
+    handle_telegram_commands()
+
+def reload_background_services():
+    """
+    Применяет настройки, измененные в любом из процессов.
+
+    В планировщике переставляются только затронутые задачи. Бот перезапускается
+    лишь при смене полей из BOT_RESTART_FIELDS, иначе опрос продолжается:
+    шаблоны и сообщения бота обработчики и так читают из settings_cache.
+    """
+    global applied_telegram_settings
+    settings_cache.invalidate()
+    settings = get_telegram_settings()
+    new_settings = dict(settings) if settings else {}
+    old_settings = applied_telegram_settings or {}
+    if new_settings == old_settings:
+        return
+
+    if leader_elector.is_leader:
+        apply_scheduler_settings(old_settings, new_settings)
+
+    if any(old_settings.get(field) != new_settings.get(field) for field in BOT_RESTART_FIELDS):
+        handle_telegram_commands()
+    else:
+        applied_telegram_settings = new_settings
+        print("Telegram settings applied without restarting the bot")
+
+leader_elector = LeaderElector(
+    'background_services',
+    on_leader=start_leader_services,
+    on_follower=start_follower_services,
+    on_settings_changed=reload_background_services
+)
+
+def start_background_services():
+    """Очередь задач работает в каждом процессе, планировщик и бот - только у лидера"""
+    start_job_workers()
+    leader_elector.start()
+
+def stop_background_services():
+    # Сначала отдаем аренду, чтобы лидером сразу стал другой процесс
+    leader_elector.stop()
+    stop_scheduler()
+    stop_telegram_bot()
+    stop_job_workers()
+
+def plan_notification_delays(db, count):
+    """
+    Распределяет count уведомлений по окну рассылки [сейчас, сейчас + NOTIFY_DELIVERY_WINDOW].
+
+    В каждой минуте окна учитываются уведомления, уже запланированные прошлыми
+    проверками, новые занимают только свободные места до NOTIFY_PER_MINUTE_CAP
+    и раскладываются по ним равномерно, внутри минуты время выбирается случайно.
+    За пределы окна план выходит, только если в окне не осталось мест.
+    План хранится в run_at задач и переживает перезапуск.
+
+    Returns:
+        list: Задержки в секундах от текущего момента, по возрастанию
+    """
+    if not count:
+        return []
+
+    taken = {
+        row['minute']: row['planned']
+        for row in db.execute(SQL_PLANNED_NOTIFICATIONS)
+    }
+
+    # Свободные места по минутам: минута повторяется столько раз, сколько в ней мест
+    slots = []
+    minute = 0
+    while minute < NOTIFY_DELIVERY_WINDOW or len(slots) < count:
+        slots.extend([minute] * max(0, NOTIFY_PER_MINUTE_CAP - taken.get(minute, 0)))
+        minute += 1
+
+    return sorted(slots[index * len(slots) // count] * 60 + random.randint(0, 59) for index in range(count))
+
+def get_notify_days():
+    settings = get_telegram_settings()
+    if settings and settings['notify_days']:
+        return int(settings['notify_days'])
+    return 3
+
+def sync_expiry_timeline(snapshot, notify_days):
+    """
+    Приводит expiry_timeline в соответствие со снимком панели.
+
+    Записываются только клиенты, у которых изменился срок (или notify_days),
+    бессрочные, истекшие и удаленные клиенты из таблицы убираются.
+
+    Returns:
+        tuple: (число обновленных записей, число удаленных)
+    """
+    now_ms = datetime.now().timestamp() * 1000
+    db = get_db()
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        # Ключ - (email, inbound_id): на каждом узле у клиента свой срок
+        current = {
+            (row['email'], row['inbound_id']): (row['expiry_time'], row['notify_days'])
+            for row in db.execute('SELECT email, inbound_id, expiry_time, notify_days FROM expiry_timeline')
+        }
+
+        changed = []
+        active = set()
+        # Нужен только срок, поэтому clientStats читаются напрямую, без ClientStatsView
+        for inbound in snapshot.inbounds:
+            inbound_id = str(inbound['id'])
+            for client in inbound.get('clientStats') or []:
+                expiry_time = int(client.get('expiryTime') or 0)
+                if expiry_time <= now_ms:
+                    continue
+                key = (client['email'], inbound_id)
+                active.add(key)
+                if current.get(key) != (expiry_time, notify_days):
+                    changed.append(key + (expiry_time, notify_days, expiry_time - notify_days * MS_PER_DAY))
+
+        # Клиентов недоступного узла не удаляем: их просто нет в этом снимке
+        removed = [key for key in current
+                   if key not in active and split_inbound_id(key[1])[0] not in snapshot.unavailable]
+
+        db.executemany('''INSERT INTO expiry_timeline (email, inbound_id, expiry_time, notify_days, notify_at, updated_at)
+                         VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                         ON CONFLICT (email, inbound_id) DO UPDATE SET
+                             expiry_time = excluded.expiry_time,
+                             notify_days = excluded.notify_days,
+                             notify_at = excluded.notify_at,
+                             updated_at = CURRENT_TIMESTAMP''', changed)
+        db.executemany('DELETE FROM expiry_timeline WHERE email = ? AND inbound_id = ?', removed)
+        db.commit()
+        return len(changed), len(removed)
+    finally:
+        db.close()
+
+def update_expiry_timeline(email, inbound_id, expiry_time):
+    """Обновляет срок одного клиента после продления, не дожидаясь синхронизации"""
+    notify_days = get_notify_days()
+    db = get_db()
+    try:
+        db.execute('''INSERT INTO expiry_timeline (email, inbound_id, expiry_time, notify_days, notify_at, updated_at)
+                     VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                     ON CONFLICT (email, inbound_id) DO UPDATE SET
+                         expiry_time = excluded.expiry_time,
+                         notify_days = excluded.notify_days,
+                         notify_at = excluded.notify_at,
+                         updated_at = CURRENT_TIMESTAMP''',
+                  [email, str(inbound_id), int(expiry_time), notify_days,
+                   int(expiry_time) - notify_days * MS_PER_DAY])
+        db.commit()
+    finally:
+        db.close()
+
+def load_due_timeline(db, now_ms):
+    """
+    Клиенты, которым пора отправить напоминание.
+
+    Заодно берутся те, чей срок наступит в ближайшие EXPIRY_CHECK_COALESCE секунд:
+    напоминание на несколько минут раньше лучше отдельного пробуждения ради него.
+    """
+    return db.execute(SQL_DUE_TIMELINE, [now_ms + EXPIRY_CHECK_COALESCE * 1000, now_ms]).fetchall()
+
+def refresh_due_timeline(db, snapshot, due, notify_days):
+    """
+    Сверяет с панелью только клиентов, которым пора напомнить.
+
+    Продленные в панели клиенты получают новый notify_at, удаленные и истекшие
+    убираются из expiry_timeline. Полная сверка - в sync_subscriptions.
+    """
+    now_ms = datetime.now().timestamp() * 1000
+    changed = []
+    removed = []
+    for row in due:
+        if split_inbound_id(row['inbound_id'])[0] in snapshot.unavailable:
+            continue
+        record = snapshot.find_client(row['email'], row['inbound_id'])
+        client = (record.stats or record.settings) if record else None
+        expiry_time = int(client.get('expiryTime') or 0) if client else 0
+        if expiry_time <= now_ms:
+            removed.append((row['email'], row['inbound_id']))
+        elif expiry_time != row['expiry_time'] or notify_days != row['notify_days']:
+            changed.append((expiry_time, notify_days, expiry_time - notify_days * MS_PER_DAY,
+                            row['email'], row['inbound_id']))
+
+    db.executemany('''UPDATE expiry_timeline 
+                     SET expiry_time = ?, notify_days = ?, notify_at = ?, updated_at = CURRENT_TIMESTAMP 
+                     WHERE email = ? AND inbound_id = ?''', changed)
+    db.executemany('DELETE FROM expiry_timeline WHERE email = ? AND inbound_id = ?', removed)
+    db.commit()
+
+def schedule_next_expiry_check(min_delay=0):
+    """
+    Ставит проверку подписок на момент, когда следующему клиенту пора напомнить.
+
+    Args:
+        min_delay (int): Не раньше чем через столько секунд
+    """
+    if scheduler is None or not scheduler.running:
+        return
+
+    settings = get_telegram_settings()
+    if not settings or not settings['is_enabled']:
+        # Бот выключен - напоминать некому, проверка вернется после включения
+        if scheduler.get_job('check_subscriptions'):
+            scheduler.remove_job('check_subscriptions')
+        return
+
+    now_ms = datetime.now().timestamp() * 1000
+    db = get_db()
+    try:
+        next_at = db.execute(SQL_NEXT_NOTIFY_AT, [now_ms]).fetchone()['next_at']
+    finally:
+        db.close()
+
+    if next_at is None:
+        # Напоминать некому, следующую проверку поставит синхронизация
+        if scheduler.get_job('check_subscriptions'):
+            scheduler.remove_job('check_subscriptions')
+        return
+
+    run_date = max(datetime.fromtimestamp(next_at / 1000, tz=utc),
+                   datetime.now(utc) + timedelta(seconds=min_delay))
+    scheduler.add_job(
+        func=check_expiring_subscriptions,
+        trigger='date',
+        run_date=run_date,
+        id='check_subscriptions',
+        replace_existing=True,
+        misfire_grace_time=None
+    )
+    print(f"Next subscription check at {run_date.isoformat()}")
+
+def sync_subscriptions():
+    """Синхронизирует expiry_timeline с панелью и переставляет следующую проверку"""
+    try:
+        with app.app_context():
+            settings = get_telegram_settings()
+            if not settings or not settings['is_enabled'] or not get_settings():
+                return
+
+            try:
+                snapshot = get_inbound_snapshot()
+            except PanelError as e:
+                print(f"Error syncing expiry timeline: {str(e)}")
+                return
+
+            changed, removed = sync_expiry_timeline(snapshot, get_notify_days())
+            print(f"Expiry timeline synced: {changed} changed, {removed} removed")
+            schedule_next_expiry_check()
+    except Exception as e:
+        print(f"Error in sync_subscriptions: {str(e)}")
+
 def check_expiring_subscriptions():
+    """
+    Отправляет напоминания клиентам, чей срок подошел по expiry_timeline.
+
+    Запускается не по интервалу, а на момент ближайшего notify_at, поэтому
+    работа пропорциональна числу клиентов, которым пора напомнить.
+    """
     print("Starting subscription check...")  # Добавим отладочный вывод
     try:
         # Создаем новый контекст приложения
@@ -2007,8 +5051,8 @@ def check_expiring_subscriptions():
             # Получаем настройки из базы данных
             db = get_db()
             try:
-                settings = db.execute('SELECT * FROM telegram_settings ORDER BY id DESC LIMIT 1').fetchone()
-                panel_settings = db.execute('SELECT * FROM settings ORDER BY id DESC LIMIT 1').fetchone()
+                settings = get_telegram_settings()
+                panel_settings = get_settings()
                 
                 if not settings or not settings['is_enabled']:
                     print("Telegram bot is not enabled or settings not found")
@@ -2021,95 +5065,115 @@ def check_expiring_subscriptions():
                 print(f"Starting subscription check with notify_days={settings['notify_days']}")
                 
                 # Очищаем старые уведомления (старше 24 часов)
-                db.execute('''DELETE FROM notification_history 
-                            WHERE created_at < datetime('now', '-1 day')''')
+                db.execute(SQL_CLEANUP_NOTIFICATION_HISTORY)
                 db.commit()
                 
-                # Получаем список клиентов через API панели
-                session = requests.Session()
-                login_response = session.post(
-                    f"{panel_settings['panel_url']}/login",
-                    data={'username': panel_settings['username'], 'password': panel_settings['password']}
-                )
+                notify_days = get_notify_days()
+                current_time = datetime.now().timestamp() * 1000
+                
+                due = load_due_timeline(db, current_time)
+                if due:
+                    # Срок могли продлить в панели после последней синхронизации
+                    try:
+                        snapshot = get_inbound_snapshot()
+                    except PanelAuthError:
+                        print("Ошибка авторизации в панели")
+                        return
+                    except PanelError:
+                        print("Ошибка получения списка клиентов")
+                        return
+                    refresh_due_timeline(db, snapshot, due, notify_days)
+                    due = load_due_timeline(db, current_time)
                 
-                if login_response.status_code != 200:
-                    print("Ошибка авторизации в панели")
+                print(f"{len(due)} clients are due for an expiry reminder")
+                if not due:
+                    print("Subscription check completed")
                     return
+                
+                # Историю и tgid читаем внутри транзакции записи, чтобы параллельная
+                # проверка не поставила те же уведомления второй раз
+                db.execute('BEGIN IMMEDIATE')
+                emails = list(dict.fromkeys(row['email'] for row in due))
+                notified = set()
+                tgids = {}
+                # Ограничение SQLite на число параметров в одном запросе
+                for i in range(0, len(emails), 500):
+                    chunk = emails[i:i + 500]
+                    placeholders = ','.join('?' * len(chunk))
+                    notified.update(
+                        (row['email'], row['expiry_time'])
+                        for row in db.execute(SQL_NOTIFIED_EMAILS.format(placeholders=placeholders), chunk)
+                    )
+                    tgids.update(
+                        (row['email'], row['tgid'])
+                        for row in db.execute(SQL_TGIDS_BY_EMAILS.format(placeholders=placeholders), chunk)
+                    )
+                
+                planned = []
+                planned_emails = set()
+                skipped_without_tgid = 0
+                for row in due:
+                    # Клиенту на нескольких узлах хватает одного напоминания (о ближайшем сроке)
+                    if (row['email'], row['expiry_time']) in notified or row['email'] in planned_emails:
+                        continue
                     
-                clients_response = session.get(f"{panel_settings['panel_url']}/panel/api/inbounds/list")
-                clients_data = clients_response.json()
+                    tgid = tgids.get(row['email'])
+                    if not tgid:
+                        skipped_without_tgid += 1
+                        continue
+                    planned.append((row, (row['expiry_time'] - current_time) / MS_PER_DAY, tgid))
+                    planned_emails.add(row['email'])
                 
-                if not clients_data.get('success'):
-                    print("Ошибка получения списка клиентов")
-                    return
+                delays = plan_notification_delays(db, len(planned))
+                
+                # Напоминания ждут своего run_at в отдельной группе, чтобы не задерживать
+                # остальные сообщения чату (уведомление об оплате, счет из /payments/create).
+                # Уведомления за разные сутки различаются: история хранится 24 часа,
+                # после этого напоминание отправляется снова
+                notify_date = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+                history = []
+                for (row, days_left, tgid), delay in zip(planned, delays):
+                    # Счет (если включено) и уведомление создает очередь задач в назначенное время
+                    if settings['create_payment'] and settings['payment_amount']:
+                        payment_id = f"vpn_{row['email']}_{int(datetime.now().timestamp())}"
+                        enqueue_job(db, 'create_invoice', {
+                            'email': row['email'],
+                            'amount': float(settings['payment_amount']),
+                            'days': 30,  # Станартный период продления
+                            'inbound_id': row['inbound_id'],
+                            'tgid': tgid,
+                            'payment_id': payment_id,
+                            'days_left': int(days_left),
+                        }, dedup_key=f"create_invoice:{row['email']}:{row['expiry_time']}:{notify_date}",
+                           group_key=f"reminder:{tgid}", delay=delay)
+                    else:
+                        message = settings['notification_template'].format(
+                            days=int(days_left),
+                            email=row['email'],
+                            payment_link=''
+                        )
+                        enqueue_job(db, 'send_message', {
+                            'chat_id': tgid,
+                            'text': message,
+                        }, dedup_key=f"expiry_notice:{row['email']}:{row['expiry_time']}:{notify_date}",
+                           group_key=f"reminder:{tgid}", delay=delay)
                     
-                current_time = datetime.now().timestamp() * 1000
-                notify_days = int(settings['notify_days'])
+                    history.append((row['email'], row['expiry_time']))
                 
-                print(f"Checking {len(clients_data['obj'])} inbounds...")
+                # Вся история уведомлений пишется одной транзакцией вместе с задачами
+                db.executemany('''
+                    INSERT INTO notification_history (email, expiry_time)
+                    VALUES (?, ?)
+                ''', history)
                 
-                # Проверяем каждого клиента
-                for inbound in clients_data['obj']:
-                    for client in inbound['clientStats']:
-                        if client['expiryTime'] > 0:  # Пропускаем бессрочные подписки
-                            days_left = (client['expiryTime'] - current_time) / (1000 * 60 * 60 * 24)
-                            
-                            print(f"Checking client {client['email']}, days left: {days_left:.1f}")
-                            
-                            # Если осталось меньше указанного количества дней
-                            if 0 < days_left < notify_days:
-                                # Проверяем, не отправляли ли мы уже уведомление
-                                notification = db.execute(
-                                    'SELECT * FROM notification_history WHERE email = ? AND expiry_time = ?', 
-                                    (client['email'], client['expiryTime'])
-                                ).fetchone()
-                                
-                                if not notification:  # Если уведомление еще не отправлялось
-                                    client_data = db.execute(
-                                        'SELECT tgid FROM client_data WHERE email = ?',
-                                        [client['email']]
-                                    ).fetchone()
-                                    
-                                    if client_data and client_data['tgid']:
-                                        print(f"Sending notification to {client['email']}")
-                                        
-                                        # Создаем плате если включено
-                                        payment_link = ''
-                                        if settings['create_payment'] and settings['payment_amount']:
-                                            try:
-                                                payment = create_payment_for_client(
-                                                    client['email'],
-                                                    float(settings['payment_amount']),
-                                                    30,  # Станартный период продления
-                                                    inbound['id'],
-                                                    client_data['tgid']
-                                                )
-                                                if payment.get('success'):
-                                                    payment_link = payment['payment_url']
-                                            except Exception as e:
-                                                print(f"Ошибка создания платеа: {str(e)}")
-                                        
-                                        # Формируем и отправляем уведомление
-                                        message = settings['notification_template'].format(
-                                            days=int(days_left),
-                                            email=client['email'],
-                                            payment_link=f"\nСсылка для оплаты:\n{payment_link}" if payment_link else ''
-                                        )
-                                        
-                                        bot = telebot.TeleBot(settings['bot_token'])
-                                        bot.send_message(client_data['tgid'], message)
-                                        print(f"Notification sent to {client['email']}")
-                                        
-                                        # Сохраняем информаци об отпраленном уведомлении
-                                        db.execute('''
-                                            INSERT INTO notification_history (email, expiry_time)
-                                            VALUES (?, ?)
-                                        ''', [client['email'], client['expiryTime']])
-                                        db.commit()
-                                    else:
-                                        print(f"No Telegram ID found for {client['email']}")
-                                else:
-                                    print(f"Notification already sent to {client['email']}")
+                # Следующее напоминание тем же клиентам - через сутки, как и раньше
+                db.executemany('UPDATE expiry_timeline SET notify_at = ? WHERE email = ? AND inbound_id = ?',
+                              [(current_time + MS_PER_DAY, row['email'], row['inbound_id']) for row in due])
+                db.commit()
+                
+                print(f"Queued {len(history)} notifications over {max(delays, default=0) // 60 + 1} minutes, "
+                      f"{len(due) - len(history) - skipped_without_tgid} already sent, "
+                      f"{skipped_without_tgid} without Telegram ID")
                 
                 print("Subscription check completed")
                 
@@ -2119,6 +5183,9 @@ def check_expiring_subscriptions():
                 db.close()
     except Exception as e:
         print(f"Error in check_expiring_subscriptions: {str(e)}")
+    finally:
+        # Если клиента не удалось обработать, не просыпаемся снова сразу же
+        schedule_next_expiry_check(min_delay=EXPIRY_CHECK_MIN_DELAY)
 
 @app.route('/payments')
 @login_required
@@ -2190,8 +5257,11 @@ def delete_record():
         
         db = get_db()
         db.execute(f'DELETE FROM {table} WHERE id = ?', [record_id])
+        if table in SETTINGS_TABLES:
+            bump_settings_version(db)
         db.commit()
         db.close()
+        settings_cache.invalidate()
         
         return jsonify({'success': True})
     except Exception as e:
@@ -2212,7 +5282,7 @@ if __name__ == '__main__':
         if not shutdown_event:  # Проверяем, не начато ли уже завершение
             shutdown_event = True
             print("\nReceived shutdown signal...")
-            stop_telegram_bot()
+            stop_background_services()
             sys.exit(0)
     
     signal.signal(signal.SIGINT, signal_handler)
@@ -2220,9 +5290,15 @@ if __name__ == '__main__':
     
     try:
         init_db()
-        init_scheduler()
-        handle_telegram_commands()
+        start_background_services()
         app.run(debug=True)
     finally:
         if not shutdown_event:  # Останавливаем бота только если еще не остановлен
-            stop_telegram_bot()
\ No newline at end of file
+            stop_background_services()
+        db_pool.close_all()
+elif os.environ.get('START_BACKGROUND_SERVICES') == '1':
+    # Под WSGI-сервером (gunicorn с несколькими воркерами) блок выше не выполняется:
+    # каждый воркер запускает фоновые службы сам, лидером становится один из них
+    init_db()
+    start_background_services()
+    atexit.register(stop_background_services)
\ No newline at end of file
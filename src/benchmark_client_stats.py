@@ -0,0 +1,82 @@
+"""
+Сравнение построчной проверки клиентов с колоночным ClientStatsView.
+
+Запуск из каталога src: python benchmark_client_stats.py
+"""
+import random
+import time
+from datetime import datetime
+
+import app
+from app import ClientStatsView, MS_PER_DAY
+
+NOTIFY_DAYS = 3
+REPEAT = 5
+
+def make_inbounds(count, clients_per_inbound=1000):
+    """Синтетический список inbound с count клиентами"""
+    now_ms = int(datetime.now().timestamp() * 1000)
+    inbounds = []
+    for start in range(0, count, clients_per_inbound):
+        clients = []
+        for index in range(start, min(start + clients_per_inbound, count)):
+            total = random.choice([0, 10, 50, 100]) * 1024 ** 3
+            clients.append({
+                'email': f'client{index}@example.com',
+                'expiryTime': random.choice([0, now_ms + random.randint(-10, 60) * MS_PER_DAY]),
+                'up': random.randint(0, 20 * 1024 ** 3),
+                'down': random.randint(0, 80 * 1024 ** 3),
+                'total': total,
+                'enable': random.random() > 0.05,
+            })
+        inbounds.append({'id': len(inbounds) + 1, 'clientStats': clients})
+    return inbounds
+
+def loop_masks(inbounds, now_ms, notify_days):
+    """Прежний способ: цикл по клиентам с вычислением дней и трафика для каждого"""
+    expiring, expired, over_quota = [], [], []
+    for inbound in inbounds:
+        for client in inbound['clientStats']:
+            if client['expiryTime'] > 0:
+                days_left = (client['expiryTime'] - now_ms) / (1000 * 60 * 60 * 24)
+                if 0 < days_left < notify_days:
+                    expiring.append(client)
+                elif days_left <= 0:
+                    expired.append(client)
+            used_gb = (client['up'] + client['down']) / (1024 * 1024 * 1024)
+            if client['total'] > 0 and used_gb >= client['total'] / (1024 * 1024 * 1024):
+                over_quota.append(client)
+    return expiring, expired, over_quota
+
+def best_of(func, *args):
+    best = None
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+def main():
+    print(f"NumPy: {'yes' if app.np is not None else 'no (list fallback)'}")
+    print(f"{'clients':>8} {'loop, ms':>10} {'build, ms':>10} {'masks, ms':>10} {'speedup':>8}")
+    for count in (1000, 10000, 100000):
+        inbounds = make_inbounds(count)
+        now_ms = datetime.now().timestamp() * 1000
+
+        loop_ms = best_of(loop_masks, inbounds, now_ms, NOTIFY_DAYS)
+        build_ms = best_of(ClientStatsView, inbounds)
+        view = ClientStatsView(inbounds)
+        masks_ms = best_of(view.masks, now_ms, NOTIFY_DAYS)
+
+        # Результаты должны совпадать с прежним циклом
+        expiring, expired, over_quota = loop_masks(inbounds, now_ms, NOTIFY_DAYS)
+        masks = view.masks(now_ms, NOTIFY_DAYS)
+        assert len(masks['expiring']) == len(expiring)
+        assert len(masks['expired']) == len(expired)
+        assert len(masks['over_quota']) == len(over_quota)
+
+        print(f"{count:>8} {loop_ms:>10.2f} {build_ms:>10.2f} {masks_ms:>10.2f} {loop_ms / masks_ms:>7.1f}x")
+
+if __name__ == '__main__':
+    main()
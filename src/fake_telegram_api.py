@@ -0,0 +1,190 @@
+"""
+Локальная заглушка Telegram Bot API для проверки бота без сети.
+
+Запуск из каталога src:
+    python fake_telegram_api.py --port 8081
+и приложение с TELEGRAM_API_URL=http://127.0.0.1:8081/bot{0}/{1}
+
+Бот видит заглушку как настоящий Bot API: getUpdates (long polling), setWebhook,
+deleteWebhook, sendMessage, sendPhoto, answerCallbackQuery, deleteMessage.
+Для управления есть служебные адреса:
+    POST /_updates  chat_id, text или data - сообщение или нажатие кнопки от пользователя
+    GET  /_sent     что бот отправил
+Если бот установил webhook, обновления отправляются на его адрес (или на --webhook-target,
+т.к. приложение принимает только https-адрес) с заголовком секрета.
+"""
+import argparse
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import requests
+
+class FakeTelegramApi:
+    """Состояние заглушки: очередь обновлений, webhook и отправленные ботом сообщения"""
+
+    def __init__(self, webhook_target=None, flood_every=0, retry_after=1):
+        self.webhook_target = webhook_target
+        self.flood_every = flood_every  # Каждый N-й sendMessage/sendPhoto отвечает 429, 0 - никогда
+        self.retry_after = retry_after
+
+        self._condition = threading.Condition()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._send_calls = itertools.count(1)
+        self.updates = []
+        self.sent = []
+        self.webhook = None  # (url, secret_token)
+
+    def _message(self, chat_id, **fields):
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'},
+        }
+        message.update(fields)
+        return message
+
+    def push_update(self, chat_id, text=None, data=None):
+        """Сообщение пользователя (text) или нажатие inline-кнопки (data)"""
+        user = {'id': int(chat_id), 'is_bot': False, 'first_name': 'Test'}
+        update = {'update_id': next(self._update_ids)}
+        if data is not None:
+            update['callback_query'] = {
+                'id': str(update['update_id']),
+                'from': user,
+                'chat_instance': str(chat_id),
+                'message': self._message(chat_id, text='...'),
+                'data': data,
+            }
+        else:
+            message = self._message(chat_id, text=text or '')
+            message['from'] = user
+            if message['text'].startswith('/'):
+                command = message['text'].split()[0]
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+            update['message'] = message
+
+        webhook = self.webhook
+        if webhook:
+            response = requests.post(self.webhook_target or webhook[0], json=update, timeout=10,
+                                     headers={'X-Telegram-Bot-Api-Secret-Token': webhook[1] or ''})
+            return {'update_id': update['update_id'], 'webhook_status': response.status_code}
+
+        with self._condition:
+            self.updates.append(update)
+            self._condition.notify_all()
+        return {'update_id': update['update_id']}
+
+    def get_updates(self, offset=0, timeout=0):
+        """getUpdates: подтверждает обновления до offset и ждет новые до timeout секунд"""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self._condition.wait(deadline - time.monotonic())
+            return list(self.updates)
+
+    def call(self, method, params):
+        """Вызов метода Bot API. Returns: (HTTP-статус, тело ответа)"""
+        if method in ('sendMessage', 'sendPhoto') and self.flood_every and next(self._send_calls) % self.flood_every == 0:
+            return 429, {'ok': False, 'error_code': 429,
+                         'description': f'Too Many Requests: retry after {self.retry_after}',
+                         'parameters': {'retry_after': self.retry_after}}
+
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}
+        elif method == 'getUpdates':
+            result = self.get_updates(int(params.get('offset') or 0), float(params.get('timeout') or 0))
+        elif method == 'setWebhook':
+            # telebot.remove_webhook вызывает setWebhook с пустым url
+            self.webhook = (params['url'], params.get('secret_token')) if params.get('url') else None
+            result = True
+        elif method == 'deleteWebhook':
+            self.webhook = None
+            result = True
+        elif method == 'getWebhookInfo':
+            result = {'url': self.webhook[0] if self.webhook else '', 'pending_update_count': len(self.updates)}
+        elif method == 'sendMessage':
+            result = self._message(params['chat_id'], text=params.get('text', ''))
+        elif method == 'sendPhoto':
+            photo = params.get('photo') or f'fake-photo-{len(self.sent) + 1}'
+            result = self._message(params['chat_id'], caption=params.get('caption', ''),
+                                   photo=[{'file_id': photo, 'file_unique_id': photo, 'width': 1, 'height': 1}])
+        elif method in ('answerCallbackQuery', 'deleteMessage'):
+            result = True
+        else:
+            return 404, {'ok': False, 'error_code': 404, 'description': 'Not Found: method not found'}
+
+        if method in ('sendMessage', 'sendPhoto'):
+            with self._condition:
+                self.sent.append({'method': method, 'params': params, 'at': time.time()})
+        return 200, {'ok': True, 'result': result}
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, status, body):
+            data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _params(self):
+            """Параметры из строки запроса, формы или JSON (файлы multipart не разбираются)"""
+            url = urlsplit(self.path)
+            params = dict(parse_qsl(url.query))
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            content_type = self.headers.get('Content-Type', '')
+            if content_type.startswith('application/json') and body:
+                params.update(json.loads(body))
+            elif content_type.startswith('application/x-www-form-urlencoded'):
+                params.update(parse_qsl(body.decode('utf-8')))
+            return url.path, params
+
+        def _handle(self):
+            path, params = self._params()
+            if path == '/_updates':
+                self._reply(200, api.push_update(params['chat_id'], params.get('text'), params.get('data')))
+            elif path == '/_sent':
+                self._reply(200, api.sent)
+            elif path.startswith('/bot') and path.count('/') == 2:
+                self._reply(*api.call(path.rsplit('/', 1)[1], params))
+            else:
+                self._reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+
+        do_GET = _handle
+        do_POST = _handle
+
+    return Handler
+
+def serve(port=0, **options):
+    """Запускает заглушку в фоновом потоке. Returns: (FakeTelegramApi, сервер)"""
+    api = FakeTelegramApi(**options)
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(api))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return api, server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Локальная заглушка Telegram Bot API')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--webhook-target', help='куда отправлять обновления вместо адреса из setWebhook')
+    parser.add_argument('--flood-every', type=int, default=0, help='каждый N-й send отвечает 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    args = parser.parse_args()
+
+    api, server = serve(args.port, webhook_target=args.webhook_target,
+                        flood_every=args.flood_every, retry_after=args.retry_after)
+    print(f"Fake Telegram API on http://127.0.0.1:{server.server_address[1]}/bot{{0}}/{{1}}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
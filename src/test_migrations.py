@@ -0,0 +1,33 @@
+"""
+Проверка схемы: миграции применяются на пустой базе, частые запросы идут по индексам.
+
+Запуск из каталога src: python -m unittest test_migrations
+"""
+import sqlite3
+import unittest
+
+from app import INDEXED_QUERIES, MIGRATIONS, find_full_scans, run_migrations
+
+class MigrationsTest(unittest.TestCase):
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        self.db.row_factory = sqlite3.Row
+        run_migrations(self.db)
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_all_migrations_applied(self):
+        versions = [row['version'] for row in self.db.execute('SELECT version FROM schema_version ORDER BY version')]
+        self.assertEqual(versions, [version for version, _, _ in MIGRATIONS])
+
+    def test_migrations_are_idempotent(self):
+        run_migrations(self.db)
+        count = self.db.execute('SELECT COUNT(*) FROM schema_version').fetchone()[0]
+        self.assertEqual(count, len(MIGRATIONS))
+
+    def test_indexed_queries_do_not_scan(self):
+        self.assertEqual(find_full_scans(self.db, INDEXED_QUERIES), [])
+
+if __name__ == '__main__':
+    unittest.main()
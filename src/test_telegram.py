@@ -0,0 +1,127 @@
+"""
+Проверка бота на заглушке Telegram Bot API (fake_telegram_api): прием обновлений
+через getUpdates и через webhook, повтор отправки после ответа 429.
+
+Запуск из каталога src: python -m unittest test_telegram
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import telebot
+from werkzeug.serving import make_server
+
+import app
+import fake_telegram_api
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+class TelegramBotTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # database.db создается в текущем каталоге
+        cls.old_cwd = os.getcwd()
+        cls.workdir = tempfile.mkdtemp()
+        os.chdir(cls.workdir)
+
+        cls.api, cls.api_server = fake_telegram_api.serve()
+        cls.old_api_url = telebot.apihelper.API_URL
+        telebot.apihelper.API_URL = f'http://127.0.0.1:{cls.api_server.server_port}/bot{{0}}/{{1}}'
+
+        # Приложение принимает только https-адрес webhook, заглушка шлет обновления сюда
+        cls.web_server = make_server('127.0.0.1', 0, app.app, threaded=True)
+        threading.Thread(target=cls.web_server.serve_forever, daemon=True).start()
+        cls.api.webhook_target = f'http://127.0.0.1:{cls.web_server.server_port}/telegram/webhook'
+
+        app.init_db()
+        db = app.get_db()
+        try:
+            db.execute('''INSERT INTO telegram_settings
+                         (bot_token, admin_chat_id, is_enabled, update_mode, webhook_secret)
+                         VALUES (?, ?, 1, ?, ?)''', ['1:test', '1', 'polling', 'secret'])
+            app.bump_settings_version(db)
+            db.commit()
+        finally:
+            db.close()
+        app.settings_cache.invalidate()
+        app.leader_elector._is_leader = True
+
+    @classmethod
+    def tearDownClass(cls):
+        app.stop_telegram_bot()
+        app.leader_elector._is_leader = False
+        cls.web_server.shutdown()
+        cls.api_server.shutdown()
+        telebot.apihelper.API_URL = cls.old_api_url
+        os.chdir(cls.old_cwd)
+        shutil.rmtree(cls.workdir, ignore_errors=True)
+
+    def setUp(self):
+        self.api.sent.clear()
+        self.api.flood_every = 0
+
+    def tearDown(self):
+        app.stop_telegram_bot()
+
+    def set_update_mode(self, mode, webhook_url=None):
+        db = app.get_db()
+        try:
+            db.execute('UPDATE telegram_settings SET update_mode = ?, webhook_url = ?', [mode, webhook_url])
+            app.bump_settings_version(db)
+            db.commit()
+        finally:
+            db.close()
+        app.settings_cache.invalidate()
+        app.handle_telegram_commands()
+
+    def sent_to(self, chat_id):
+        return [sent for sent in self.api.sent
+                if sent['method'] == 'sendMessage' and str(sent['params']['chat_id']) == str(chat_id)]
+
+    def test_polling_update_gets_reply(self):
+        self.set_update_mode('polling')
+        self.assertEqual(app.bot_mode, 'polling')
+        self.assertIsNone(self.api.webhook)
+
+        self.api.push_update(555, '/start')
+        self.assertTrue(wait_for(lambda: self.sent_to(555)))
+        time.sleep(0.5)
+        self.assertEqual(len(self.sent_to(555)), 1)
+
+    def test_webhook_update_gets_reply(self):
+        self.set_update_mode('webhook', 'https://example.org/telegram/webhook')
+        self.assertEqual(app.bot_mode, 'webhook')
+        self.assertEqual(self.api.webhook, ('https://example.org/telegram/webhook', 'secret'))
+
+        result = self.api.push_update(556, '/start')
+        self.assertEqual(result['webhook_status'], 200)
+        self.assertTrue(wait_for(lambda: self.sent_to(556)))
+        time.sleep(0.5)
+        self.assertEqual(len(self.sent_to(556)), 1)
+
+    def test_rate_limited_message_is_retried(self):
+        self.api.flood_every = 2
+        self.api.retry_after = 1
+        throttled = app.telegram_sender.stats()['throttled']
+
+        first = app.telegram_sender.send(557, 'first')
+        second = app.telegram_sender.send(557, 'second')
+        first.result(10)
+        second.result(10)
+
+        self.assertEqual([sent['params']['text'] for sent in self.sent_to(557)], ['first', 'second'])
+        self.assertEqual(app.telegram_sender.stats()['throttled'], throttled + 1)
+        sent_at = [sent['at'] for sent in self.sent_to(557)]
+        self.assertGreaterEqual(sent_at[1] - sent_at[0], 0.9)
+
+if __name__ == '__main__':
+    unittest.main()